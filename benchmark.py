@@ -0,0 +1,171 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+import bitboard_board
+import chess_board
+import opening_finder
+import perft
+import rulebook as rules
+
+# Representative positions, as moves in long algebraic notation from the starting position
+POSITIONS = {
+    "start": "",
+    "open_game": "e2e4 e7e5 g1f3 b8c6 f1b5 a7a6 b5a4 g8f6 e1g1 f8e7 f1e1 b7b5 a4b3 d7d6 c2c3 e8g8",
+    "queens_gambit": "d2d4 d7d5 c2c4 e7e6 b1c3 g8f6 c1g5 f8e7 e2e3 e8g8 g1f3 b8d7 a1c1 c7c6 f1d3 d5c4 d3c4",
+    "sharp_middlegame": "e2e4 c7c5 g1f3 d7d6 d2d4 c5d4 f3d4 g8f6 b1c3 a7a6 c1e3 e7e5 d4b3 c8e6 f2f3 b8d7 d1d2 b7b5 e1c1 f8e7 g2g4 b5b4 c3d5 f6d5 e4d5 e6d5",
+    "endgame": "e2e4 e7e5 d2d4 e5d4 d1d4 b8c6 d4e3 g8f6 b1c3 f8b4 c1d2 e8g8 e1c1 f8e8 e3g3 f6e4 c3e4 e8e4 d2b4 c6b4 g3c3 b4a2 c1b1 d8f6 c3f6 g7f6 b1a2",
+}
+
+BOOK_FILES = ["resources/a.tsv", "resources/b.tsv", "resources/c.tsv", "resources/d.tsv", "resources/e.tsv"]
+
+def play_uci_moves(board, moves):
+    """ Play space separated long algebraic notation moves, checking that each is legal """
+    for uci in moves.split():
+        start_row, start_col = rules.notation_to_loc(uci[0:2])
+        end_row, end_col = rules.notation_to_loc(uci[2:4])
+        legal = rules.compute_all_valid_moves(board).get((start_row, start_col), [])
+        if not any(m[0] == end_row and m[1] == end_col for m in legal):
+            raise ValueError("Illegal move " + uci + " in benchmark position")
+        board.make_move(start_row, start_col, end_row, end_col)
+
+def position_boards(board_type = chess_board.Board):
+    boards = {}
+    for name, moves in POSITIONS.items():
+        board = board_type()
+        play_uci_moves(board, moves)
+        boards[name] = board
+    return boards
+
+def time_call(function, iterations, repeats):
+    """ Returns the best (lowest) time in microseconds per call over the repeats """
+    best = None
+    for r in range(repeats):
+        start_time = time.perf_counter()
+        for i in range(iterations):
+            function()
+        elapsed = (time.perf_counter() - start_time) / iterations * 1000000
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def bench_make_unmake(board):
+    all_valid_moves = rules.compute_all_valid_moves(board)
+    moves = [(start, m) for start in all_valid_moves for m in all_valid_moves[start]]
+    def run():
+        for start, m in moves:
+            board.make_move(start[0], start[1], m[0], m[1])
+            board.unmake_move()
+    return run, len(moves)
+
+def bench_algebraic_notation(board):
+    targets = {}
+    all_valid_moves = rules.compute_all_valid_moves(board, targets)
+    moves = [(start, m) for start in all_valid_moves for m in all_valid_moves[start]]
+    def run():
+        for start, m in moves:
+            rules.algebraic_notation(start[0], start[1], m[0], m[1], all_valid_moves, board, targets)
+    return run, len(moves)
+
+def run_benchmarks(scale = 1.0, repeats = 5, board_type = chess_board.Board):
+    """ Returns a dict of benchmark name -> microseconds per operation, using boards of the given type """
+
+    def iterations(n):
+        return max(1, int(n * scale))
+
+    results = {}
+    boards = position_boards(board_type)
+    for name, board in boards.items():
+        run, count = bench_make_unmake(board)
+        results["make_unmake/" + name] = time_call(run, iterations(200), repeats) / count
+        results["compute_all_valid_moves/" + name] = time_call(lambda: rules.compute_all_valid_moves(board), iterations(200), repeats)
+        run, count = bench_algebraic_notation(board)
+        results["algebraic_notation/" + name] = time_call(run, iterations(50), repeats) / count
+        results["full_hash/" + name] = time_call(lambda: board.zobrist_hasher.full_hash(board), iterations(2000), repeats)
+        results["perft_3/" + name] = time_call(lambda: perft.perft(board, 3), iterations(1), repeats)
+
+    def load_books():
+        openings = opening_finder.OpeningFinder()
+        for filename in BOOK_FILES:
+            openings.load_opening_book_tsv(filename)
+        return openings
+    openings = load_books()
+    results["tsv_book_load"] = time_call(load_books, iterations(3), repeats)
+    for name, board in boards.items():
+        results["find_opening/" + name] = time_call(lambda: openings.find_opening(board), iterations(2000), repeats)
+
+    with tempfile.TemporaryDirectory() as directory:
+        book_filename = os.path.join(directory, "openings.bin")
+        opening_finder.compile_opening_book(BOOK_FILES, book_filename)
+        def open_book():
+            book = opening_finder.OpeningFinder()
+            book.open_opening_book(book_filename)
+            return book
+        book = open_book()
+        results["binary_book_open"] = time_call(lambda: open_book().close(), iterations(20), repeats)
+        for name, board in boards.items():
+            results["binary_book_lookup/" + name] = time_call(lambda: book.find_opening(board), iterations(2000), repeats)
+        book.close()
+
+    return results
+
+def compare(results, baseline, threshold):
+    """ Returns a list of (name, baseline, current, percent change) for paths slower than the threshold percent """
+    regressions = []
+    for name, current in results.items():
+        if name not in baseline:
+            continue
+        change = (current - baseline[name]) / baseline[name] * 100
+        if change > threshold:
+            regressions.append((name, baseline[name], current, change))
+    return regressions
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description = "Time the core engine paths and compare them against a saved baseline")
+    parser.add_argument("--baseline", default = "benchmark_baseline.json", help = "JSON file of baseline timings")
+    parser.add_argument("--save", action = "store_true", help = "write the results as the new baseline")
+    parser.add_argument("--threshold", type = float, default = 10.0, help = "percent slowdown that counts as a regression")
+    parser.add_argument("--scale", type = float, default = 1.0, help = "multiplier on the iteration counts")
+    parser.add_argument("--repeats", type = int, default = 5, help = "repeats per benchmark; the best is kept")
+    parser.add_argument("--board", choices = sorted(bitboard_board.BOARD_TYPES), default = "list", help = "board backend to time")
+    args = parser.parse_args()
+
+    # The opening book loader reports each file it loads
+    with contextlib.redirect_stdout(io.StringIO()):
+        results = run_benchmarks(args.scale, args.repeats, bitboard_board.BOARD_TYPES[args.board])
+
+    baseline = None
+    if not args.save:
+        try:
+            with open(args.baseline) as f:
+                saved = json.load(f)
+            baseline = saved["results"]
+            # Baselines saved with one backend can be compared against the other
+            baseline_board = saved.get("board", "list")
+            if baseline_board != args.board:
+                print("Comparing the", args.board, "board against a baseline of the", baseline_board, "board")
+        except FileNotFoundError:
+            print("No baseline found at", args.baseline + "; run with --save to create one")
+
+    for name, current in results.items():
+        line = '{0:<40} {1:>12.2f} us'.format(name, current)
+        if baseline and name in baseline:
+            line += '   {0:>+7.1f}%'.format((current - baseline[name]) / baseline[name] * 100)
+        print(line)
+
+    if args.save:
+        with open(args.baseline, "w") as f:
+            json.dump({"created": time.strftime("%Y-%m-%d %H:%M:%S"), "board": args.board, "results": results}, f, indent = 2, sort_keys = True)
+        print("Baseline written to", args.baseline)
+    elif baseline:
+        regressions = compare(results, baseline, args.threshold)
+        for name, old, new, change in regressions:
+            print("REGRESSION:", name, "went from", '{0:.2f}'.format(old), "us to", '{0:.2f}'.format(new), "us", '({0:+.1f}%)'.format(change))
+        if regressions:
+            sys.exit(1)
+        print("No regressions beyond", str(args.threshold) + "%")
@@ -0,0 +1,470 @@
+import chess_board
+
+# Bitboards use one bit per square, where the bit index of a square
+# is row * 8 + col (the same square index used by the Zobrist hasher).
+# Row 0 is the 8th rank, so bit 0 is a8 and bit 63 is h1.
+
+def square_bit(row, col):
+    return 1 << (row * 8 + col)
+
+def in_bounds(row, col):
+    return row >= 0 and row <= 7 and col >= 0 and col <= 7
+
+def build_step_attacks(offsets):
+    """ Returns a 64 element list of attack masks for a piece that steps by the given offsets """
+    attacks = []
+    for square in range(64):
+        row, col = divmod(square, 8)
+        mask = 0
+        for dr, dc in offsets:
+            if in_bounds(row + dr, col + dc):
+                mask |= square_bit(row + dr, col + dc)
+        attacks.append(mask)
+    return attacks
+
+def build_ray_masks(direction):
+    """ Returns a 64 element list of masks of every square along a direction, excluding the origin """
+    rays = []
+    for square in range(64):
+        row, col = divmod(square, 8)
+        mask = 0
+        r = row + direction[0]
+        c = col + direction[1]
+        while in_bounds(r, c):
+            mask |= square_bit(r, c)
+            r += direction[0]
+            c += direction[1]
+        rays.append(mask)
+    return rays
+
+KNIGHT_ATTACKS = build_step_attacks([(-2, -1), (-1, -2), (-2, 1), (-1, 2), (2, -1), (1, -2), (2, 1), (1, 2)])
+KING_ATTACKS = build_step_attacks([(-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, -1), (1, 0), (1, 1)])
+
+# Squares attacked by a white pawn (moving "up" toward row 0) or a black pawn
+WHITE_PAWN_ATTACKS = build_step_attacks([(-1, -1), (-1, 1)])
+BLACK_PAWN_ATTACKS = build_step_attacks([(1, -1), (1, 1)])
+
+# Ray masks are split by whether the bit index grows along the ray, since
+# the first blocker is then the lowest set bit rather than the highest one
+ROOK_DIRECTIONS = [(-1, 0), (1, 0), (0, -1), (0, 1)]
+BISHOP_DIRECTIONS = [(-1, -1), (-1, 1), (1, -1), (1, 1)]
+RAYS = {d: build_ray_masks(d) for d in ROOK_DIRECTIONS + BISHOP_DIRECTIONS}
+
+def ray_attacks(square, occupancy, direction):
+    ray = RAYS[direction][square]
+    blockers = ray & occupancy
+    if blockers:
+        if direction[0] * 8 + direction[1] > 0:
+            first = (blockers & -blockers).bit_length() - 1
+        else:
+            first = blockers.bit_length() - 1
+        ray ^= RAYS[direction][first]
+    return ray
+
+def build_line_attacks(directions):
+    """
+    Returns (masks, tables) for sliding along a line through each square in the two
+    opposite directions given.  masks[square] holds the line's squares that can block
+    (the last square of each ray cannot), and tables[square] maps every occupancy of
+    those squares to the attack mask, so attacks are a single lookup.
+    """
+    masks = []
+    tables = []
+    for square in range(64):
+        mask = 0
+        for d in directions:
+            ray = RAYS[d][square]
+            if ray:
+                last = ray.bit_length() - 1 if d[0] * 8 + d[1] > 0 else (ray & -ray).bit_length() - 1
+                mask |= ray ^ (1 << last)
+        table = {}
+        # Enumerate every subset of the mask
+        occupancy = 0
+        while True:
+            table[occupancy] = ray_attacks(square, occupancy, directions[0]) | ray_attacks(square, occupancy, directions[1])
+            occupancy = (occupancy - mask) & mask
+            if occupancy == 0:
+                break
+        masks.append(mask)
+        tables.append(table)
+    return masks, tables
+
+FILE_MASKS, FILE_ATTACKS = build_line_attacks([(-1, 0), (1, 0)])
+RANK_MASKS, RANK_ATTACKS = build_line_attacks([(0, -1), (0, 1)])
+DIAGONAL_MASKS, DIAGONAL_ATTACKS = build_line_attacks([(-1, -1), (1, 1)])
+ANTI_DIAGONAL_MASKS, ANTI_DIAGONAL_ATTACKS = build_line_attacks([(-1, 1), (1, -1)])
+
+def rook_attacks(square, occupancy):
+    return (FILE_ATTACKS[square][occupancy & FILE_MASKS[square]] |
+            RANK_ATTACKS[square][occupancy & RANK_MASKS[square]])
+
+def bishop_attacks(square, occupancy):
+    return (DIAGONAL_ATTACKS[square][occupancy & DIAGONAL_MASKS[square]] |
+            ANTI_DIAGONAL_ATTACKS[square][occupancy & ANTI_DIAGONAL_MASKS[square]])
+
+def piece_attacks(piece, square, occupancy):
+    """ Attack mask of a non-pawn piece standing on square """
+    p = piece.upper()
+    if p == "N":
+        return KNIGHT_ATTACKS[square]
+    if p == "K":
+        return KING_ATTACKS[square]
+    if p == "R":
+        return rook_attacks(square, occupancy)
+    if p == "B":
+        return bishop_attacks(square, occupancy)
+    if p == "Q":
+        return rook_attacks(square, occupancy) | bishop_attacks(square, occupancy)
+    return 0
+
+ROOK_LINES = [0] * 64
+BISHOP_LINES = [0] * 64
+# BETWEEN[a][b] is the mask of the squares strictly between two squares on a
+# shared rank, file, or diagonal (0 if they share none)
+BETWEEN = [[0] * 64 for square in range(64)]
+for square in range(64):
+    row, col = divmod(square, 8)
+    for d in ROOK_DIRECTIONS + BISHOP_DIRECTIONS:
+        if d in ROOK_DIRECTIONS:
+            ROOK_LINES[square] |= RAYS[d][square]
+        else:
+            BISHOP_LINES[square] |= RAYS[d][square]
+        passed = 0
+        r = row + d[0]
+        c = col + d[1]
+        while in_bounds(r, c):
+            BETWEEN[square][r * 8 + c] = passed
+            passed |= square_bit(r, c)
+            r += d[0]
+            c += d[1]
+
+ALL_SQUARES = (1 << 64) - 1
+ROW_COL = [divmod(square, 8) for square in range(64)]
+WHITE_PAWN_HOME = 0xff << 48 # row 6 (the 2nd rank)
+BLACK_PAWN_HOME = 0xff << 8 # row 1 (the 7th rank)
+
+def is_square_attacked(board, square, by_white, occupancy = None):
+    """
+    Returns True if the square is attacked by white (by_white) or black pieces.
+    Sliding attacks are computed against occupancy, which defaults to the board's.
+    """
+    bb = board.bitboards
+    if occupancy is None:
+        occupancy = board.occupancy
+    if by_white:
+        pawns, knights, bishops, rooks, queens, king = bb["P"], bb["N"], bb["B"], bb["R"], bb["Q"], bb["K"]
+        # A white pawn attacks the square if it stands where a black pawn on the square would attack
+        pawn_sources = BLACK_PAWN_ATTACKS[square]
+    else:
+        pawns, knights, bishops, rooks, queens, king = bb["p"], bb["n"], bb["b"], bb["r"], bb["q"], bb["k"]
+        pawn_sources = WHITE_PAWN_ATTACKS[square]
+    if pawn_sources & pawns or KNIGHT_ATTACKS[square] & knights or KING_ATTACKS[square] & king:
+        return True
+    if rook_attacks(square, occupancy) & (rooks | queens):
+        return True
+    if bishop_attacks(square, occupancy) & (bishops | queens):
+        return True
+    return False
+
+def is_king_in_check(white_king, board):
+    king = board.bitboards["K" if white_king else "k"]
+    if not king:
+        print("ERROR: Cannot find king in board " + str(board.squares))
+        return False
+    return is_square_attacked(board, king.bit_length() - 1, not white_king)
+
+def piece_moves(row, col, board):
+    """
+    Pseudo-legal moves of the knight, bishop, rook, queen, or king on (row, col),
+    in the (new row, new col, is en passant?, is capture?) format used by rulebook.
+    Castling is not included.
+    """
+    piece = board.squares[row][col]
+    if piece.isupper():
+        own, enemy = board.white_occupancy, board.black_occupancy
+    else:
+        own, enemy = board.black_occupancy, board.white_occupancy
+    targets = piece_attacks(piece, row * 8 + col, board.occupancy) & ~own
+    moves = []
+    while targets:
+        bit = targets & -targets
+        r, c = divmod(bit.bit_length() - 1, 8)
+        moves.append((r, c, False, bool(bit & enemy)))
+        targets ^= bit
+    return moves
+
+def legal_move_masks(board):
+    """
+    Legal moves of the side to move, found set-wise from the king's checkers and
+    pins.  Returns a list of (square, target mask, en passant bit) for each of its
+    pieces, where the en passant bit is the target bit of an en passant capture
+    included in the mask (0 if there is none).  Castling is included in the king's mask.
+    """
+    white = board.whites_turn
+    bb = board.bitboards
+    occupancy = board.occupancy
+    if white:
+        own = board.white_occupancy
+        pieces, enemy_knights, enemy_pawns = "KQRBNP", bb["n"], bb["p"]
+        enemy_straight, enemy_diagonal = bb["r"] | bb["q"], bb["b"] | bb["q"]
+        pawn_attacks = WHITE_PAWN_ATTACKS
+    else:
+        own = board.black_occupancy
+        pieces, enemy_knights, enemy_pawns = "kqrbnp", bb["N"], bb["P"]
+        enemy_straight, enemy_diagonal = bb["R"] | bb["Q"], bb["B"] | bb["Q"]
+        pawn_attacks = BLACK_PAWN_ATTACKS
+    king = bb[pieces[0]]
+    results = []
+
+    # Without a king there is nothing to keep out of check
+    check_mask = ALL_SQUARES
+    pins = {} # pinned piece bit -> mask of the squares it may still move to
+    if king:
+        king_square = king.bit_length() - 1
+        checkers = (KNIGHT_ATTACKS[king_square] & enemy_knights | pawn_attacks[king_square] & enemy_pawns |
+                    rook_attacks(king_square, occupancy) & enemy_straight |
+                    bishop_attacks(king_square, occupancy) & enemy_diagonal)
+        if checkers:
+            if checkers & (checkers - 1):
+                # Only the king can get out of a double check
+                check_mask = 0
+            else:
+                check_mask = checkers | BETWEEN[king_square][checkers.bit_length() - 1]
+
+        # An opposing slider on a line with the king, with only one of our pieces in between, pins it
+        pinners = ROOK_LINES[king_square] & enemy_straight | BISHOP_LINES[king_square] & enemy_diagonal
+        while pinners:
+            bit = pinners & -pinners
+            pinners ^= bit
+            between = BETWEEN[king_square][bit.bit_length() - 1]
+            blockers = between & occupancy
+            if blockers and not blockers & (blockers - 1) and blockers & own:
+                pins[blockers] = between | bit
+
+        # The king may go to any square not attacked once it has stepped off its own square
+        targets = KING_ATTACKS[king_square] & ~own
+        legal = 0
+        without_king = occupancy ^ king
+        enemy_king = bb["k" if white else "K"]
+        while targets:
+            bit = targets & -targets
+            targets ^= bit
+            square = bit.bit_length() - 1
+            if not (KNIGHT_ATTACKS[square] & enemy_knights or pawn_attacks[square] & enemy_pawns or
+                    KING_ATTACKS[square] & enemy_king or rook_attacks(square, without_king) & enemy_straight or
+                    bishop_attacks(square, without_king) & enemy_diagonal):
+                legal |= bit
+        if not checkers:
+            legal |= castling_mask(board, white)
+        results.append((king_square, legal, 0))
+
+    allowed = ~own & check_mask
+    for remaining, straight, diagonal in ((bb[pieces[1]], True, True), (bb[pieces[2]], True, False), (bb[pieces[3]], False, True)):
+        while remaining:
+            bit = remaining & -remaining
+            remaining ^= bit
+            square = bit.bit_length() - 1
+            targets = 0
+            if straight:
+                targets = (FILE_ATTACKS[square][occupancy & FILE_MASKS[square]] |
+                           RANK_ATTACKS[square][occupancy & RANK_MASKS[square]])
+            if diagonal:
+                targets |= (DIAGONAL_ATTACKS[square][occupancy & DIAGONAL_MASKS[square]] |
+                            ANTI_DIAGONAL_ATTACKS[square][occupancy & ANTI_DIAGONAL_MASKS[square]])
+            targets &= allowed
+            if bit in pins:
+                targets &= pins[bit]
+            results.append((square, targets, 0))
+    remaining = bb[pieces[4]]
+    while remaining:
+        bit = remaining & -remaining
+        remaining ^= bit
+        square = bit.bit_length() - 1
+        # A pinned knight can never stay on the pin ray
+        results.append((square, 0 if bit in pins else KNIGHT_ATTACKS[square] & allowed, 0))
+
+    ep_bit = 0
+    ep_row, ep_col = board.en_passant_rights
+    if ep_col != -1 and ep_row == (2 if white else 5):
+        ep_bit = square_bit(ep_row, ep_col)
+    enemy = occupancy ^ own
+    remaining = bb[pieces[5]]
+    while remaining:
+        bit = remaining & -remaining
+        remaining ^= bit
+        square = bit.bit_length() - 1
+        if white:
+            push = bit >> 8
+            double_push = bit >> 16 if bit & WHITE_PAWN_HOME else 0
+        else:
+            push = bit << 8
+            double_push = bit << 16 if bit & BLACK_PAWN_HOME else 0
+        targets = pawn_attacks[square] & enemy
+        if not push & occupancy:
+            targets |= push
+            if double_push and not double_push & occupancy:
+                targets |= double_push
+        targets &= check_mask
+        if bit in pins:
+            targets &= pins[bit]
+        pawn_ep = 0
+        if ep_bit & pawn_attacks[square]:
+            # The capture takes two pawns off the same rank, which can expose the
+            # king to a slider along it, so the position after it is tested in full
+            captured = ep_bit << 8 if white else ep_bit >> 8
+            after = occupancy ^ bit ^ captured | ep_bit
+            if not king or not (rook_attacks(king_square, after) & enemy_straight or
+                                bishop_attacks(king_square, after) & enemy_diagonal or
+                                KNIGHT_ATTACKS[king_square] & enemy_knights or
+                                pawn_attacks[king_square] & (enemy_pawns ^ captured)):
+                targets |= ep_bit
+                pawn_ep = ep_bit
+        results.append((square, targets, pawn_ep))
+
+    return results
+
+def castling_mask(board, white):
+    """
+    Target bits of the castling moves available to the white (or black) king, which
+    must not be in check.  The board's castling rights already record whether the
+    king or rook has moved or the rook was captured, so only the squares need checking.
+    """
+    if white:
+        ks_rights, qs_rights, home = board.white_ks_castling_rights, board.white_qs_castling_rights, 56
+    else:
+        ks_rights, qs_rights, home = board.black_ks_castling_rights, board.black_qs_castling_rights, 0
+    occupancy = board.occupancy
+    mask = 0
+    # Short castle: squares between king and rook are empty and the king does not go through check
+    if (ks_rights and not occupancy & (0x60 << home) and
+        not is_square_attacked(board, home + 5, not white) and
+        not is_square_attacked(board, home + 6, not white)):
+        mask |= 1 << (home + 6)
+    # Long castle: the b-file square must be empty but may be attacked
+    if (qs_rights and not occupancy & (0x0e << home) and
+        not is_square_attacked(board, home + 3, not white) and
+        not is_square_attacked(board, home + 2, not white)):
+        mask |= 1 << (home + 2)
+    return mask
+
+def compute_all_valid_moves(board, targets = None):
+    """ Same as rulebook.compute_all_valid_moves, for a BitboardBoard """
+    all_moves = {}
+    enemy = board.black_occupancy if board.whites_turn else board.white_occupancy
+    for square, mask, ep_bit in legal_move_masks(board):
+        origin = ROW_COL[square]
+        moves = []
+        while mask:
+            bit = mask & -mask
+            mask ^= bit
+            row, col = ROW_COL[bit.bit_length() - 1]
+            if bit == ep_bit:
+                m = (row, col, True, True)
+            else:
+                m = (row, col, False, bool(bit & enemy))
+            moves.append(m)
+            if targets is not None:
+                if (row, col) in targets:
+                    targets[(row, col)].append((origin, m))
+                else:
+                    targets[(row, col)] = [(origin, m)]
+        all_moves[origin] = moves
+    return all_moves
+
+def count_legal_moves(board):
+    """ Number of legal moves of the side to move, counted without building them """
+    return sum(bin(mask).count("1") for square, mask, ep_bit in legal_move_masks(board))
+
+class BitboardBoard(chess_board.Board):
+    """
+    A Board that additionally keeps a 64-bit bitboard for each of the twelve
+    piece types plus white, black, and total occupancy masks.  The bitboards
+    are updated incrementally in make_move/unmake_move, and rulebook uses
+    set-wise operations on them in place of square-by-square scans.  It is a
+    drop-in replacement for chess_board.Board.
+    """
+
+    uses_bitboards = True
+
+    def load_fen(self, fen):
+        super().load_fen(fen)
+        self.build_bitboards()
+
+    def build_bitboards(self):
+        self.bitboards = {p: 0 for p in "PNBRQKpnbrqk"}
+        for row in range(8):
+            for col in range(8):
+                piece = self.squares[row][col]
+                if piece != ".":
+                    self.bitboards[piece] |= square_bit(row, col)
+        self.white_occupancy = 0
+        self.black_occupancy = 0
+        for p in "PNBRQK":
+            self.white_occupancy |= self.bitboards[p]
+        for p in "pnbrqk":
+            self.black_occupancy |= self.bitboards[p]
+        self.occupancy = self.white_occupancy | self.black_occupancy
+
+    def toggle_move_bits(self, move, piece, captured):
+        """
+        XOR the bits changed by a packed move into the bitboards, where piece is
+        the (pre-promotion) piece moved and captured is the piece captured or ".".
+        Since XOR is its own inverse, the same call both applies and reverts a move.
+        """
+        # Packed squares are row * 8 + col, the same as bit indexes
+        start = move & 63
+        end = (move >> 6) & 63
+        bb = self.bitboards
+        from_bit = 1 << start
+        to_bit = 1 << end
+        white = piece.isupper()
+
+        bb[piece] ^= from_bit
+        if move & chess_board.MOVE_PROMOTION:
+            bb["Q" if white else "q"] ^= to_bit
+        else:
+            bb[piece] ^= to_bit
+        moved = from_bit | to_bit
+
+        # Castling also moves the rook
+        if move & chess_board.MOVE_CASTLE:
+            if end > start:
+                rook_from, rook_to = from_bit << 3, from_bit << 1
+            else:
+                rook_from, rook_to = from_bit >> 4, from_bit >> 1
+            bb["R" if white else "r"] ^= rook_from | rook_to
+            moved |= rook_from | rook_to
+
+        if white:
+            self.white_occupancy ^= moved
+        else:
+            self.black_occupancy ^= moved
+
+        if captured != ".":
+            # An en passant capture removes the pawn beside the start square
+            captured_bit = 1 << ((start & 56) | (end & 7)) if move & chess_board.MOVE_EN_PASSANT else to_bit
+            bb[captured] ^= captured_bit
+            if white:
+                self.black_occupancy ^= captured_bit
+            else:
+                self.white_occupancy ^= captured_bit
+
+        self.occupancy = self.white_occupancy | self.black_occupancy
+
+    def make_move(self, start_row, start_col, end_row, end_col):
+        piece = self.squares[start_row][start_col]
+        super().make_move(start_row, start_col, end_row, end_col)
+        self.toggle_move_bits(self.move_history[-1], piece, chr(self.captured_history[-1]))
+
+    def unmake_move(self):
+        if self.move_history:
+            move = self.move_history[-1]
+            if move & chess_board.MOVE_PROMOTION:
+                piece = "p" if self.whites_turn else "P"
+            else:
+                piece = self.squares[(move >> 9) & 7][(move >> 6) & 7]
+            self.toggle_move_bits(move, piece, chr(self.captured_history[-1]))
+        super().unmake_move()
+
+# Board backends that can be chosen by name on the command line
+BOARD_TYPES = {"list": chess_board.Board, "bitboard": BitboardBoard}
@@ -1,6 +1,47 @@
 import sys
+from array import array
 import zobrist
 
+# Moves are packed into 16 bits: bits 0-5 hold the start square (row * 8 + col),
+# bits 6-11 hold the end square, and bits 12-15 hold the flags below
+MOVE_CAPTURE = 1 << 12
+MOVE_EN_PASSANT = 1 << 13
+MOVE_CASTLE = 1 << 14
+MOVE_PROMOTION = 1 << 15
+
+def encode_move(start_row, start_col, end_row, end_col, flags = 0):
+    return (start_row * 8 + start_col) | (end_row * 8 + end_col) << 6 | flags
+
+def move_squares(move):
+    """ Returns (start row, start col, end row, end col) of a packed move """
+    start = move & 63
+    end = (move >> 6) & 63
+    return start >> 3, start & 7, end >> 3, end & 7
+
+def move_to_uci(move):
+    """ Long algebraic notation of a packed move, as used by UCI (e.g. "e2e4") """
+    start_row, start_col, end_row, end_col = move_squares(move)
+    uci = "abcdefgh"[start_col] + str(8 - start_row) + "abcdefgh"[end_col] + str(8 - end_row)
+    if move & MOVE_PROMOTION:
+        uci += "q"
+    return uci
+
+def uci_to_squares(uci):
+    """ Returns (start row, start col, end row, end col) of a move in long algebraic notation """
+    return 8 - int(uci[1]), "abcdefgh".index(uci[0]), 8 - int(uci[3]), "abcdefgh".index(uci[2])
+
+# Irreversible state saved with each move for undo purposes is packed into 16 bits:
+# bits 0-6 hold the en passant square (row * 8 + col, or 64 for none),
+# bits 7-10 the castling rights (WKS, WQS, BKS, BQS), and bits 11-12 whether
+# white and black had castled
+NO_EN_PASSANT = 64
+
+# Forsyth-Edwards Notation (FEN) of the starting position
+STARTING_FEN = "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1"
+
+# Material value of each piece type
+PIECE_VALUES = {"P":1, "N":3, "B":3, "R":5, "Q":9, "K":0, "p":1, "n":3, "b":3, "r":5, "q":9, "k":0}
+
 class Board():
     """
     This class contains the entire state of the game board and any past moves.
@@ -8,31 +49,47 @@ class Board():
     passed through "do_move" have already been validated.
     """
 
+    # Set by board backends (see bitboard_board.BitboardBoard) that keep
+    # piece bitboards which rulebook can use in place of square scans
+    uses_bitboards = False
+
     def __init__(self):
 
         # Squares represented as an 8x8 list of characters.
         # Character "." indicates an empty square
         self.squares = [ ["."]*8 for i in range(8)]
 
-        # Moves made up to this point.
-        # List of tuples which contain the following 10 elements:
-        #   0 - Start row
-        #   1 - Start col
-        #   2 - End row
-        #   3 - End col
-        #   4 - Character of piece being moved
-        #   5 - Character of the piece captured or "."
-        #   6 - Boolean of whether this is an en passant capture move
-        #   7 - En passant rights prior to this move being made (for undo purposes)
-        #   8 - Castling state prior to this move being made (white_castled, black_castled) (for undo purposes)
-        #   9 - Castling rights prior to this move being made (WKS, WQS, BKS, WQS) (for undo purposes)
-        #  10 - (row, col) of the promotion square if a promotion occured, (-1,-1) otherwise (for undo purposes)
-        self.move_history = []
+        # Moves made up to this point, packed with encode_move.
+        # Use move_squares, last_move, and uci_moves to read them.
+        self.move_history = array("H")
+
+        # Undo stack entries, one per move in self.move_history:
+        #   captured_history - ord() of the character of the piece captured or "."
+        #   state_history - en passant rights, castling rights, and castling state
+        #                   prior to the move being made (see pack_state)
+        self.captured_history = array("B")
+        self.state_history = array("H")
 
         # Zobrist hash state for all previous moves.  This should correspond
-        # to the self.move_history elements.  This is used to quickly check
-        # for three-fold repetition
-        self.zobrist_history = []
+        # to the self.move_history elements.
+        self.zobrist_history = array("Q")
+
+        # Number of times each position (Zobrist hash) has occurred in the game,
+        # including the initial position.  This is used to check for three-fold
+        # repetition without walking the history.
+        self.position_counts = {}
+
+        # Halfmoves since the last capture or pawn move, for the fifty-move rule.
+        # The clock prior to each move is saved in halfmove_history for undo purposes.
+        self.halfmove_clock = 0
+        self.halfmove_history = array("H")
+
+        # Move number as counted in FEN, starting at 1 and incremented after black moves
+        self.fullmove_number = 1
+
+        # Piece placement field of the FEN of the current position, built on
+        # request and cleared by each move (see fen_placement)
+        self.cached_placement = None
 
         # Is it white's turn?
         self.whites_turn = True
@@ -53,6 +110,24 @@ class Board():
         # Set to (-1, -1) if an en passant capture is not available
         self.en_passant_rights = (-1, -1)
 
+        # Squares occupied by each piece type, keyed by piece character.
+        # These are kept in step with self.squares so that consumers can
+        # visit only occupied squares instead of scanning all 64.
+        self.piece_squares = {p: set() for p in "PNBRQKpnbrqk"}
+
+        # (row, col) of each king
+        self.white_king_square = (-1, -1)
+        self.black_king_square = (-1, -1)
+
+        # Number of each piece type on the board and captured so far, keyed by
+        # piece character, and the total material value (see PIECE_VALUES) of
+        # each side.  These are updated with each move so they can be read
+        # without scanning the board or the move history.
+        self.piece_counts = {p: 0 for p in "PNBRQKpnbrqk"}
+        self.captured_counts = {p: 0 for p in "PNBRQKpnbrqk"}
+        self.white_material = 0
+        self.black_material = 0
+
         # Zobrist has of the current state
         self.zobrist_hasher = zobrist.ZobristHasher()
         self.zobrist_hash = 0
@@ -95,9 +170,10 @@ class Board():
             board_str += "Black QS  "
         board_str += "\n"
         board_str += "En passant rights: " + str(self.en_passant_rights) + "\n"
+        board_str += "FEN: " + self.to_fen() + "\n"
         board_str += "Zobrist hash: " + str(self.zobrist_hash) + "\n"
-        board_str += "Move history: " + str(self.move_history) + "\n"
-        board_str += "Zobrist history: " + str(self.zobrist_history) + "\n"
+        board_str += "Move history: " + " ".join(self.uci_moves()) + "\n"
+        board_str += "Zobrist history: " + str(list(self.zobrist_history)) + "\n"
         return board_str
 
     def fatal_error(self, string):
@@ -112,25 +188,182 @@ class Board():
         Reset the board to its initial state
         """
 
-        self.squares[0] = list("rnbqkbnr")
-        self.squares[1] = list("pppppppp")
-        self.squares[2] = list("........")
-        self.squares[3] = list("........")
-        self.squares[4] = list("........")
-        self.squares[5] = list("........")
-        self.squares[6] = list("PPPPPPPP")
-        self.squares[7] = list("RNBQKBNR")
-        self.move_history.clear()
-        self.zobrist_history.clear()
-        self.whites_turn = True
-        self.white_ks_castling_rights = True
-        self.white_qs_castling_rights = True
+        self.load_fen(STARTING_FEN)
+
+    @classmethod
+    def from_fen(cls, fen):
+        """
+        Returns a new board set up from a FEN string
+        """
+
+        board = cls()
+        board.load_fen(fen)
+        return board
+
+    def load_fen(self, fen):
+        """
+        Set up the board from a FEN string, clearing any move history.
+        Whether either side has castled is not part of FEN, so it is taken as not.
+        """
+
+        fields = fen.split()
+        if len(fields) < 4:
+            raise ValueError("Invalid FEN (too few fields): " + fen)
+        placement, side, castling, en_passant = fields[0:4]
+        rows = placement.split("/")
+        if len(rows) != 8:
+            raise ValueError("Invalid FEN (not 8 rows): " + fen)
+        for row, text in enumerate(rows):
+            squares = []
+            for c in text:
+                if c.isdigit():
+                    squares.extend(["."] * int(c))
+                elif c in "PNBRQKpnbrqk":
+                    squares.append(c)
+                else:
+                    raise ValueError("Invalid FEN (unknown piece " + c + "): " + fen)
+            if len(squares) != 8:
+                raise ValueError("Invalid FEN (row " + text + " is not 8 squares): " + fen)
+            self.squares[row] = squares
+        if side not in ("w", "b"):
+            raise ValueError("Invalid FEN (side to move " + side + "): " + fen)
+
+        del self.move_history[:]
+        del self.captured_history[:]
+        del self.state_history[:]
+        del self.zobrist_history[:]
+        del self.halfmove_history[:]
+        self.whites_turn = side == "w"
+        self.white_ks_castling_rights = "K" in castling
+        self.white_qs_castling_rights = "Q" in castling
         self.white_castled = False
-        self.black_ks_castling_rights = True
-        self.black_qs_castling_rights = True
+        self.black_ks_castling_rights = "k" in castling
+        self.black_qs_castling_rights = "q" in castling
         self.black_castled = False
+
+        # Like make_move, only keep en passant rights when a pawn can use them
         self.en_passant_rights = (-1, -1)
+        if en_passant != "-":
+            ep_row = 8 - int(en_passant[1])
+            ep_col = "abcdefgh".index(en_passant[0])
+            pawn_row, pawn = (3, "P") if self.whites_turn else (4, "p")
+            if (ep_row == (2 if self.whites_turn else 5) and
+                (ep_col > 0 and self.squares[pawn_row][ep_col-1] == pawn or
+                 ep_col < 7 and self.squares[pawn_row][ep_col+1] == pawn)):
+                self.en_passant_rights = (ep_row, ep_col)
+
+        self.halfmove_clock = int(fields[4]) if len(fields) > 4 else 0
+        self.fullmove_number = int(fields[5]) if len(fields) > 5 else 1
+        self.cached_placement = None
+        self.build_piece_squares()
+        for p in self.captured_counts:
+            self.captured_counts[p] = 0
         self.zobrist_hash = self.zobrist_hasher.full_hash(self)
+        self.position_counts = {self.zobrist_hash: 1}
+
+    def fen_placement(self):
+        """
+        Returns the piece placement field of the FEN of the current position.
+        This is built at most once per position.
+        """
+
+        if self.cached_placement is None:
+            rows = []
+            for row in self.squares:
+                text = ""
+                empty = 0
+                for piece in row:
+                    if piece == ".":
+                        empty += 1
+                    else:
+                        if empty:
+                            text += str(empty)
+                            empty = 0
+                        text += piece
+                if empty:
+                    text += str(empty)
+                rows.append(text)
+            self.cached_placement = "/".join(rows)
+        return self.cached_placement
+
+    def to_fen(self):
+        """
+        Returns the FEN string of the current position.  An en passant square is
+        only given when a pawn can capture onto it.
+        """
+
+        castling = ""
+        if self.white_ks_castling_rights:
+            castling += "K"
+        if self.white_qs_castling_rights:
+            castling += "Q"
+        if self.black_ks_castling_rights:
+            castling += "k"
+        if self.black_qs_castling_rights:
+            castling += "q"
+        ep_row, ep_col = self.en_passant_rights
+        en_passant = "-" if ep_row == -1 else "abcdefgh"[ep_col] + str(8 - ep_row)
+        return " ".join([self.fen_placement(), "w" if self.whites_turn else "b", castling or "-",
+                         en_passant, str(self.halfmove_clock), str(self.fullmove_number)])
+
+    def build_piece_squares(self):
+        """
+        Rebuild the piece square sets, king squares, piece counts, and
+        material totals from self.squares
+        """
+
+        for squares in self.piece_squares.values():
+            squares.clear()
+        for row in range(8):
+            for col in range(8):
+                piece = self.squares[row][col]
+                if piece != ".":
+                    self.piece_squares[piece].add((row, col))
+        self.white_king_square = next(iter(self.piece_squares["K"]), (-1, -1))
+        self.black_king_square = next(iter(self.piece_squares["k"]), (-1, -1))
+        for p, squares in self.piece_squares.items():
+            self.piece_counts[p] = len(squares)
+        self.white_material = sum(PIECE_VALUES[p] * self.piece_counts[p] for p in "PNBRQ")
+        self.black_material = sum(PIECE_VALUES[p] * self.piece_counts[p] for p in "pnbrq")
+
+    def last_move(self):
+        """
+        Returns (start row, start col, end row, end col) of the last move, or None
+        """
+
+        if not self.move_history:
+            return None
+        return move_squares(self.move_history[-1])
+
+    def uci_moves(self):
+        """
+        Returns the moves made so far in long algebraic notation
+        """
+
+        return [move_to_uci(m) for m in self.move_history]
+
+    def pack_state(self):
+        ep_row, ep_col = self.en_passant_rights
+        return ((NO_EN_PASSANT if ep_row == -1 else ep_row * 8 + ep_col) |
+                self.white_ks_castling_rights << 7 | self.white_qs_castling_rights << 8 |
+                self.black_ks_castling_rights << 9 | self.black_qs_castling_rights << 10 |
+                self.white_castled << 11 | self.black_castled << 12)
+
+    def king_square(self, white):
+        return self.white_king_square if white else self.black_king_square
+
+    def occupied_squares(self, white):
+        """
+        Generator of the (row, col) of every white (or black) piece
+        """
+
+        for piece in ("KQRBNP" if white else "kqrbnp"):
+            yield from self.piece_squares[piece]
+
+    def move_piece_square(self, piece, from_square, to_square):
+        squares = self.piece_squares[piece]
+        squares.remove(from_square)
+        squares.add(to_square)
 
     def make_move(self, start_row, start_col, end_row, end_col):
         """
@@ -154,19 +387,32 @@ class Board():
         else:
             captured = self.squares[end_row][end_col]
 
-        # Promotion tuple for accounting
-        if (self.whites_turn and end_row == 0 and self.squares[start_row][start_col] == "P" or
-            not self.whites_turn and end_row == 7 and self.squares[start_row][start_col] == "p"):
-            promotion = (end_row, end_col)
-        else:
-            promotion = (-1, -1)
+        # Flags for accounting
+        flags = 0
+        if captured != ".":
+            flags |= MOVE_CAPTURE
+        if is_en_passant:
+            flags |= MOVE_EN_PASSANT
+        if piece in "Kk" and start_col == 4 and abs(end_col - start_col) == 2:
+            flags |= MOVE_CASTLE
+        if (self.whites_turn and end_row == 0 and piece == "P" or
+            not self.whites_turn and end_row == 7 and piece == "p"):
+            flags |= MOVE_PROMOTION
 
         # We now have all the information we need to log the move before updating state
-        self.move_history.append((start_row, start_col, end_row, end_col,
-                                  piece, captured, is_en_passant, self.en_passant_rights,
-                                  (self.white_castled, self.black_castled),
-                                  (self.white_ks_castling_rights, self.white_qs_castling_rights, self.black_ks_castling_rights, self.black_qs_castling_rights),
-                                   promotion ))
+        self.move_history.append(encode_move(start_row, start_col, end_row, end_col, flags))
+        self.captured_history.append(ord(captured))
+        self.state_history.append(self.pack_state())
+        self.halfmove_history.append(self.halfmove_clock)
+        self.cached_placement = None
+        if not self.whites_turn:
+            self.fullmove_number += 1
+
+        # Captures and pawn moves are irreversible and restart the fifty-move count
+        if captured != "." or piece in "Pp":
+            self.halfmove_clock = 0
+        else:
+            self.halfmove_clock += 1
 
         # If we're a pawn moving two space, check if we have to give the
         # other player en passant rights for next turn
@@ -204,6 +450,20 @@ class Board():
         # Move source to dest
         self.squares[end_row][end_col] = self.squares[start_row][start_col]
         self.squares[start_row][start_col] = "."
+        if captured != "." and not is_en_passant:
+            self.piece_squares[captured].remove((end_row, end_col))
+        self.move_piece_square(piece, (start_row, start_col), (end_row, end_col))
+        if captured != ".":
+            self.piece_counts[captured] -= 1
+            self.captured_counts[captured] += 1
+            if self.whites_turn:
+                self.black_material -= PIECE_VALUES[captured]
+            else:
+                self.white_material -= PIECE_VALUES[captured]
+        if piece == "K":
+            self.white_king_square = (end_row, end_col)
+        elif piece == "k":
+            self.black_king_square = (end_row, end_col)
 
         # Hash - revert the captured square back to "." if need be
         if captured != "." and not is_en_passant:
@@ -216,10 +476,12 @@ class Board():
         # If en passant, remove captured pawn
         if is_en_passant and self.whites_turn:
             self.squares[end_row+1][end_col] = "."
+            self.piece_squares[captured].remove((end_row+1, end_col))
             # Hash - revert the captured pawn square back to "."
             self.zobrist_hash ^= self.zobrist_hasher.hash_piece[(end_row+1)*8+end_col][self.zobrist_hasher.piece_index[captured]]
         elif is_en_passant and not self.whites_turn:
             self.squares[end_row-1][end_col] = "."
+            self.piece_squares[captured].remove((end_row-1, end_col))
             # Hash - revert the captured pawn square back to "."
             self.zobrist_hash ^= self.zobrist_hasher.hash_piece[(end_row-1)*8+end_col][self.zobrist_hasher.piece_index[captured]]
 
@@ -227,12 +489,22 @@ class Board():
         # TODO: Allow promotions to pieces other than queen
         if self.whites_turn and end_row == 0 and self.squares[end_row][end_col] == "P":
             self.squares[end_row][end_col] = "Q"
+            self.piece_squares["P"].remove((end_row, end_col))
+            self.piece_squares["Q"].add((end_row, end_col))
+            self.piece_counts["P"] -= 1
+            self.piece_counts["Q"] += 1
+            self.white_material += PIECE_VALUES["Q"] - PIECE_VALUES["P"]
             # Hash - remove pawn from promotion square
             self.zobrist_hash ^= self.zobrist_hasher.hash_piece[end_row*8+end_col][self.zobrist_hasher.piece_index["P"]]
             # Hash - apply queen to promotion square
             self.zobrist_hash ^= self.zobrist_hasher.hash_piece[end_row*8+end_col][self.zobrist_hasher.piece_index["Q"]]
         elif not self.whites_turn and end_row == 7 and self.squares[end_row][end_col] == "p":
             self.squares[end_row][end_col] = "q"
+            self.piece_squares["p"].remove((end_row, end_col))
+            self.piece_squares["q"].add((end_row, end_col))
+            self.piece_counts["p"] -= 1
+            self.piece_counts["q"] += 1
+            self.black_material += PIECE_VALUES["q"] - PIECE_VALUES["p"]
             # Hash - remove pawn from promotion square
             self.zobrist_hash ^= self.zobrist_hasher.hash_piece[end_row*8+end_col][self.zobrist_hasher.piece_index["p"]]
             # Hash - apply queen to promotion square
@@ -243,6 +515,7 @@ class Board():
             # White KS castling
             self.squares[7][5] = self.squares[7][7]
             self.squares[7][7] = "."
+            self.move_piece_square("R", (7, 7), (7, 5))
             # Hash - apply rook to new square (7*8+5 = 61)
             self.zobrist_hash ^= self.zobrist_hasher.hash_piece[61][self.zobrist_hasher.piece_index["R"]]
             # Hash - revert old rook square to "." (7*8+7 = 63)
@@ -252,6 +525,7 @@ class Board():
             # White QS castling
             self.squares[7][3] = self.squares[7][0]
             self.squares[7][0] = "."
+            self.move_piece_square("R", (7, 0), (7, 3))
             # Hash - apply rook to new square (7*8+3 = 59)
             self.zobrist_hash ^= self.zobrist_hasher.hash_piece[59][self.zobrist_hasher.piece_index["R"]]
             # Hash - revert old rook square to "." (7*8+0 = 56)
@@ -261,6 +535,7 @@ class Board():
             # Black KS castling
             self.squares[0][5] = self.squares[0][7]
             self.squares[0][7] = "."
+            self.move_piece_square("r", (0, 7), (0, 5))
             # Hash - apply rook to new square (0*8+5 = 5)
             self.zobrist_hash ^= self.zobrist_hasher.hash_piece[5][self.zobrist_hasher.piece_index["r"]]
             # Hash - revert old rook square to "." (0*8+7 = 7)
@@ -270,6 +545,7 @@ class Board():
             # Black QS castling
             self.squares[0][3] = self.squares[0][0]
             self.squares[0][0] = "."
+            self.move_piece_square("r", (0, 0), (0, 3))
             # Hash - apply rook to new square (0*8+3 = 3)
             self.zobrist_hash ^= self.zobrist_hasher.hash_piece[3][self.zobrist_hasher.piece_index["r"]]
             # Hash - revert old rook square to "." (0*8+0 = 0)
@@ -333,6 +609,7 @@ class Board():
 
         # Store zobrist hash in history
         self.zobrist_history.append(self.zobrist_hash)
+        self.position_counts[self.zobrist_hash] = self.position_counts.get(self.zobrist_hash, 0) + 1
 
     def unmake_move(self):
         """
@@ -342,31 +619,42 @@ class Board():
 
         # Remove the last move from the Zobrist history
         self.zobrist_history.pop()
+        count = self.position_counts[self.zobrist_hash]
+        if count == 1:
+            del self.position_counts[self.zobrist_hash]
+        else:
+            self.position_counts[self.zobrist_hash] = count - 1
 
         # Get the last move from the history
         if not self.move_history:
             self.fatal_error("Trying to undo an empty move history")
-        last_move = self.move_history.pop()
+        move = self.move_history.pop()
+        capture = chr(self.captured_history.pop())
+        state = self.state_history.pop()
+        self.halfmove_clock = self.halfmove_history.pop()
+        self.cached_placement = None
 
         # It was the previous players turn when this move was made
         self.whites_turn = not self.whites_turn
+        if not self.whites_turn:
+            self.fullmove_number -= 1
         # Hash - change turn
         self.zobrist_hash ^= self.zobrist_hasher.hash_blacks_turn
 
         # Restore saved state
-        start_row = last_move[0]
-        start_col = last_move[1]
-        end_row = last_move[2]
-        end_col = last_move[3]
-        piece = last_move[4]
-        capture = last_move[5]
-        is_en_passant = last_move[6]
-        self.white_castled = last_move[8][0]
-        self.black_castled = last_move[8][1]
-        promotion = last_move[10]
+        start_row, start_col, end_row, end_col = move_squares(move)
+        is_en_passant = move & MOVE_EN_PASSANT
+        promotion = move & MOVE_PROMOTION
+        if promotion:
+            piece = "P" if self.whites_turn else "p"
+        else:
+            piece = self.squares[end_row][end_col]
+        self.white_castled = bool(state & (1 << 11))
+        self.black_castled = bool(state & (1 << 12))
 
         # Restore en passant rights if they changed
-        epr = last_move[7]
+        ep_square = state & 127
+        epr = (-1, -1) if ep_square == NO_EN_PASSANT else divmod(ep_square, 8)
         if epr != self.en_passant_rights:
             # Hash - undo old en passant rights, if needed
             if self.en_passant_rights[1] != -1:
@@ -377,22 +665,22 @@ class Board():
             self.en_passant_rights = epr
 
         # Restore castling rights if they changed
-        wks = last_move[9][0]
+        wks = bool(state & (1 << 7))
         if wks != self.white_ks_castling_rights:
             self.white_ks_castling_rights = wks
             # Hash - toggle rights
             self.zobrist_hash ^= self.zobrist_hasher.hash_white_ks_castling_rights
-        wqs = last_move[9][1]
+        wqs = bool(state & (1 << 8))
         if wqs != self.white_qs_castling_rights:
             self.white_qs_castling_rights = wqs
             # Hash - toggle rights
             self.zobrist_hash ^= self.zobrist_hasher.hash_white_qs_castling_rights
-        bks = last_move[9][2]
+        bks = bool(state & (1 << 9))
         if bks != self.black_ks_castling_rights:
             self.black_ks_castling_rights = bks
             # Hash - toggle rights
             self.zobrist_hash ^= self.zobrist_hasher.hash_black_ks_castling_rights
-        bqs = last_move[9][3]
+        bqs = bool(state & (1 << 10))
         if bqs != self.black_qs_castling_rights:
             self.black_qs_castling_rights = bqs
             # Hash - toggle rights
@@ -403,6 +691,7 @@ class Board():
             # White KS castling
             self.squares[7][5] = "."
             self.squares[7][7] = "R"
+            self.move_piece_square("R", (7, 5), (7, 7))
             # Hash - apply rook to new square (7*8+5 = 61)
             self.zobrist_hash ^= self.zobrist_hasher.hash_piece[61][self.zobrist_hasher.piece_index["R"]]
             # Hash - revert old rook square to "." (7*8+7 = 63)
@@ -411,6 +700,7 @@ class Board():
             # White QS castling
             self.squares[7][3] = "."
             self.squares[7][0] = "R"
+            self.move_piece_square("R", (7, 3), (7, 0))
             # Hash - apply rook to new square (7*8+3 = 59)
             self.zobrist_hash ^= self.zobrist_hasher.hash_piece[59][self.zobrist_hasher.piece_index["R"]]
             # Hash - revert old rook square to "." (7*8+0 = 56)
@@ -419,6 +709,7 @@ class Board():
             # Black KS castling
             self.squares[0][5] = "."
             self.squares[0][7] = "r"
+            self.move_piece_square("r", (0, 5), (0, 7))
             # Hash - apply rook to new square (0*8+5 = 5)
             self.zobrist_hash ^= self.zobrist_hasher.hash_piece[5][self.zobrist_hasher.piece_index["r"]]
             # Hash - revert old rook square to "." (0*8+7 = 7)
@@ -427,27 +718,36 @@ class Board():
             # Black QS castling
             self.squares[0][3] = "."
             self.squares[0][0] = "r"
+            self.move_piece_square("r", (0, 3), (0, 0))
             # Hash - apply rook to new square (0*8+3 = 3)
             self.zobrist_hash ^= self.zobrist_hasher.hash_piece[3][self.zobrist_hasher.piece_index["r"]]
             # Hash - revert old rook square to "." (0*8+0 = 0)
             self.zobrist_hash ^= self.zobrist_hasher.hash_piece[0][self.zobrist_hasher.piece_index["r"]]
 
         # Undo any promotion (change it to a pawn)
-        if promotion != (-1, -1):
-            if promotion[0] != end_row or promotion[1] != end_col:
-                self.fatal_error("Promotion move invalid during move unmake")
+        if promotion:
             if self.whites_turn:
-                if promotion[0] != 0:
+                if end_row != 0:
                     self.fatal_error("Cannot undo white promotion move")
-                self.squares[0][promotion[1]] = "P"
+                self.squares[0][end_col] = "P"
+                self.piece_squares["Q"].remove((end_row, end_col))
+                self.piece_squares["P"].add((end_row, end_col))
+                self.piece_counts["Q"] -= 1
+                self.piece_counts["P"] += 1
+                self.white_material -= PIECE_VALUES["Q"] - PIECE_VALUES["P"]
                 # Hash - remove queen from promotion square
                 self.zobrist_hash ^= self.zobrist_hasher.hash_piece[end_row*8+end_col][self.zobrist_hasher.piece_index["Q"]]
                 # Hash - apply pawn to promotion square
                 self.zobrist_hash ^= self.zobrist_hasher.hash_piece[end_row*8+end_col][self.zobrist_hasher.piece_index["P"]]
             else:
-                if promotion[0] != 7:
+                if end_row != 7:
                     self.fatal_error("Cannot undo black promotion move")
-                self.squares[7][promotion[1]] = "p"      
+                self.squares[7][end_col] = "p"
+                self.piece_squares["q"].remove((end_row, end_col))
+                self.piece_squares["p"].add((end_row, end_col))
+                self.piece_counts["q"] -= 1
+                self.piece_counts["p"] += 1
+                self.black_material -= PIECE_VALUES["q"] - PIECE_VALUES["p"]
                 # Hash - remove queen from promotion square
                 self.zobrist_hash ^= self.zobrist_hasher.hash_piece[end_row*8+end_col][self.zobrist_hasher.piece_index["q"]]
                 # Hash - apply pawn to promotion square
@@ -456,15 +756,22 @@ class Board():
         # If en passant, put the captured pawn back
         if is_en_passant and self.whites_turn:
             self.squares[end_row+1][end_col] = "p"
+            self.piece_squares["p"].add((end_row+1, end_col))
             # Hash - put the captured pawn back
             self.zobrist_hash ^= self.zobrist_hasher.hash_piece[(end_row+1)*8+end_col][self.zobrist_hasher.piece_index["p"]]
         elif is_en_passant and not self.whites_turn:
             self.squares[end_row-1][end_col] = "P"
+            self.piece_squares["P"].add((end_row-1, end_col))
             # Hash - put the captured pawn back
             self.zobrist_hash ^= self.zobrist_hasher.hash_piece[(end_row-1)*8+end_col][self.zobrist_hasher.piece_index["P"]]
 
         # Put the source back
         self.squares[start_row][start_col] = self.squares[end_row][end_col]
+        self.move_piece_square(piece, (end_row, end_col), (start_row, start_col))
+        if piece == "K":
+            self.white_king_square = (start_row, start_col)
+        elif piece == "k":
+            self.black_king_square = (start_row, start_col)
         # Hash - put the source back
         self.zobrist_hash ^= self.zobrist_hasher.hash_piece[start_row*8+start_col][self.zobrist_hasher.piece_index[piece]]
 
@@ -473,7 +780,15 @@ class Board():
         self.squares[end_row][end_col] = "."
 
         # Put back the capture if necessary
+        if capture != ".":
+            self.piece_counts[capture] += 1
+            self.captured_counts[capture] -= 1
+            if self.whites_turn:
+                self.black_material += PIECE_VALUES[capture]
+            else:
+                self.white_material += PIECE_VALUES[capture]
         if capture != "." and not is_en_passant:
             self.squares[end_row][end_col] = capture
+            self.piece_squares[capture].add((end_row, end_col))
             # Hash - add the captured piece back to the dest
             self.zobrist_hash ^= self.zobrist_hasher.hash_piece[end_row*8+end_col][self.zobrist_hasher.piece_index[capture]]
@@ -1,9 +1,12 @@
 import tkinter as tk
 from PIL import Image,ImageTk
+import chess_board
 import rulebook as rules
-import threading
-import subprocess
+import move_cache
+import polyglot_book
+import san_cache
 import time
+import uci_engine
 from player_type import PlayerType 
 
 class ChessGUI(tk.Canvas):
@@ -24,7 +27,7 @@ class ChessGUI(tk.Canvas):
 
         # Players
         self.player_type = [PlayerType.HUMAN, PlayerType.HUMAN]
-        self.external_engine_process = [None, None]
+        self.engines = [None, None] # uci_engine.UCIEngine of each external engine player
 
         # Time controls
         self.time_remaining_ms = [0, 0]
@@ -32,16 +35,56 @@ class ChessGUI(tk.Canvas):
         self.start_time_of_current_move = 0
         self.remaining_time_at_start_of_move = 0
 
-        # Variables and locks for thread communication
-        self.engine_thread_lock = threading.Lock()
-        self.computer_move_finished = False
-        self.kill_thread = False
+        # Engines are driven by an asyncio event loop in a background thread, which
+        # hands their results to this thread on engine_loop.results, waking it
+        # with a <<EngineResult>> event
+        self.engine_loop = uci_engine.EngineLoop()
+
+        # Milliseconds from each bestmove being read to its move being on the board,
+        # which are printed along with the engine traffic if engine_verbose is set
+        self.engine_move_latencies = []
+
+        # Each search is numbered, so that the results of abandoned searches are ignored.
+        # search_id is the number of the search whose results are awaited.
+        self.search_count = 0
+        self.search_id = 0
+        self.search_start = 0 # time.perf_counter() when the current search started
+
+        # If ponder is True, engines that support it search on the opponent's time,
+        # assuming the opponent will play the reply they expect.  pondering holds the
+        # (search id, expected move) of each color's ponder search.
+        self.ponder = False
+        self.pondering = [None, None]
+
+        # Info lines of the current search are parsed on the engine loop's thread and
+        # coalesced in info_buffer, which is drawn info_frames_per_second times a second
+        self.info_buffer = uci_engine.InfoBuffer()
+        self.info_frames_per_second = 20
+        self.info_timer = None
+        self.searching = False
+        self.search_info = {} # Latest fields of the current search (see uci_engine.parse_info)
+
+        # Whether to print every line sent to and from the engines
+        self.engine_verbose = False
+
+        # In analysis mode, a loaded engine that is not to move analyses the position
+        # whenever a human is to move (or the game is over), showing analysis_lines
+        # variations.  Their moves are converted to SAN through san_cache.
+        self.analysis_lines = 0
+        self.analysis_engine = None
+        self.analyzing = False
+        self.analysis_rows = {} # multipv number -> values last shown in its table row
 
         # Hash size in MB for external engines (-1 means default)
         self.engine_hash_size = -1
 
-        # Contains (best_move, value, moves analyzed, max depth, time took, pv line)
-        self.selected_computer_move = None
+        # Polyglot opening book played from by engines, if one is loaded.  Book moves
+        # are played without searching until the game leaves the book or book_max_ply
+        # moves have been played.
+        self.polyglot_book = None
+        self.book_max_ply = 20
+        self.book_weighted = True
+        self.in_polyglot_book = True
 
         # Parameters related to board layout
         self.canvas_height = 600
@@ -68,6 +111,9 @@ class ChessGUI(tk.Canvas):
         self.sprites = {}
         self.selected_square = (-1, -1)  # (row,col) tuple when active
         self.all_valid_moves = {} # key is (row, col), value is list of valid moves for the current player
+        self.valid_move_targets = {} # key is target (row, col), value is list of (origin (row, col), move) for the current player
+        self.move_cache = move_cache.MoveCache() # legal moves of positions already seen, shared by all_valid_moves
+        self.san_cache = san_cache.SANCache(moves = self.move_cache) # SAN of engine variations
         self.game_active = False
         self.show_valid_moves = True
         self.highlight_last_move = True
@@ -108,13 +154,27 @@ class ChessGUI(tk.Canvas):
         # Render board
         self.render_board_update()
 
+        # Collect engine results as soon as they arrive.  The event is queued with
+        # when = "tail" since it is generated from the engine loop's thread.
+        self.bind("<<EngineResult>>", self.process_engine_results)
+        self.engine_loop.notify = self.notify_engine_results
+
+    def notify_engine_results(self):
+        """ Called from the engine loop's thread when results arrive """
+        try:
+            self.event_generate("<<EngineResult>>", when = "tail")
+        except tk.TclError:
+            # The window has already been destroyed
+            pass
+
     def shutdown(self):
         self.game_active = False
-        self.kill_thread = True
-        for color in [0, 1]:
-            if self.player_type[color] == PlayerType.EXTERNAL_ENGINE:
-                self.external_engine_process[color].stdin.write("quit\n")
-                self.external_engine_process[color].kill()
+        # event_generate from the engine loop's thread waits for this thread, so stop
+        # notifying and let through any call already waiting before blocking in close
+        self.engine_loop.notify = None
+        self.unbind("<<EngineResult>>")
+        self.update()
+        self.engine_loop.close(self.engines)
         self.top.destroy()
 
     def load_external_engine(self, color, filename):
@@ -128,26 +188,34 @@ class ChessGUI(tk.Canvas):
             self.display.black_player_name = filename.split("/")[-1]
         if self.display:
             self.display.update_player_text()
-        if self.external_engine_process[color] is not None:
-            self.external_engine_process[color].kill()
-        self.external_engine_process[color] = subprocess.Popen(filename,stdout=subprocess.PIPE, stdin=subprocess.PIPE, universal_newlines=True, bufsize=1)
-        output = self.external_engine_process[color].stdout.readline().strip()
-        print("From external engine:", output)
-        print("To external engine:", "uci")
-        self.external_engine_process[color].stdin.write("uci\n")
-        output = ""
-        while (output != "uciok"):
-            output = self.external_engine_process[color].stdout.readline().strip()
-            print("From external engine:", output)
-        self.update_engine_hash()
-        print("To external engine:", "ucinewgame")
-        self.external_engine_process[color].stdin.write("ucinewgame\n")
-        print("To external engine:", "isready")
-        self.external_engine_process[color].stdin.write("isready\n")
-        output = self.external_engine_process[color].stdout.readline().strip()
-        print("From external engine:", output)
+        if self.engines[color] is not None:
+            self.engine_loop.submit(self.engines[color].quit())
+        # The engine starts in the background; if it fails, the player goes back to human
+        engine = uci_engine.UCIEngine([filename], self.engine_verbose)
+        self.engines[color] = engine
+        self.engine_loop.submit(self.start_engine(engine), ("started", color, engine))
         return True
 
+    async def start_engine(self, engine):
+        async with engine.lock:
+            await engine.start()
+            await engine.handshake()
+            if self.engine_hash_size > 0:
+                await engine.set_option("Hash", self.engine_hash_size)
+            if self.ponder and "Ponder" in engine.options:
+                await engine.set_option("Ponder", "true")
+            await engine.new_game()
+
+    async def engine_new_game(self, engine):
+        # Stop any search of the last game first, which would otherwise hold the lock
+        await engine.stop()
+        async with engine.lock:
+            await engine.new_game()
+
+    async def engine_set_option(self, engine, name, value):
+        async with engine.lock:
+            await engine.set_option(name, value)
+
     def square_color(self, row, col):
         return self.light_square_color if (row + col) % 2 == 0 else self.dark_square_color
     
@@ -213,8 +281,8 @@ class ChessGUI(tk.Canvas):
 
         # Draw last move highlights
         if self.highlight_last_move:
-            if self.board.move_history:
-                last_move = self.board.move_history[-1]
+            last_move = self.board.last_move()
+            if last_move:
                 self.itemconfig(self.square_rects[last_move[0]][last_move[1]], fill=self.square_highlighted_color(last_move[0], last_move[1]))
                 self.itemconfig(self.square_rects[last_move[2]][last_move[3]], fill=self.square_highlighted_color(last_move[2], last_move[3]))
 
@@ -226,8 +294,10 @@ class ChessGUI(tk.Canvas):
         # Delete any state from old game
         if self.selected_square[0] != -1:
             self.selected_square = (-1, -1)
-        self.all_valid_moves.clear()
+        self.all_valid_moves = {}
+        self.valid_move_targets = {}
         self.san_moves.clear()
+        self.in_polyglot_book = True
 
         # Reset time
         if self.display:
@@ -235,7 +305,7 @@ class ChessGUI(tk.Canvas):
 
         # Pre-compute all valid moves for the new player so
         # that we can rapidly look them up in throughout this turn
-        self.all_valid_moves = rules.compute_all_valid_moves(self.board)
+        self.all_valid_moves, self.valid_move_targets = self.move_cache.compute_valid_moves_and_targets(self.board)
 
         # Activate game
         self.game_active = True
@@ -248,14 +318,12 @@ class ChessGUI(tk.Canvas):
             self.display.notify_move(None, None)
 
         # If external engine, tell it we're starting a new game
+        self.search_id = self.new_search_id()
+        self.searching = False
+        self.stop_pondering()
         for color in [0, 1]:
-            if self.player_type[color] == PlayerType.EXTERNAL_ENGINE:
-                print("To external engine:", "ucinewgame")
-                self.external_engine_process[color].stdin.write("ucinewgame\n")
-                print("To external engine:", "isready")
-                self.external_engine_process[color].stdin.write("isready\n")
-                output = self.external_engine_process[color].stdout.readline().strip()
-                print("From external engine:", output)
+            if self.player_type[color] == PlayerType.EXTERNAL_ENGINE and self.engines[color]:
+                self.engine_loop.submit(self.engine_new_game(self.engines[color]))
 
         # Start time
         color = 0 if self.board.whites_turn else 1
@@ -266,6 +334,8 @@ class ChessGUI(tk.Canvas):
         if self.game_active:
             if self.board.whites_turn and self.player_type[0] != PlayerType.HUMAN:
                 self.prepare_computer_move()
+            else:
+                self.update_analysis()
 
         # Reset eval bar
         if self.eval_bar:
@@ -274,19 +344,21 @@ class ChessGUI(tk.Canvas):
     def end_game(self):
 
         # If external engine, tell it to stop
+        self.search_id = self.new_search_id()
+        self.searching = False
+        self.stop_pondering()
         for color in [0, 1]:
-            if self.player_type[color] == PlayerType.EXTERNAL_ENGINE:
-                print("To external engine:", "stop")
-                self.external_engine_process[color].stdin.write("stop\n")
+            if self.player_type[color] == PlayerType.EXTERNAL_ENGINE and self.engines[color]:
+                self.engine_loop.submit(self.engines[color].stop())
 
         self.game_active = False
+        self.update_analysis()
 
     def update_engine_hash(self):
         if self.engine_hash_size > 0:
             for i in range(2):
-                if self.player_type[i] == PlayerType.EXTERNAL_ENGINE and self.external_engine_process[i]:
-                    print("To external engine:", "setoption name Hash value", self.engine_hash_size)
-                    self.external_engine_process[i].stdin.write("setoption name Hash value " + str(self.engine_hash_size) + "\n")
+                if self.player_type[i] == PlayerType.EXTERNAL_ENGINE and self.engines[i]:
+                    self.engine_loop.submit(self.engine_set_option(self.engines[i], "Hash", self.engine_hash_size))
 
     def do_move(self, start_row, start_col, end_row, end_col):
 
@@ -294,7 +366,7 @@ class ChessGUI(tk.Canvas):
         piece = self.board.squares[start_row][start_col]
 
         # Create SAN for move
-        san_str = rules.algebraic_notation(start_row, start_col, end_row, end_col, self.all_valid_moves, self.board)
+        san_str = rules.algebraic_notation(start_row, start_col, end_row, end_col, self.all_valid_moves, self.board, self.valid_move_targets)
         print("Move is", san_str)
 
         # Update time remaining for player who just made this move
@@ -315,7 +387,7 @@ class ChessGUI(tk.Canvas):
 
         # Pre-compute all valid moves for the new player so
         # that we can rapidly look them up in throughout this turn
-        self.all_valid_moves = rules.compute_all_valid_moves(self.board)
+        self.all_valid_moves, self.valid_move_targets = self.move_cache.compute_valid_moves_and_targets(self.board)
 
         # For SAN, check for check, checkmate, stalemate, and draw by insufficient material
         special_state_black = None
@@ -344,10 +416,17 @@ class ChessGUI(tk.Canvas):
             elif status == 0.2:
                 san_str += " 1/2-1/2"
                 special_state_white = "Draw - 3x Repetition"
-                special_state_black = "Draw - 3x Repetition"                              
+                special_state_black = "Draw - 3x Repetition"
+            elif status == 0.3:
+                if rules.is_king_in_check(self.board.whites_turn, self.board):
+                    san_str += "+"
+                san_str += " 1/2-1/2"
+                special_state_white = "Draw - 50 Moves"
+                special_state_black = "Draw - 50 Moves"
             else:
                 print("ERROR: Invalid game over code")
             self.game_active = False
+            self.stop_pondering()
         else:
             if status == 1 or status == -1:
                 # In check
@@ -364,32 +443,21 @@ class ChessGUI(tk.Canvas):
         if self.display:
             self.display.notify_move(special_state_white, special_state_black)
 
-        # If a computer's turn is next, trigger the search
-        if self.game_active:
-            if (self.board.whites_turn and self.player_type[0] != PlayerType.HUMAN or
-                not self.board.whites_turn and self.player_type[1] != PlayerType.HUMAN):
-                self.prepare_computer_move()
+        # If a computer's turn is next, trigger the search; otherwise the analysis follows the game
+        if (self.game_active and
+            (self.board.whites_turn and self.player_type[0] != PlayerType.HUMAN or
+             not self.board.whites_turn and self.player_type[1] != PlayerType.HUMAN)):
+            self.prepare_computer_move()
+        else:
+            self.update_analysis()
 
     def compute_total_piece_values(self, white):
-        value = 0
-        piece_values = {"P":1, "N":3, "B":3, "R":5, "Q":9}
-        for row in range(8):
-            for col in range(8):
-                piece = self.board.squares[row][col]
-                if white and piece in "QRNBP" or not white and piece in "qrnbp":
-                    if piece.upper() in piece_values:
-                        value += piece_values[piece.upper()]
-        return value
+        return self.board.white_material if white else self.board.black_material
     
     def captured_pieces(self, white):
-        if white:
-            captured = {"q":0, "r":0, "n":0, "b":0, "p":0}
-        else:
-            captured = {"Q":0, "R":0, "N":0, "B":0, "P":0}
-        for m in self.board.move_history:
-            if white and m[4] in "KQRNBP" and m[5] != "." or not white and m[4] in "kqrnbp" and m[5] != ".":
-                captured[m[5]] += 1
-        return captured
+        # Pieces captured by white are black's pieces, and vice versa
+        pieces = "qrnbp" if white else "QRNBP"
+        return {p: self.board.captured_counts[p] for p in pieces}
 
     def any_valid_moves(self):
         for moves in self.all_valid_moves.values():
@@ -410,8 +478,8 @@ class ChessGUI(tk.Canvas):
                 for r in range(8):
                     for c in range(8):
                         self.itemconfig(self.square_rects[r][c], fill=self.square_color(r, c))
-                if self.board.move_history:
-                    last_move = self.board.move_history[-1]
+                last_move = self.board.last_move()
+                if last_move:
                     self.itemconfig(self.square_rects[last_move[0]][last_move[1]], fill=self.square_highlighted_color(last_move[0], last_move[1]))
                     self.itemconfig(self.square_rects[last_move[2]][last_move[3]], fill=self.square_highlighted_color(last_move[2], last_move[3]))
                 self.itemconfig(self.square_rects[sr][sc], fill=self.square_highlighted_color(sr, sc))
@@ -421,8 +489,8 @@ class ChessGUI(tk.Canvas):
         sr = self.selected_square[0]
         sc = self.selected_square[1]
 
-        if self.board.move_history:
-            last_move = self.board.move_history[-1]
+        last_move = self.board.last_move()
+        if last_move:
             if self.highlight_last_move:
                 self.itemconfig(self.square_rects[last_move[0]][last_move[1]], fill=self.square_highlighted_color(last_move[0], last_move[1]))
                 self.itemconfig(self.square_rects[last_move[2]][last_move[3]], fill=self.square_highlighted_color(last_move[2], last_move[3]))
@@ -430,154 +498,334 @@ class ChessGUI(tk.Canvas):
                 self.itemconfig(self.square_rects[last_move[0]][last_move[1]], fill=self.square_color(last_move[0], last_move[1]))
                 self.itemconfig(self.square_rects[last_move[2]][last_move[3]], fill=self.square_color(last_move[2], last_move[3]))
 
-    def execute_computer_move_blocking(self):
-        """ This is a blocking call and must be run within a Thread """
+    def new_search_id(self):
+        self.search_count += 1
+        return self.search_count
 
-        # TODO: Handle the case where "new game" is clicked
-        depth = 250
-        max_time = 0
+    def search_limits(self):
+        """ Returns (depth, movetime, wtime, btime, winc, binc) for UCIEngine.go, with None for no limit """
+        depth = None
+        movetime = None
         if self.display:
-            if self.display.engine_depth_clicked.get() == "∞":
-                depth = 250
-            else:
+            if self.display.engine_depth_clicked.get() != "∞":
                 depth = int(self.display.engine_depth_clicked.get())
             max_time = int(self.display.engine_time_options[self.display.engine_time_clicked.get()])
-        if self.board.whites_turn:
-            color = 0
-        else:
-            color = 1
-        if self.player_type[color] == PlayerType.HUMAN:
-            print("Error: Trying to execute computer move during human turn")
+            if max_time != 0:
+                movetime = max_time
+        wtime = btime = winc = binc = None
+        if self.time_remaining_ms[0] > 0 and self.time_remaining_ms[1] > 0:
+            wtime, btime = self.time_remaining_ms
+            winc, binc = self.time_inc_ms
+        return depth, movetime, wtime, btime, winc, binc
+
+    async def search(self, engine, search_id, moves, limits, ponder = False):
+        """ Search the position reached by the moves, returning (best move, ponder move,
+        time.perf_counter() when the best move was read) """
+        async with engine.lock:
+            # Info lines are only kept while their search is the one awaited
+            engine.info_callback = lambda line: self.update_search_info(search_id, line)
+            try:
+                await engine.position(moves)
+                await engine.is_ready()
+                best_move, ponder_move = await engine.go(*limits, ponder = ponder)
+                return best_move, ponder_move, engine.bestmove_time
+            finally:
+                engine.info_callback = None
+
+    def update_search_info(self, search_id, line):
+        # Called on the engine loop's thread
+        if search_id == self.search_id:
+            self.info_buffer.update(search_id, uci_engine.parse_info(line))
+
+    def white_centipawns(self, info = None):
+        """ Score of the current search (or the given info) from white's view, or None """
+        centipawns = uci_engine.score_centipawns(self.search_info if info is None else info)
+        if centipawns is not None and not self.board.whites_turn:
+            centipawns *= -1
+        return centipawns
+
+    def evaluation_text(self, info = None):
+        """ Evaluation of the current search (or the given info) from white's view, as pawns or moves to mate """
+        if info is None:
+            info = self.search_info
+        if "score_mate" in info:
+            mate = info["score_mate"]
+            return "#" + str(mate if self.board.whites_turn else -mate)
+        centipawns = self.white_centipawns(info)
+        return "" if centipawns is None else '{0:+.2f}'.format(centipawns / 100)
+
+    def draw_engine_info(self):
+        """ Show the latest info of the current search, once per frame while it lasts """
+        if self.info_timer is not None:
+            # Called between frames, so the next frame is rescheduled below
+            self.top.after_cancel(self.info_timer)
+            self.info_timer = None
+        taken = self.info_buffer.take(self.search_id)
+        if taken is not None and (self.game_active or self.analyzing):
+            self.search_info = taken[0]
+            info = self.search_info
+            centipawns = self.white_centipawns()
+            if self.eval_bar and centipawns is not None:
+                self.eval_bar.update_winning_chances(centipawns)
+            if self.analyzing:
+                self.draw_analysis(info)
+            elif self.display:
+                e_text = "Engine is currently searching with max depth = " + self.display.engine_depth_clicked.get() + "\n"
+                e_text += "Depth: " + str(info.get("depth", 0)) + "/" + str(info.get("seldepth", 0))
+                e_text += "  Nodes: " + str(info.get("nodes", 0)) + "  NPS: " + str(info.get("nps", 0)) + "\n"
+                e_text += "Evaluation (white is positive): " + self.evaluation_text() + "\n"
+                e_text += "Principal variation: " + " ".join(info.get("pv", [])) + "\n"
+                self.display.update_engine_text_panel(e_text)
+        if self.searching:
+            self.info_timer = self.top.after(1000 // self.info_frames_per_second, self.draw_engine_info)
+
+    def draw_analysis(self, info):
+        """ Update the rows of the analysis table whose variations have changed """
+        lines = info.get("lines", {1: info})
+        for number in sorted(lines):
+            line = lines[number]
+            sans = self.san_cache.pv_to_san(self.board, line.get("pv", []))
+            if not sans:
+                continue
+            values = (sans[0], self.evaluation_text(line), line.get("depth", ""), " ".join(sans))
+            if self.analysis_rows.get(number) != values:
+                self.analysis_rows[number] = values
+                if self.display:
+                    self.display.update_analysis_row(number, values)
+
+    def set_analysis_lines(self, lines):
+        """ Turn analysis mode on with the number of variations, or off if it is 0 """
+        self.analysis_lines = lines
+        self.stop_analysis()
+        if self.display:
+            self.display.show_analysis(lines > 0)
+        self.update_analysis()
+
+    async def analyze(self, engine, search_id, moves, lines):
+        async with engine.lock:
+            engine.info_callback = lambda line: self.update_search_info(search_id, line)
+            try:
+                await engine.set_option("MultiPV", lines)
+                await engine.position(moves)
+                await engine.is_ready()
+                await engine.go(infinite = True)
+            finally:
+                engine.info_callback = None
+                # Later searches only want the best move
+                await engine.set_option("MultiPV", 1)
+
+    def stop_analysis(self):
+        if self.analysis_engine is not None:
+            self.engine_loop.submit(self.analysis_engine.stop())
+            self.analysis_engine = None
+        if self.analyzing:
+            self.analyzing = False
+            self.searching = False
+            self.search_id = self.new_search_id()
+
+    def update_analysis(self):
+        """ Analyse the current position if analysis mode is on and no engine is to move """
+        self.stop_analysis()
+        self.analysis_rows = {}
+        if self.display:
+            self.display.clear_analysis()
+        color = 0 if self.board.whites_turn else 1
+        if self.analysis_lines == 0 or self.game_active and self.player_type[color] != PlayerType.HUMAN:
             return
-        else:
+        # Engines that are pondering are busy until the opponent moves
+        for c in [color, 1 - color]:
+            if self.engines[c] is not None and self.pondering[c] is None:
+                self.analysis_engine = self.engines[c]
+                break
+        if self.analysis_engine is None:
+            return
+        search_id = self.new_search_id()
+        self.start_search(search_id, "Engine is analysing")
+        self.analyzing = True
+        self.engine_loop.submit(self.analyze(self.analysis_engine, search_id, self.board.uci_moves(), self.analysis_lines))
+
+    def load_polyglot_book(self, filename):
+        """ Returns True if the Polyglot book was loaded """
+        if self.polyglot_book is not None:
+            self.polyglot_book.close()
+            self.polyglot_book = None
+        try:
+            self.polyglot_book = polyglot_book.PolyglotBook(filename)
+        except (OSError, ValueError) as e:
+            print("Could not load opening book:", e)
+            return False
+        print("Opening book", filename, "containing", self.polyglot_book.count, "entries has been loaded.")
+        return True
 
-            # Get move history in long algebratic notation
-            lan_history = ""
-            for m in self.board.move_history:
-                lan_history += "abcdefgh"[m[1]] 
-                lan_history += str(8 - m[0])
-                lan_history += "abcdefgh"[m[3]] 
-                lan_history += str(8 - m[2])
-                lan_history += " "
-
-            uci_pos_str = "position startpos moves " + lan_history + "\n"
-            print("To external engine:", uci_pos_str)
-            self.external_engine_process[color].stdin.write(uci_pos_str)
-            print("To external engine:", "isready")
-            self.external_engine_process[color].stdin.write("isready\n")
-            output = self.external_engine_process[color].stdout.readline().strip()
-            print("From external engine:", output)
-
-            # Send UCI go command
-            uci_go_str = "go"
-            if depth != 0 and depth != 250:
-                uci_go_str += " depth " + str(depth)
-            if max_time != 0:
-                uci_go_str += " movetime " + str(max_time)
-            if self.time_remaining_ms[0] > 0 and self.time_remaining_ms[1] > 0:
-                uci_go_str += " wtime " + str(self.time_remaining_ms[0]) + " winc " + str(self.time_inc_ms[0])
-                uci_go_str += " btime " + str(self.time_remaining_ms[1]) + " binc " + str(self.time_inc_ms[1])
-            uci_go_str += "\n"
-            print("To external engine:", uci_go_str)
-            self.external_engine_process[color].stdin.write(uci_go_str)
-            value = 0
-            pv = ""
-            moves_searched = 0
-            max_depth_searched = 0
-            s_time = time.time()
-            best_move = None
-            while not self.kill_thread:
-                from_engine_str = self.external_engine_process[color].stdout.readline().strip()
-                if self.kill_thread:
-                    break
-                print("From external engine:", from_engine_str)
-                words = from_engine_str.split()
-                if "info" in words and self.display:
-                    self.display.append_engine_text_panel(from_engine_str)
-                if "info" in words and "depth" in words:
-                    pos = words.index("depth") + 1
-                    max_depth_searched = int(words[pos])
-                if "info" in words and "nodes" in words:
-                    pos = words.index("nodes") + 1
-                    moves_searched += int(words[pos])
-                if "info" in words and "pv" in words:
-                    pos = words.index("pv")
-                    pv = ""
-                    for i in range(pos+1, len(words)):
-                        pv += words[i] + " "
-                if "info" in words and "cp" in words:
-                    pos = words.index("cp") + 1
-                    value = int(words[pos])
-                    if self.eval_bar:
-                        eval = value
-                        if not self.board.whites_turn:
-                            eval *= -1
-                        self.eval_bar.update_winning_chances(eval)
-                if len(words) >= 2 and words[0] == "bestmove":
-                    e_time = time.time()
-                    start_col = "abcdefgh".find(words[1][0])
-                    start_row = 8 - int(words[1][1])
-                    end_col = "abcdefgh".find(words[1][2])
-                    end_row = 8 - int(words[1][3])
-                    best_move = ((start_row, start_col, end_row, end_col), value, moves_searched, max_depth_searched, pv, e_time - s_time)
-                    break
-
-        # Store the returned move
-        with self.engine_thread_lock:
-            self.selected_computer_move = best_move
-            self.computer_move_finished = True
+    def book_move(self):
+        """ Returns a book move for the current position, or None once the game has left the book """
+        if self.polyglot_book is None or not self.in_polyglot_book:
+            return None
+        move = None
+        if len(self.board.move_history) < self.book_max_ply:
+            move = self.polyglot_book.choose_move(self.board, self.book_weighted)
+        if move is None:
+            self.in_polyglot_book = False
+        return move
+
+    def play_book_move(self, search_id, move):
+        # The game may have ended or been restarted since the move was chosen,
+        # which moves on the search id
+        if search_id != self.search_id or not self.game_active:
+            return
+        for origin, m in self.valid_move_targets.get((move[2], move[3]), []):
+            if origin == (move[0], move[1]):
+                self.do_move(move[0], move[1], move[2], move[3])
+                return
 
     def prepare_computer_move(self):
-        with self.engine_thread_lock:
-            self.computer_move_finished = False
+        move = self.book_move()
+        if move is not None:
+            if self.display:
+                self.display.update_engine_text_panel("Engine played a book move\n")
+            # Play it from the event loop, so the board is drawn between book moves
+            search_id = self.new_search_id()
+            self.search_id = search_id
+            self.top.after_idle(lambda: self.play_book_move(search_id, move))
+            return
+        self.stop_analysis()
+        color = 0 if self.board.whites_turn else 1
+        engine = self.engines[color]
+        if self.player_type[color] == PlayerType.HUMAN or engine is None:
+            print("Error: Trying to execute computer move during human turn")
+            return
+
+        # If the engine has been pondering, either the opponent played the move it expected
+        # and its search carries on, or the ponder search is stopped and a new one started
+        pondering = self.pondering[color]
+        self.pondering[color] = None
+        if pondering is not None:
+            ponder_id, expected_move = pondering
+            if self.board.uci_moves()[-1] == expected_move:
+                self.start_search(ponder_id, "Engine expected this move and continues its search")
+                self.engine_loop.submit(engine.ponderhit())
+                return
+            self.engine_loop.submit(engine.stop())
+
+        search_id = self.new_search_id()
+        self.start_search(search_id, "Engine is currently searching")
+        search = self.search(engine, search_id, self.board.uci_moves(), self.search_limits())
+        self.engine_loop.submit(search, ("bestmove", search_id))
+
+    def start_search(self, search_id, text):
+        """ Await the results of the search, drawing its info until they arrive """
+        self.search_id = search_id
+        self.search_info = {}
+        self.searching = True
+        self.search_start = time.perf_counter()
+        if self.info_timer is None:
+            self.info_timer = self.top.after(1000 // self.info_frames_per_second, self.draw_engine_info)
         if self.display:
-            e_text = "Engine is currently searching with max depth = " + self.display.engine_depth_clicked.get() + "\n"
+            e_text = text + " with max depth = " + self.display.engine_depth_clicked.get() + "\n"
             self.display.update_engine_text_panel(e_text)
-        search_thread = threading.Thread(target = self.execute_computer_move_blocking)
-        search_thread.start()
-        self.top.after(500, self.check_if_computer_is_done)
 
-    def check_if_computer_is_done(self):
-        if not self.game_active or self.kill_thread:
-            self.kill_thread = False
+    def start_pondering(self, color, ponder_move):
+        """ Have the engine of the color search the position after the ponder move on the opponent's time """
+        engine = self.engines[color]
+        if not self.ponder or ponder_move is None or not self.game_active or engine is None:
             return
-        move = None
-        with self.engine_thread_lock:
-            if self.computer_move_finished:
-                if not self.selected_computer_move:
-                    self.board.fatal_error("No computer move selected")
-                else:
-                    move = self.selected_computer_move
-                    self.computer_move_finished = False
-            else:
-                self.top.after(500, self.check_if_computer_is_done)
-        if move:
-            if self.eval_bar:
-                evaluation = move[1]
-                if not self.board.whites_turn:
-                    evaluation *= -1
-                self.eval_bar.update_winning_chances(evaluation)
-            if self.display:
-                e_text = "Engine finished searching" + "\n"
-                e_text += "Principal variation: " + str(move[4]) + "\n"
-                evaluation = move[1]
-                if self.board.whites_turn:
-                    eval_string = "+" + '{0:.2f}'.format(evaluation / 100)
-                else:
-                    evaluation *= -1
-                    eval_string = '{0:.2f}'.format(evaluation / 100)
-                e_text += "Evaluation (white is positive): " + eval_string + "\n"
-                e_text += str(move[2]) + " moves searched in " + '{0:.2f}'.format(move[5]) + "s" + "\n"
-                e_text += "Max depth reached (excluding captures): " + str(move[3]) + "\n"
-                self.display.update_engine_text_panel(e_text)
-            self.do_move(move[0][0], move[0][1], move[0][2], move[0][3])
+        if "Ponder" not in engine.options or not uci_engine.move_is_legal(self.board, ponder_move):
+            return
+        ponder_id = self.new_search_id()
+        self.pondering[color] = (ponder_id, ponder_move)
+        search = self.search(engine, ponder_id, self.board.uci_moves() + [ponder_move], self.search_limits(), True)
+        self.engine_loop.submit(search, ("bestmove", ponder_id))
+
+    def stop_pondering(self, colors = (0, 1)):
+        for color in colors:
+            if self.pondering[color] is not None and self.engines[color] is not None:
+                self.engine_loop.submit(self.engines[color].stop())
+            self.pondering[color] = None
+
+    def process_engine_results(self, event = None):
+        """ Handle the results of the engines, which arrive on engine_loop.results """
+        for tag, result, error in self.engine_loop.collect():
+            if tag[0] == "started":
+                self.engine_started(tag[1], tag[2], error)
+            elif tag[1] != self.search_id or not self.game_active:
+                # A search abandoned for a new game, or a game that has ended
+                continue
+            elif tag[0] == "bestmove":
+                self.searching = False
+                color = 0 if self.board.whites_turn else 1
+                if error is not None:
+                    self.engine_failed(color, self.engines[color], "Engine error: " + str(error))
+                    continue
+                if result[0] is None:
+                    self.engine_failed(color, self.engines[color], "Engine did not send a move")
+                    continue
+                self.computer_move_done(result[0], result[1], result[2] - self.search_start)
+                latency = (time.perf_counter() - result[2]) * 1000
+                self.engine_move_latencies.append(latency)
+                if self.engine_verbose:
+                    print("Engine move reached the board", '{0:.2f}'.format(latency), "ms after bestmove")
+
+    def engine_started(self, color, engine, error):
+        if error is None:
+            print("Engine", engine.name, "has been loaded.")
+            if self.analysis_lines > 0 and self.analysis_engine is None:
+                self.update_analysis()
+            return
+        self.engine_failed(color, engine, "Could not load engine: " + str(error))
+
+    def engine_failed(self, color, engine, message):
+        """ Report an engine that failed, and hand its side over to a human """
+        print(message)
+        if self.display:
+            self.display.update_engine_text_panel(message + "\n")
+        if engine is None or self.engines[color] is not engine:
+            return
+        # End any search awaited from the engine, such as one queued while it was starting
+        if self.board.whites_turn == (color == 0):
+            self.search_id = self.new_search_id()
+            self.searching = False
+        self.stop_pondering([color])
+        if engine is self.analysis_engine:
+            self.stop_analysis()
+        self.engine_loop.submit(engine.quit())
+        self.engines[color] = None
+        self.player_type[color] = PlayerType.HUMAN
+        if self.display and color == 0:
+            self.display.white_player_name = "Human"
+        elif self.display and color == 1:
+            self.display.black_player_name = "Human"
+        if self.display:
+            self.display.update_player_text()
+        # The human to move may want the position analysed
+        if self.game_active and self.board.whites_turn == (color == 0):
+            self.update_analysis()
+
+    def computer_move_done(self, best_move, ponder_move, search_time):
+        start_row, start_col, end_row, end_col = chess_board.uci_to_squares(best_move)
+        # Take the last info of the search, which may have arrived since the last frame
+        self.draw_engine_info()
+        info = self.search_info
+        if self.display:
+            e_text = "Engine finished searching" + "\n"
+            e_text += "Principal variation: " + " ".join(info.get("pv", [])) + "\n"
+            e_text += "Evaluation (white is positive): " + self.evaluation_text() + "\n"
+            e_text += str(info.get("nodes", 0)) + " moves searched in " + '{0:.2f}'.format(search_time) + "s" + "\n"
+            e_text += "Max depth reached (excluding captures): " + str(info.get("depth", 0)) + "\n"
+            self.display.update_engine_text_panel(e_text)
+        color = 0 if self.board.whites_turn else 1
+        self.do_move(start_row, start_col, end_row, end_col)
+        self.start_pondering(color, ponder_move)
 
     def shutdown_external_engine(self, color):
         if self.board.whites_turn and color == 0 or not self.board.whites_turn and color ==1:
-            self.kill_thread = True
-        if self.player_type[color] == PlayerType.EXTERNAL_ENGINE:
-            self.external_engine_process[color].stdin.write("quit\n")
-            self.external_engine_process[color].kill()
+            self.search_id = self.new_search_id()
+            self.searching = False
+        self.stop_pondering([color])
+        if self.engines[color] is not None and self.engines[color] is self.analysis_engine:
+            self.stop_analysis()
+        if self.engines[color] is not None:
+            self.engine_loop.submit(self.engines[color].quit())
+            self.engines[color] = None
 
     def mouse_click(self, event):
 
@@ -612,12 +860,11 @@ class ChessGUI(tk.Canvas):
             for r in range(8):
                 for c in range(8):
                     self.itemconfig(self.square_rects[r][c], fill=self.square_color(r, c))
-            if self.highlight_last_move and self.board.move_history:
-                last_move = self.board.move_history[-1]
+            last_move = self.board.last_move()
+            if self.highlight_last_move and last_move:
                 self.itemconfig(self.square_rects[last_move[0]][last_move[1]], fill=self.square_highlighted_color(last_move[0], last_move[1]))
                 self.itemconfig(self.square_rects[last_move[2]][last_move[3]], fill=self.square_highlighted_color(last_move[2], last_move[3]))
 
             # If the move is legal, perform it
-            if ( (row, col, True, False) in self.all_valid_moves[(sr, sc)] or (row, col, True, True) in self.all_valid_moves[(sr, sc)] or
-                (row, col, False, False) in self.all_valid_moves[(sr, sc)] or (row, col, False, True) in self.all_valid_moves[(sr, sc)] ):
+            if any(origin == (sr, sc) for origin, m in self.valid_move_targets.get((row, col), [])):
                 self.do_move(sr, sc, row, col)
@@ -1,4 +1,5 @@
-import chess_board
+import argparse
+import bitboard_board
 import chess_gui
 import display_panel
 import evalbar_gui
@@ -7,6 +8,12 @@ import tkinter as tk
 
 if __name__ == "__main__":
 
+    parser = argparse.ArgumentParser(description = "Coral chess GUI")
+    parser.add_argument("--verbose", action = "store_true", help = "print every line sent to and from the engines")
+    parser.add_argument("--ponder", action = "store_true", help = "let engines that support it think on their opponent's time")
+    parser.add_argument("--board", choices = sorted(bitboard_board.BOARD_TYPES), default = "list", help = "board backend used for move generation")
+    args = parser.parse_args()
+
     # tk window
     top = tk.Tk()
     top.title("Chess")
@@ -14,18 +21,21 @@ if __name__ == "__main__":
     top.configure(background="white")
 
     # Chess board
-    board = chess_board.Board()
+    board = bitboard_board.BOARD_TYPES[args.board]()
 
     # Opening books
     openings = opening_finder.OpeningFinder()
-    openings.load_opening_book_tsv("resources/a.tsv")
-    openings.load_opening_book_tsv("resources/b.tsv")
-    openings.load_opening_book_tsv("resources/c.tsv")
-    openings.load_opening_book_tsv("resources/d.tsv")
-    openings.load_opening_book_tsv("resources/e.tsv")
+    # The tsv books are compiled into a binary book, which is rebuilt whenever one is newer
+    openings.open_opening_book("resources/openings.bin", ["resources/a.tsv",
+                                                          "resources/b.tsv",
+                                                          "resources/c.tsv",
+                                                          "resources/d.tsv",
+                                                          "resources/e.tsv"])
 
     # Chess GUI (which is a tk.Canvas)
     gui = chess_gui.ChessGUI(top, board)
+    gui.engine_verbose = args.verbose
+    gui.ponder = args.ponder
     gui.pack(side = tk.LEFT)
 
     # Eval bar (which is a tk.Canvas)
@@ -1,8 +1,10 @@
 import tkinter as tk
 import tkinter.scrolledtext as st
+from tkinter import ttk
 from tkinter import filedialog as fd 
 import math
 import time
+import opening_finder
 from player_type import PlayerType 
 
 class DisplayPanel(tk.Frame):
@@ -25,6 +27,7 @@ class DisplayPanel(tk.Frame):
 
         # Opening tree, which will be loaded seperately if we have one
         self.openings = None
+        self.opening_cursor = None
 
         # Captured pieces images
         self.whites_captured_images = {"q":[], "r":[], "n":[], "b":[], "p":[]}
@@ -165,12 +168,24 @@ class DisplayPanel(tk.Frame):
         # Engine hash size frame
         engine_hash_frame = tk.Frame(self, bg="white")
         engine_hash_frame.pack(side = tk.TOP, pady=5)
-        tk.Label(engine_hash_frame, background="White", text="  Engine hash table size in MB: ").pack(side = tk.LEFT)
+        tk.Label(engine_hash_frame, background="White", text="  Engine hash MB: ").pack(side = tk.LEFT)
         self.hash_size_entry = tk.Entry(engine_hash_frame, width = 5)
         self.hash_size_entry.pack(side = tk.LEFT)
         hash_button = tk.Button(engine_hash_frame, highlightbackground = "white", text="Apply", command = self.update_engine_hash)
         hash_button.pack(side = tk.LEFT)
 
+        # Engine opening book (in the same frame), with the number of moves to play from it
+        tk.Label(engine_hash_frame, background="White", text="  Book: ").pack(side = tk.LEFT)
+        book_button = tk.Button(engine_hash_frame, highlightbackground = "white", text="Load", command = self.load_polyglot_book)
+        book_button.pack(side = tk.LEFT)
+        book_depth_options = ["4", "6", "8", "10", "12", "15", "20", "∞"]
+        self.book_depth_clicked = tk.StringVar()
+        self.book_depth_clicked.set("10")
+        self.book_depth_clicked.trace_add("write", self.book_depth_callback)
+        book_depth_dropdown = tk.OptionMenu(engine_hash_frame, self.book_depth_clicked, *book_depth_options)
+        book_depth_dropdown.config(background="white", highlightbackground = "white")
+        book_depth_dropdown.pack(side = tk.LEFT)
+
         # Set initial player text
         self.update_player_text()
 
@@ -180,11 +195,21 @@ class DisplayPanel(tk.Frame):
         highlight_last_move_checkbox = tk.Checkbutton(self, bg = "white", text='Highlight previous move',variable=self.highlight_last_move, onvalue=1, offvalue=0, command=self.update_highlight_last_move)
         highlight_last_move_checkbox.pack(side = tk.TOP, anchor = tk.W)
 
-        # Show legal moves
+        # Show legal moves, and on the same line the number of engine analysis lines
+        view_options_frame = tk.Frame(self, bg="white")
+        view_options_frame.pack(side = tk.TOP, anchor = tk.W, fill = tk.X)
         self.show_valid_moves = tk.BooleanVar()
         self.show_valid_moves.set(True)
-        valid_moves_checkbox = tk.Checkbutton(self, bg = "white", text='Show legal moves',variable=self.show_valid_moves, onvalue=1, offvalue=0, command=self.update_show_valid_moves)
-        valid_moves_checkbox.pack(side = tk.TOP, anchor = tk.W)
+        valid_moves_checkbox = tk.Checkbutton(view_options_frame, bg = "white", text='Show legal moves',variable=self.show_valid_moves, onvalue=1, offvalue=0, command=self.update_show_valid_moves)
+        valid_moves_checkbox.pack(side = tk.LEFT)
+        analysis_lines_options = ["Off", "1", "2", "3", "4", "5"]
+        self.analysis_lines_clicked = tk.StringVar()
+        self.analysis_lines_clicked.set("Off")
+        self.analysis_lines_clicked.trace_add("write", self.analysis_lines_callback)
+        analysis_lines_dropdown = tk.OptionMenu(view_options_frame, self.analysis_lines_clicked, *analysis_lines_options)
+        analysis_lines_dropdown.config(background="white", highlightbackground = "white")
+        analysis_lines_dropdown.pack(side = tk.RIGHT)
+        tk.Label(view_options_frame, background="White", text="Analysis lines: ").pack(side = tk.RIGHT)
 
         # Game moves
         self.move_text_panel = st.ScrolledText(self, width = 60, height = 6, background="white", highlightbackground="black", highlightthickness=1, borderwidth = 0)
@@ -200,6 +225,13 @@ class DisplayPanel(tk.Frame):
         self.engine_stats_panel.pack(side = tk.TOP, pady = 5)
         self.update_engine_text_panel("Engine Information")
 
+        # Engine analysis table, shown in place of the engine stats in analysis mode.
+        # Rows are numbered by variation and updated in place as the analysis deepens.
+        self.analysis_table = ttk.Treeview(self, columns = ("move", "score", "depth", "line"), show = "headings", height = 5)
+        for column, heading, width in [("move", "Move", 60), ("score", "Score", 60), ("depth", "Depth", 50), ("line", "Line", 230)]:
+            self.analysis_table.heading(column, text = heading)
+            self.analysis_table.column(column, width = width, stretch = column == "line")
+
     def new_game(self):
         for imgs in self.whites_captured_images.values():
             for i in imgs:
@@ -217,6 +249,8 @@ class DisplayPanel(tk.Frame):
         self.move_text_panel.insert(tk.INSERT, self.opening_text + "\n" + self.move_text)
         self.move_text_panel.configure(state ='disabled') 
         self.update_engine_text_panel("Engine Information")
+        if self.openings:
+            self.opening_cursor.reset()
         self.gui.new_game()
         self.update_time_display()
 
@@ -241,6 +275,41 @@ class DisplayPanel(tk.Frame):
             self.gui.engine_hash_size = hash_int
             self.gui.update_engine_hash()
 
+    def load_polyglot_book(self):
+        name = fd.askopenfilename(filetypes = [("Polyglot book", "*.bin"), ("All files", "*")])
+        if name:
+            self.gui.load_polyglot_book(name)
+
+    def book_depth_callback(self, var, index, mode):
+        # Book depth is chosen in moves of each side, and the GUI counts plies
+        moves = self.book_depth_clicked.get()
+        self.gui.book_max_ply = 1000 if moves == "∞" else 2 * int(moves)
+
+    def analysis_lines_callback(self, var, index, mode):
+        lines = self.analysis_lines_clicked.get()
+        self.gui.set_analysis_lines(0 if lines == "Off" else int(lines))
+
+    def show_analysis(self, show):
+        if show:
+            self.engine_stats_panel.pack_forget()
+            self.analysis_table.pack(side = tk.TOP, pady = 5)
+        else:
+            self.analysis_table.pack_forget()
+            self.engine_stats_panel.pack(side = tk.TOP, pady = 5)
+
+    def update_analysis_row(self, number, values):
+        """ Show the values (move, score, depth, line) of the numbered variation """
+        row = str(number)
+        if self.analysis_table.exists(row):
+            self.analysis_table.item(row, values = values)
+        else:
+            # Keep the rows in order of variation
+            index = sum(1 for r in self.analysis_table.get_children() if int(r) < number)
+            self.analysis_table.insert("", index, iid = row, values = values)
+
+    def clear_analysis(self):
+        self.analysis_table.delete(*self.analysis_table.get_children())
+
     def time_control_callback(self, var, index, mode):
         vals = self.time_control_options[self.time_control_clicked.get()]
         self.gui.time_remaining_ms = [vals[0], vals[0]]
@@ -248,6 +317,7 @@ class DisplayPanel(tk.Frame):
 
     def attach_openings(self, openings):
         self.openings = openings
+        self.opening_cursor = opening_finder.OpeningCursor(openings)
 
     def update_show_valid_moves(self):
         self.gui.show_valid_moves = self.show_valid_moves.get()
@@ -352,7 +422,8 @@ class DisplayPanel(tk.Frame):
                 self.move_number += 1
             self.move_text += m_str + " "
             if self.openings:
-                opening_text_result = self.openings.find_opening(self.gui.board)
+                # Follow the game through the book, which costs nothing once out of it
+                opening_text_result = self.opening_cursor.advance(self.gui.board)
                 if opening_text_result:
                     self.opening_text = opening_text_result
             else:
@@ -0,0 +1,65 @@
+from collections import OrderedDict
+import rulebook as rules
+
+class MoveCache():
+    """
+    Bounded cache of the legal move dictionaries and target square indexes made by
+    rules.compute_all_valid_moves, keyed by Zobrist hash.  Each entry also records the
+    side to move, castling rights, and en passant square, which are checked on lookup
+    so that a hash collision cannot return another position's moves.  Once max_entries
+    is reached, the least recently used entry is evicted.
+
+    The cached dictionaries are shared between lookups, so they must not be modified.
+    Zobrist hashes depend on the board's hasher, so a cache is only valid for one board.
+    """
+
+    def __init__(self, max_entries = 10000):
+        self.max_entries = max_entries
+        self.entries = OrderedDict() # key is Zobrist hash, value is (state, all valid moves, targets)
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def position_state(self, board):
+        # The castled flags of the packed state do not affect which moves are legal
+        return board.whites_turn, board.pack_state() & 0x7ff
+
+    def get(self, board):
+        """ Returns the cached (legal moves, targets) for the board's position, or None """
+        entry = self.entries.get(board.zobrist_hash)
+        if entry is None or entry[0] != self.position_state(board):
+            self.misses += 1
+            return None
+        self.entries.move_to_end(board.zobrist_hash)
+        self.hits += 1
+        return entry[1], entry[2]
+
+    def store(self, board, all_valid_moves, targets):
+        self.entries[board.zobrist_hash] = (self.position_state(board), all_valid_moves, targets)
+        self.entries.move_to_end(board.zobrist_hash)
+        if len(self.entries) > self.max_entries:
+            self.entries.popitem(last = False)
+
+    def compute_valid_moves_and_targets(self, board):
+        """
+        Returns the legal moves and target square index made by rules.compute_all_valid_moves,
+        served from the cache when possible
+        """
+        entry = self.get(board)
+        if entry is None:
+            targets = {}
+            all_valid_moves = rules.compute_all_valid_moves(board, targets)
+            self.store(board, all_valid_moves, targets)
+            return all_valid_moves, targets
+        return entry
+
+    def compute_all_valid_moves(self, board):
+        """ Same as rules.compute_all_valid_moves, but served from the cache when possible """
+        return self.compute_valid_moves_and_targets(board)[0]
+
+    def clear(self):
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
@@ -1,41 +1,324 @@
 import csv
+import mmap
+import os
+import struct
+import chess_board
+
+# Compiled opening books hold, in little-endian order:
+#   header  - magic, format version, number of positions, the Zobrist hash of the
+#             starting position (which changes if the hasher's values change), and
+#             the number of opening trie nodes and edges
+#   keys    - the Zobrist hash of each position, sorted, as unsigned 64-bit integers
+#   entries - for each key, the (offset, length) of its opening name in the string table
+#   nodes   - for each trie node, the (offset, length) of its opening name (offset
+#             NO_NAME if no line ends there) and the (first, count) of its edges
+#   edges   - for each edge, its move (see trie_move) and the index of its child node.
+#             The edges of a node are consecutive, and node 0 is the root.
+#   strings - the UTF-8 opening names
+BOOK_MAGIC = b"CORALBK\0"
+BOOK_VERSION = 2
+BOOK_HEADER = struct.Struct("<8sIIQII")
+BOOK_KEY = struct.Struct("<Q")
+BOOK_ENTRY = struct.Struct("<II")
+BOOK_NODE = struct.Struct("<IIII")
+BOOK_EDGE = struct.Struct("<HI")
+NO_NAME = 0xffffffff
+
+def trie_move(move):
+    """ Key of a packed move in the opening trie: its start and end squares without the flags """
+    return move & 0xfff
+
+def read_opening_book_tsv(filename, board):
+    """ Generator of (Zobrist hash, opening name, moves) for each line of a tsv opening
+    book, where the lines are in the form ECO reference, name, moves in SAN, moves in
+    long algebraic notation.  Each opening's moves are replayed on the board to find
+    the Zobrist hash of its position, which includes the side to move, castling, and
+    en passant rights.  Moves are the board's packed move history, which changes as
+    the next line is read."""
+    with open(filename) as f:
+        csv_reader = csv.reader(f, delimiter="\t")
+        next(csv_reader)
+        board.reset()
+        played = []
+        for line in csv_reader:
+            moves = line[3].split()
+            # Neighbouring lines often share their first moves, so only
+            # undo the moves that differ from the previous line
+            common = 0
+            while common < len(played) and common < len(moves) and played[common] == moves[common]:
+                common += 1
+            for uci in played[common:]:
+                board.unmake_move()
+            for uci in moves[common:]:
+                start_row, start_col, end_row, end_col = chess_board.uci_to_squares(uci)
+                board.make_move(start_row, start_col, end_row, end_col)
+            played = moves
+            yield board.zobrist_hash, line[1], board.move_history
+
+fingerprint = None
+
+def hasher_fingerprint():
+    """ Zobrist hash of the starting position, computed once """
+    global fingerprint
+    if fingerprint is None:
+        fingerprint = chess_board.Board().zobrist_hash
+    return fingerprint
+
+def add_trie_line(root, moves, name):
+    """ Add a line of packed moves to an in-memory trie, where each node is [name, {trie move: child}] """
+    node = root
+    for m in moves:
+        key = trie_move(m)
+        child = node[1].get(key)
+        if child is None:
+            child = [None, {}]
+            node[1][key] = child
+        node = child
+    node[0] = name
+
+def compile_opening_book(tsv_filenames, book_filename):
+    """ Compile tsv opening books into a binary book file.  Where a position or line
+    appears more than once, the last name loaded is kept, as with load_opening_book_tsv. """
+    board = chess_board.Board()
+    openings = {}
+    root = [None, {}]
+    for filename in tsv_filenames:
+        for key, name, moves in read_opening_book_tsv(filename, board):
+            openings[key] = name
+            add_trie_line(root, moves, name)
+
+    strings = bytearray()
+    offsets = {} # Opening name -> (offset, length), since many positions share a name
+    def name_offset(name):
+        if name is None:
+            return NO_NAME, 0
+        if name not in offsets:
+            encoded = name.encode("utf-8")
+            offsets[name] = (len(strings), len(encoded))
+            strings.extend(encoded)
+        return offsets[name]
+
+    keys = sorted(openings)
+    entries = bytearray()
+    for key in keys:
+        entries += BOOK_ENTRY.pack(*name_offset(openings[key]))
+
+    # Number the trie nodes breadth first, so each node's children are numbered consecutively
+    trie_nodes = [root]
+    nodes = bytearray()
+    edges = bytearray()
+    edge_count = 0
+    for node in trie_nodes:
+        offset, length = name_offset(node[0])
+        nodes += BOOK_NODE.pack(offset, length, edge_count, len(node[1]))
+        for move in sorted(node[1]):
+            edges += BOOK_EDGE.pack(move, len(trie_nodes))
+            trie_nodes.append(node[1][move])
+            edge_count += 1
+
+    # Write to a temporary file first so a reader never sees a partial book
+    temp_filename = book_filename + ".tmp"
+    with open(temp_filename, "wb") as f:
+        f.write(BOOK_HEADER.pack(BOOK_MAGIC, BOOK_VERSION, len(keys), hasher_fingerprint(), len(trie_nodes), edge_count))
+        for key in keys:
+            f.write(BOOK_KEY.pack(key))
+        f.write(entries)
+        f.write(nodes)
+        f.write(edges)
+        f.write(strings)
+    os.replace(temp_filename, book_filename)
+    return len(keys)
+
+def opening_book_is_current(tsv_filenames, book_filename):
+    """ True if the binary book exists, is newer than every tsv, and matches this
+    version of the format and the Zobrist hasher """
+    try:
+        book_time = os.path.getmtime(book_filename)
+        with open(book_filename, "rb") as f:
+            header = f.read(BOOK_HEADER.size)
+    except OSError:
+        return False
+    if len(header) != BOOK_HEADER.size or header[0:8] != BOOK_MAGIC:
+        return False
+    magic, version, count, book_fingerprint, node_count, edge_count = BOOK_HEADER.unpack(header)
+    if version != BOOK_VERSION or book_fingerprint != hasher_fingerprint():
+        return False
+    return all(os.path.getmtime(filename) <= book_time for filename in tsv_filenames)
 
 class OpeningFinder():
     def __init__(self):
         self.total_openings_loaded = 0
-        self.openings = {} # Fen position string -> Opening name
+        self.openings = {} # Zobrist hash of position -> Opening name
+        self.trie = [None, {}] # Opening lines loaded from tsv (see add_trie_line)
+
+        # Memory-mapped binary book, if one has been opened
+        self.book_file = None
+        self.book = None
+        self.book_count = 0
+        self.book_entries_offset = 0
+        self.book_nodes_offset = 0
+        self.book_edges_offset = 0
+        self.book_strings_offset = 0
 
     def load_opening_book_tsv(self, filename):
-        """ This method loads a tsv file containing a list of openings with lines
-        in the form ECO reference, name, move in SAN."""
-        with open(filename) as f:
-            csv_reader = csv.reader(f, delimiter="\t")
-            next(csv_reader)
-            count = 0
-            for line in csv_reader:
-                opening_name = line[1]
-                fen_string = line[4].split()[0]
-                self.openings[fen_string] = opening_name
-                count += 1
+        """ This method loads a tsv file containing a list of openings into memory
+        (see read_opening_book_tsv). """
+        count = 0
+        for key, name, moves in read_opening_book_tsv(filename, chess_board.Board()):
+            self.openings[key] = name
+            add_trie_line(self.trie, moves, name)
+            count += 1
         print("Opening book", filename, "containing", count, "openings has been loaded.")
         self.total_openings_loaded += count
 
+    def open_opening_book(self, book_filename, tsv_filenames = None):
+        """ Open a binary opening book, which is only read as positions are looked up.
+        If any of the tsv files are newer than the book, the book is first rebuilt from them. """
+        if tsv_filenames and not opening_book_is_current(tsv_filenames, book_filename):
+            count = compile_opening_book(tsv_filenames, book_filename)
+            print("Opening book", book_filename, "containing", count, "positions has been compiled.")
+        self.close()
+        self.book_file = open(book_filename, "rb")
+        self.book = mmap.mmap(self.book_file.fileno(), 0, access = mmap.ACCESS_READ)
+        if self.book[0:8] != BOOK_MAGIC:
+            self.close()
+            raise ValueError("Opening book " + book_filename + " is not a compiled book")
+        magic, version, count, book_fingerprint, node_count, edge_count = BOOK_HEADER.unpack_from(self.book, 0)
+        if version != BOOK_VERSION or book_fingerprint != hasher_fingerprint():
+            self.close()
+            raise ValueError("Opening book " + book_filename + " was compiled by a different version")
+        self.book_count = count
+        self.book_entries_offset = BOOK_HEADER.size + count * BOOK_KEY.size
+        self.book_nodes_offset = self.book_entries_offset + count * BOOK_ENTRY.size
+        self.book_edges_offset = self.book_nodes_offset + node_count * BOOK_NODE.size
+        self.book_strings_offset = self.book_edges_offset + edge_count * BOOK_EDGE.size
+        self.total_openings_loaded += count
+
+    def close(self):
+        if self.book is not None:
+            self.book.close()
+            self.book_file.close()
+            self.total_openings_loaded -= self.book_count
+        self.book_file = None
+        self.book = None
+        self.book_count = 0
+
+    def book_string(self, offset, length):
+        start = self.book_strings_offset + offset
+        return self.book[start:start + length].decode("utf-8")
+
+    def book_lookup(self, key):
+        """ Binary search of the binary book for a Zobrist hash, returning the opening name or None """
+        book = self.book
+        low = 0
+        high = self.book_count
+        while low < high:
+            middle = (low + high) // 2
+            middle_key = BOOK_KEY.unpack_from(book, BOOK_HEADER.size + middle * BOOK_KEY.size)[0]
+            if middle_key < key:
+                low = middle + 1
+            elif middle_key > key:
+                high = middle
+            else:
+                offset, length = BOOK_ENTRY.unpack_from(book, self.book_entries_offset + middle * BOOK_ENTRY.size)
+                return self.book_string(offset, length)
+        return None
+
     def find_opening(self, board):
-        fen_string = ""
-        for row in range(0, 8):
-            skip = 0
-            for col in range(0, 8):
-                c = board.squares[row][col]
-                if c == ".":
-                    skip += 1
-                else:
-                    if skip > 0:
-                        fen_string += str(skip)
-                        skip = 0
-                    fen_string += c
-            if skip > 0:
-                fen_string += str(skip)
-            if row != 7:
-                fen_string += "/"
-        return self.openings.get(fen_string)
-        
\ No newline at end of file
+        # Boards share Zobrist values (see zobrist.DEFAULT_SEED), so the hash identifies the position
+        name = self.openings.get(board.zobrist_hash)
+        if name is None and self.book is not None:
+            name = self.book_lookup(board.zobrist_hash)
+        return name
+
+    # Opening trie nodes are [name, {trie move: child}] lists for books loaded
+    # from tsv, or node indexes into the binary book once one has been opened
+
+    def trie_root(self):
+        return 0 if self.book is not None else self.trie
+
+    def trie_name(self, node):
+        """ Name of the opening line ending at the node, or None """
+        if self.book is None:
+            return node[0]
+        offset, length, first_edge, edge_count = BOOK_NODE.unpack_from(self.book, self.book_nodes_offset + node * BOOK_NODE.size)
+        return None if offset == NO_NAME else self.book_string(offset, length)
+
+    def trie_children(self, node):
+        """ List of (trie move, child node) """
+        if self.book is None:
+            return list(node[1].items())
+        offset, length, first_edge, edge_count = BOOK_NODE.unpack_from(self.book, self.book_nodes_offset + node * BOOK_NODE.size)
+        return [BOOK_EDGE.unpack_from(self.book, self.book_edges_offset + (first_edge + i) * BOOK_EDGE.size) for i in range(edge_count)]
+
+    def trie_child(self, node, move):
+        """ Child of the node reached by the trie move, or None """
+        if self.book is None:
+            return node[1].get(move)
+        for edge_move, child in self.trie_children(node):
+            if edge_move == move:
+                return child
+        return None
+
+class OpeningCursor():
+    """
+    Follows a game through the opening trie, one node per move.  Once a move
+    leaves the book the cursor stops looking anything up, and only counts the
+    moves played since, so that retreating past them returns it to the book.
+    A move off the trie's lines that transposes into a book position (by
+    Zobrist hash) keeps the cursor in the book until the next miss.
+    """
+
+    def __init__(self, openings):
+        self.openings = openings
+        self.reset()
+
+    def reset(self):
+        self.nodes = [self.openings.trie_root()] # Trie node at each ply, or None after a transposition
+        self.names = [None] # Opening name at each ply
+        self.out_of_book = 0 # Moves played since leaving the book
+
+    def in_book(self):
+        return self.out_of_book == 0
+
+    def advance(self, board):
+        """ Follow the last move made on the board, returning the opening name of the new position or None """
+        if self.out_of_book:
+            self.out_of_book += 1
+            return None
+        node = self.nodes[-1]
+        child = None
+        if node is not None:
+            child = self.openings.trie_child(node, trie_move(board.move_history[-1]))
+        if child is not None:
+            name = self.openings.trie_name(child)
+            if name is None:
+                # Lines pass through positions that other lines may name
+                name = self.openings.find_opening(board)
+        else:
+            name = self.openings.find_opening(board)
+            if name is None:
+                self.out_of_book = 1
+                return None
+        self.nodes.append(child)
+        self.names.append(name)
+        return name
+
+    def retreat(self):
+        """ Step back one move, as when the last move is unmade """
+        if self.out_of_book:
+            self.out_of_book -= 1
+        elif len(self.nodes) > 1:
+            self.nodes.pop()
+            self.names.pop()
+
+    def opening_name(self):
+        """ Name of the current position, or None """
+        return self.names[-1] if self.out_of_book == 0 else None
+
+    def continuations(self):
+        """ List of (move in long algebraic notation, opening name or None) of the book moves from here """
+        node = self.nodes[-1]
+        if self.out_of_book or node is None:
+            return []
+        return [(chess_board.move_to_uci(move), self.openings.trie_name(child)) for move, child in self.openings.trie_children(node)]
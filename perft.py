@@ -0,0 +1,195 @@
+import argparse
+import multiprocessing
+import time
+from collections import OrderedDict
+import bitboard_board
+import chess_board
+import rulebook as rules
+
+class PerftCache():
+    """
+    Bounded cache of perft node counts keyed by (Zobrist hash, depth).
+    Once max_entries is reached, the least recently used entry is evicted.
+    """
+
+    def __init__(self, max_entries = 1000000):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, zobrist_hash, depth):
+        key = (zobrist_hash, depth)
+        count = self.entries.get(key)
+        if count is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return count
+
+    def store(self, zobrist_hash, depth, count):
+        key = (zobrist_hash, depth)
+        self.entries[key] = count
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.max_entries:
+            self.entries.popitem(last = False)
+
+    def clear(self):
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+def perft(board, depth, cache = None):
+    """ Returns the number of leaf nodes of the legal move tree of the given depth """
+
+    if depth == 0:
+        return 1
+    if cache is not None:
+        count = cache.get(board.zobrist_hash, depth)
+        if count is not None:
+            return count
+
+    if depth == 1:
+        # Leaf nodes only need counting, not making
+        count = rules.count_legal_moves(board)
+    else:
+        count = 0
+        for start, moves in rules.compute_all_valid_moves(board).items():
+            for m in moves:
+                board.make_move(start[0], start[1], m[0], m[1])
+                count += perft(board, depth - 1, cache)
+                board.unmake_move()
+
+    if cache is not None:
+        cache.store(board.zobrist_hash, depth, count)
+    return count
+
+def divide(board, depth, cache = None):
+    """ Returns a list of (root move in long algebraic notation, node count) """
+
+    results = []
+    all_valid_moves = rules.compute_all_valid_moves(board)
+    for start, moves in all_valid_moves.items():
+        for m in moves:
+            board.make_move(start[0], start[1], m[0], m[1])
+            uci = chess_board.move_to_uci(board.move_history[-1])
+            results.append((uci, perft(board, depth - 1, cache)))
+            board.unmake_move()
+    return results
+
+def position_description(board):
+    """
+    Description of the board's position that can be sent to another process
+    """
+    return board.to_fen()
+
+def load_position_description(board, description):
+    """ Set up the board from a description made by position_description """
+    board.load_fen(description)
+
+# Each worker process keeps one board and cache for all of its subtrees, so
+# that cache entries from one subtree can be reused by the next
+worker_board = None
+worker_cache = None
+
+def init_worker(cache_size, board_type = chess_board.Board):
+    global worker_board, worker_cache
+    worker_board = board_type()
+    worker_cache = PerftCache(cache_size) if cache_size > 0 else None
+
+def perft_worker(task):
+    """ Returns (root move, node count) for a (root move, position description, depth) task """
+    root_uci, description, depth = task
+    load_position_description(worker_board, description)
+    return root_uci, perft(worker_board, depth, worker_cache)
+
+def parallel_divide(board, depth, processes = None, split_ply = 1, cache_size = 0):
+    """
+    Same as divide, but the subtrees are counted in a pool of worker processes.
+    With split_ply = 2 the work is split below each reply to each root move,
+    which gives many more, smaller tasks and so balances the load better.
+    """
+
+    if depth < split_ply:
+        return divide(board, depth)
+
+    # Build one task per subtree
+    tasks = []
+    root_moves = rules.compute_all_valid_moves(board)
+    for start, moves in root_moves.items():
+        for m in moves:
+            board.make_move(start[0], start[1], m[0], m[1])
+            root_uci = chess_board.move_to_uci(board.move_history[-1])
+            if split_ply == 1:
+                tasks.append((root_uci, position_description(board), depth - 1))
+            else:
+                replies = rules.compute_all_valid_moves(board)
+                if not any(replies.values()):
+                    # Checkmate or stalemate still needs its root move listed
+                    tasks.append((root_uci, position_description(board), depth - 1))
+                for reply_start, reply_moves in replies.items():
+                    for r in reply_moves:
+                        board.make_move(reply_start[0], reply_start[1], r[0], r[1])
+                        tasks.append((root_uci, position_description(board), depth - 2))
+                        board.unmake_move()
+            board.unmake_move()
+
+    # Sum the subtree counts by root move
+    counts = {}
+    # Workers use the same board backend as the given board
+    with multiprocessing.Pool(processes, init_worker, (cache_size, type(board))) as pool:
+        for root_uci, count in pool.imap_unordered(perft_worker, tasks):
+            counts[root_uci] = counts.get(root_uci, 0) + count
+    return list(counts.items())
+
+def run_perft(board, depth, cache = None, show_divide = False, processes = 1, split_ply = 1):
+    """
+    Runs perft, printing the divide breakdown if asked along with nodes per second.
+    With more than one process, the cache size (if any) is used for each worker's cache.
+    """
+
+    start_time = time.perf_counter()
+    if processes > 1:
+        cache_size = cache.max_entries if cache is not None else 0
+        results = sorted(parallel_divide(board, depth, processes, split_ply, cache_size))
+        cache = None
+    elif show_divide:
+        results = sorted(divide(board, depth, cache))
+    else:
+        results = None
+    if results is None:
+        nodes = perft(board, depth, cache)
+    else:
+        if show_divide:
+            for uci, count in results:
+                print(uci + ":", count)
+        nodes = sum(count for uci, count in results)
+    elapsed = time.perf_counter() - start_time
+
+    print("Depth:", depth)
+    print("Nodes:", nodes)
+    print("Time:", '{0:.2f}'.format(elapsed), "seconds")
+    print("NPS:", round(nodes / elapsed) if elapsed > 0 else 0)
+    if cache is not None:
+        print("Cache:", len(cache), "entries,", cache.hits, "hits,", cache.misses, "misses")
+    return nodes
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description = "Count the leaf nodes of the legal move tree (perft)")
+    parser.add_argument("depth", type = int)
+    parser.add_argument("--divide", action = "store_true", help = "print the node count below each root move")
+    parser.add_argument("--cache-size", type = int, default = 0, help = "entries in the perft cache (0 disables it)")
+    parser.add_argument("--processes", type = int, default = 1, help = "worker processes to split the root moves across")
+    parser.add_argument("--fen", default = chess_board.STARTING_FEN, help = "position to count from (default: the starting position)")
+    parser.add_argument("--split-ply", type = int, choices = [1, 2], default = 1, help = "ply at which to split work between processes")
+    parser.add_argument("--board", choices = sorted(bitboard_board.BOARD_TYPES), default = "list", help = "board backend to count with")
+    args = parser.parse_args()
+
+    cache = PerftCache(args.cache_size) if args.cache_size > 0 else None
+    board = bitboard_board.BOARD_TYPES[args.board].from_fen(args.fen)
+    run_perft(board, args.depth, cache, args.divide, args.processes, args.split_ply)
@@ -0,0 +1,246 @@
+import argparse
+import re
+import time
+from array import array
+import chess_board
+import rulebook as rules
+
+class PGNError(Exception):
+    """ A PGN game or move that cannot be read """
+    pass
+
+class UnsupportedPromotionError(PGNError):
+    """ A promotion to a piece other than a queen, which Board does not support """
+    pass
+
+# Movetext tokens: comments, NAGs, variation brackets, move numbers, results, and moves
+TOKEN_RE = re.compile(r"\{[^}]*\}|;[^\n]*|\$\d+|\(|\)|\d+\.+|1-0|0-1|1/2-1/2|\*|[^\s(){};$.]+")
+TAG_RE = re.compile(r'\[\s*(\w+)\s+"((?:[^"\\]|\\.)*)"\s*\]')
+SAN_RE = re.compile(r"([KQRBN])?([a-h])?([1-8])?x?([a-h][1-8])(?:=?([QRBN]))?$")
+RESULTS = ("1-0", "0-1", "1/2-1/2", "*")
+
+def san_to_move(san, board, checks_and_pins = None):
+    """
+    Returns (start row, start col, end row, end col) of the legal move given in
+    standard algebraic notation.  Only the pieces of the moving type that could
+    reach the target square have their legal moves generated.  checks_and_pins is
+    the result of rules.compute_checks_and_pins for the side to move, if known.
+    """
+
+    white = board.whites_turn
+    san = san.rstrip("+#!?")
+    if checks_and_pins is None:
+        checks_and_pins = rules.compute_checks_and_pins(white, board)
+
+    # Castling
+    if san in ("O-O", "0-0", "O-O-O", "0-0-0"):
+        row, col = board.king_square(white)
+        end_col = 6 if len(san) == 3 else 2
+        for m in rules.legal_moves(row, col, board, checks_and_pins):
+            if m[0] == row and m[1] == end_col:
+                return row, col, row, end_col
+        raise PGNError("Illegal castling move " + san)
+
+    match = SAN_RE.match(san)
+    if not match:
+        raise PGNError("Cannot read move " + san)
+    piece, from_file, from_rank, target, promotion = match.groups()
+    end_row, end_col = rules.notation_to_loc(target)
+    if promotion and promotion != "Q":
+        raise UnsupportedPromotionError("Promotion to a piece other than a queen in " + san)
+
+    # Pieces of the moving type that could make the move
+    if piece is None:
+        # A pawn either captures from the given file or pushes along the target's file
+        direction = 1 if white else -1
+        pawn = "P" if white else "p"
+        row = end_row + direction
+        if from_file is not None:
+            candidates = [(row, "abcdefgh".index(from_file))]
+        elif 0 <= row <= 7 and board.squares[row][end_col] == pawn:
+            candidates = [(row, end_col)]
+        else:
+            candidates = [(row + direction, end_col)]
+        candidates = [(r, c) for r, c in candidates if 0 <= r <= 7 and board.squares[r][c] == pawn]
+    else:
+        piece = piece if white else piece.lower()
+        candidates = []
+        for row, col in board.piece_squares[piece]:
+            if from_file is not None and col != "abcdefgh".index(from_file):
+                continue
+            if from_rank is not None and row != 8 - int(from_rank):
+                continue
+            # Skip pieces that are not on a line (or knight step) to the target
+            dr = abs(row - end_row)
+            dc = abs(col - end_col)
+            if piece in "Nn" and (end_row, end_col) not in rules.KNIGHT_TARGETS[row][col]:
+                continue
+            if piece in "Bb" and dr != dc:
+                continue
+            if piece in "Rr" and dr != 0 and dc != 0:
+                continue
+            if piece in "Qq" and dr != dc and dr != 0 and dc != 0:
+                continue
+            candidates.append((row, col))
+
+    found = None
+    for row, col in candidates:
+        for m in rules.legal_moves(row, col, board, checks_and_pins):
+            if m[0] == end_row and m[1] == end_col:
+                if found is not None:
+                    raise PGNError("Ambiguous move " + san)
+                found = (row, col, end_row, end_col)
+                break
+    if found is None:
+        raise PGNError("Illegal move " + san)
+    return found
+
+class PGNGame():
+    """
+    A game read from a PGN file: its tags, the FEN of its starting position,
+    its moves in SAN and packed with chess_board.encode_move, and its result
+    """
+
+    def __init__(self, tags, fen, san_moves, moves, result):
+        self.tags = tags
+        self.fen = fen
+        self.san_moves = san_moves
+        self.moves = moves
+        self.result = result
+
+    def uci_moves(self):
+        return [chess_board.move_to_uci(m) for m in self.moves]
+
+class PGNReader():
+    """
+    Streaming reader of PGN files.  Games are read and yielded one at a time, so
+    files of any size can be processed in constant memory.  Each game's moves are
+    played on self.board, which holds the game's final position while the game is
+    being handled by the caller.
+    """
+
+    def __init__(self, board = None):
+        self.board = board if board is not None else chess_board.Board()
+        self.games_read = 0
+        self.games_skipped = 0
+        self.errors = 0
+
+    def sections(self, f, keep_movetext = True):
+        """
+        Generator of (tags, movetext) for each game in the open file f.  Movetext is
+        only collected if keep_movetext is True; otherwise it is None.
+        """
+        tags = {}
+        movetext = []
+        in_movetext = False
+        comment_depth = 0
+        for line in f:
+            stripped = line.strip()
+            if stripped.startswith("[") and comment_depth == 0:
+                if in_movetext:
+                    yield tags, "".join(movetext) if keep_movetext else None
+                    tags = {}
+                    movetext = []
+                    in_movetext = False
+                match = TAG_RE.match(stripped)
+                if match:
+                    tags[match.group(1)] = match.group(2).replace('\\"', '"').replace("\\\\", "\\")
+            elif stripped and not stripped.startswith("%"):
+                in_movetext = True
+                # Track comments spanning lines, so a line in one starting with "[" is not a tag
+                if "{" in line or "}" in line:
+                    comment_depth = max(0, comment_depth + line.count("{") - line.count("}"))
+                if keep_movetext:
+                    movetext.append(line)
+        if in_movetext or tags:
+            yield tags, "".join(movetext) if keep_movetext else None
+
+    def scan_tags(self, f):
+        """ Generator of the tags of each game, without reading the moves """
+        for tags, movetext in self.sections(f, False):
+            yield tags
+
+    def play_movetext(self, movetext, fen = chess_board.STARTING_FEN):
+        """
+        Set up the board from the FEN and play the main line of the movetext,
+        returning (SAN moves, result)
+        """
+        board = self.board
+        try:
+            board.load_fen(fen)
+        except ValueError as e:
+            raise PGNError(str(e))
+        san_moves = []
+        result = "*"
+        variation_depth = 0
+        for token in TOKEN_RE.findall(movetext):
+            first = token[0]
+            if first == "(":
+                variation_depth += 1
+            elif first == ")":
+                variation_depth -= 1
+            elif variation_depth > 0 or first in "{;$" or token[-1] == ".":
+                continue
+            elif token in RESULTS:
+                result = token
+            else:
+                start_row, start_col, end_row, end_col = san_to_move(token, board)
+                board.make_move(start_row, start_col, end_row, end_col)
+                san_moves.append(token)
+        return san_moves, result
+
+    def games(self, f, tag_filter = None, skip_errors = False):
+        """
+        Generator of PGNGame for each game in the open file f.  If tag_filter is given,
+        it is called with each game's tags and games for which it returns False are
+        skipped without reading their moves.  If skip_errors is True, games that
+        cannot be read are skipped (and counted in self.errors) instead of raising PGNError.
+        """
+        for number, (tags, movetext) in enumerate(self.sections(f, True), 1):
+            if tag_filter is not None and not tag_filter(tags):
+                self.games_skipped += 1
+                continue
+            try:
+                fen = tags.get("FEN", chess_board.STARTING_FEN)
+                san_moves, result = self.play_movetext(movetext, fen)
+            except PGNError as e:
+                if not skip_errors:
+                    raise type(e)("Game " + str(number) + ": " + str(e))
+                self.errors += 1
+                continue
+            self.games_read += 1
+            yield PGNGame(tags, fen, san_moves, array("H", self.board.move_history), tags.get("Result", result))
+
+def read_games(filename, tag_filter = None, skip_errors = False):
+    """ Generator of PGNGame for each game in the named PGN file """
+    reader = PGNReader()
+    with open(filename) as f:
+        yield from reader.games(f, tag_filter, skip_errors)
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description = "Read every game of a PGN file through the rules engine")
+    parser.add_argument("filename")
+    parser.add_argument("--tags-only", action = "store_true", help = "only scan the tags of each game")
+    args = parser.parse_args()
+
+    start_time = time.perf_counter()
+    reader = PGNReader()
+    count = 0
+    moves = 0
+    with open(args.filename) as f:
+        if args.tags_only:
+            for tags in reader.scan_tags(f):
+                count += 1
+        else:
+            for game in reader.games(f, skip_errors = True):
+                count += 1
+                moves += len(game.moves)
+    elapsed = time.perf_counter() - start_time
+
+    print("Games:", count)
+    if not args.tags_only:
+        print("Moves:", moves)
+        print("Unreadable games:", reader.errors)
+    print("Time:", '{0:.2f}'.format(elapsed), "seconds")
+    print("Games per second:", round(count / elapsed) if elapsed > 0 else 0)
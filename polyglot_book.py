@@ -0,0 +1,117 @@
+import mmap
+import random
+import struct
+import rulebook as rules
+import zobrist
+
+# Polyglot books are files of 16 byte big-endian entries sorted by key: the Polyglot
+# Zobrist key of the position, the move, its weight, and a learning value (unused).
+# See http://hgm.nubati.net/book_format.html for the format.
+POLYGLOT_ENTRY = struct.Struct(">QHHI")
+POLYGLOT_KEY = struct.Struct(">Q")
+
+# Polyglot writes castling as the king capturing its own rook
+POLYGLOT_CASTLING = {(7, 4, 7, 7):(7, 4, 7, 6), (7, 4, 7, 0):(7, 4, 7, 2),
+                     (0, 4, 0, 7):(0, 4, 0, 6), (0, 4, 0, 0):(0, 4, 0, 2)}
+POLYGLOT_QUEEN_PROMOTION = 4
+
+def decode_polyglot_move(move):
+    """ Returns (start row, start col, end row, end col, promotion piece) of a Polyglot move """
+    end_col = move & 0x7
+    end_row = 7 - ((move >> 3) & 0x7)
+    start_col = (move >> 6) & 0x7
+    start_row = 7 - ((move >> 9) & 0x7)
+    return start_row, start_col, end_row, end_col, (move >> 12) & 0x7
+
+class PolyglotBook():
+    """
+    Reader of Polyglot .bin opening books.  The book is memory-mapped and only the
+    entries of positions looked up are read, found by binary search on the sorted keys.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.hasher = zobrist.ZobristHasher(polyglot = True)
+        self.book_file = open(filename, "rb")
+        try:
+            self.book = mmap.mmap(self.book_file.fileno(), 0, access = mmap.ACCESS_READ)
+        except ValueError:
+            # An empty file cannot be mapped
+            self.book_file.close()
+            raise ValueError("Polyglot book " + filename + " is empty")
+        if len(self.book) % POLYGLOT_ENTRY.size != 0:
+            self.close()
+            raise ValueError("Polyglot book " + filename + " is not a whole number of entries")
+        self.count = len(self.book) // POLYGLOT_ENTRY.size
+
+    def close(self):
+        if self.book is not None:
+            self.book.close()
+            self.book_file.close()
+        self.book = None
+
+    def key(self, board):
+        return self.hasher.full_hash(board)
+
+    def entries(self, key):
+        """ List of (move, weight) of the book entries with the key """
+        book = self.book
+        low = 0
+        high = self.count
+        # Find the first entry with the key, since a position may have several
+        while low < high:
+            middle = (low + high) // 2
+            if POLYGLOT_KEY.unpack_from(book, middle * POLYGLOT_ENTRY.size)[0] < key:
+                low = middle + 1
+            else:
+                high = middle
+        found = []
+        while low < self.count:
+            entry_key, move, weight, learn = POLYGLOT_ENTRY.unpack_from(book, low * POLYGLOT_ENTRY.size)
+            if entry_key != key:
+                break
+            found.append((move, weight))
+            low += 1
+        return found
+
+    def find_moves(self, board):
+        """
+        List of (start row, start col, end row, end col, weight) of the book moves
+        of the board's position.  Moves that are not legal on the board (such as
+        those of a colliding key) and underpromotions, which the board does not
+        support, are left out.
+        """
+        moves = []
+        checks_and_pins = None
+        for move, weight in self.entries(self.key(board)):
+            start_row, start_col, end_row, end_col, promotion = decode_polyglot_move(move)
+            if promotion != 0 and promotion != POLYGLOT_QUEEN_PROMOTION:
+                continue
+            piece = board.squares[start_row][start_col]
+            if piece == "." or (piece in "KQRBNP") != board.whites_turn:
+                continue
+            if piece in "Kk":
+                start_row, start_col, end_row, end_col = POLYGLOT_CASTLING.get((start_row, start_col, end_row, end_col), (start_row, start_col, end_row, end_col))
+            if checks_and_pins is None:
+                checks_and_pins = rules.compute_checks_and_pins(board.whites_turn, board)
+            for m in rules.legal_moves(start_row, start_col, board, checks_and_pins):
+                if m[0] == end_row and m[1] == end_col:
+                    moves.append((start_row, start_col, end_row, end_col, weight))
+                    break
+        return moves
+
+    def choose_move(self, board, weighted = True):
+        """
+        Returns (start row, start col, end row, end col) of a book move of the board's
+        position, or None if it is not in the book.  If weighted is True the move is
+        picked at random in proportion to the book weights; otherwise the move with
+        the highest weight is played.
+        """
+        moves = self.find_moves(board)
+        if not moves:
+            return None
+        if weighted and sum(m[4] for m in moves) > 0:
+            move = random.choices(moves, weights = [m[4] for m in moves])[0]
+        else:
+            move = max(moves, key = lambda m: m[4])
+        return move[0:4]
@@ -1,3 +1,5 @@
+import bitboard_board
+
 def loc_to_notation(row, col):
     return "abcdefgh"[col] + str(8-row)
 
@@ -6,7 +8,13 @@ def notation_to_loc(n):
     row = 8-int(n[1])
     return row, col
 
-def algebraic_notation(start_row, start_col, end_row, end_col, all_valid_moves, board):
+def algebraic_notation(start_row, start_col, end_row, end_col, all_valid_moves, board, targets = None):
+    """
+    Standard algebraic notation of a move, where all_valid_moves is the result of
+    compute_all_valid_moves for the board.  targets is the matching target square
+    index (see compute_all_valid_moves); if it is not given, the entries for the
+    move's target square are found from all_valid_moves.
+    """
 
     piece = board.squares[start_row][start_col]
     piece_upper = piece.upper()
@@ -33,25 +41,22 @@ def algebraic_notation(start_row, start_col, end_row, end_col, all_valid_moves,
             notation += loc_to_notation(start_row, start_col)[0]
         elif piece_upper != "P":
             notation += piece_upper
-            # Check for ambiguity
+            # Check for ambiguity among the other pieces that can reach the target square
             ambiguous = False
             same_file = False
             same_rank = False
-            for row in range(8):
-                for col in range(8):
-                    if (row, col) != (start_row, start_col) and (row, col) in all_valid_moves:
-                        moves = all_valid_moves[(row, col)]
-                        if (moves and piece_upper == board.squares[row][col].upper() and 
-                            ( (end_row, end_col, False, False) in moves or
-                              (end_row, end_col, True, False) in moves or
-                              (end_row, end_col, False, True) in moves or
-                              (end_row, end_col, False, True) in moves) ):
-                            # This piece is making the notation ambiguous
-                            ambiguous = True
-                            if start_col == col:
-                                same_file = True
-                            if start_row == row:
-                                same_rank = True
+            if targets is None:
+                origins = [(origin, m) for origin, moves in all_valid_moves.items() for m in moves if m[0] == end_row and m[1] == end_col]
+            else:
+                origins = targets.get((end_row, end_col), [])
+            for (row, col), m in origins:
+                if (row, col) != (start_row, start_col) and piece_upper == board.squares[row][col].upper():
+                    # This piece is making the notation ambiguous
+                    ambiguous = True
+                    if start_col == col:
+                        same_file = True
+                    if start_row == row:
+                        same_rank = True
             if ambiguous:
                 if not same_file:
                     notation += loc_to_notation(start_row, start_col)[0]
@@ -67,7 +72,7 @@ def algebraic_notation(start_row, start_col, end_row, end_col, all_valid_moves,
 
     return notation
         
-def check_for_terminal_states_and_king_checks(board, any_valid_moves):
+def check_for_terminal_states_and_king_checks(board, any_valid_moves = None):
     """
     Returns two values:
         1) True if game is over, False otherwise
@@ -76,11 +81,14 @@ def check_for_terminal_states_and_king_checks(board, any_valid_moves):
                0 for stalemate
                0.1 for draw by insufficient material
                0.2 for draw by three-fold repetition
+               0.3 for draw by the fifty-move rule
                1 for white win
            If above is False:
               -1 for black is checking the white king
               1 for white is checking the black king
               0 otherwise
+    If any_valid_moves is None, whether the side to move has any legal move is
+    worked out here, stopping at the first one found.
     """
     
     # Draw by insufficient material
@@ -93,25 +101,26 @@ def check_for_terminal_states_and_king_checks(board, any_valid_moves):
     # Compute any checks
     in_check = is_king_in_check(board.whites_turn, board)
 
+    if any_valid_moves is None:
+        any_valid_moves = are_there_any_valid_moves(board)
+
     # Stalemate
     if not in_check and not any_valid_moves:
         return True, 0
 
-    # Checks and checkmates
-    if board.whites_turn:
-        if in_check and not any_valid_moves:
-            # Checkmate, black wins
-            return True, -1
-        if in_check:
-            # Black is checking white king
-            return False, -1
-    else:
-        if in_check and not any_valid_moves:
-            # Checkmate, white wins
-            return True, 1
-        if in_check:
-            # White is checking black king
-            return False, 1
+    # Checkmates
+    if in_check and not any_valid_moves:
+        # Black wins if white is checkmated, and vice versa
+        return True, -1 if board.whites_turn else 1
+
+    # The fifty-move rule applies only once checkmate has been ruled out
+    if is_draw_by_fifty_move_rule(board):
+        return True, 0.3
+
+    # Checks
+    if in_check:
+        # -1 if black is checking the white king, 1 if white is checking the black king
+        return False, -1 if board.whites_turn else 1
         
     # No special states
     return False, 0
@@ -120,15 +129,47 @@ def check_for_terminal_states_and_king_checks(board, any_valid_moves):
 def in_bounds(row, col):
     return row >= 0 and row <= 7 and col >= 0 and col <= 7
 
+def build_step_targets(offsets):
+    """ Returns an 8x8 table holding, for each square, the in-bounds squares reached by the offsets """
+    return [ [ [(row + dr, col + dc) for dr, dc in offsets if in_bounds(row + dr, col + dc)]
+               for col in range(8) ] for row in range(8) ]
+
+def build_rays(directions):
+    """ Returns an 8x8 table holding, for each square, a dict of direction -> squares along that ray """
+    rays = [ [ {} for col in range(8) ] for row in range(8) ]
+    for row in range(8):
+        for col in range(8):
+            for dr, dc in directions:
+                ray = []
+                r = row + dr
+                c = col + dc
+                while in_bounds(r, c):
+                    ray.append((r, c))
+                    r += dr
+                    c += dc
+                rays[row][col][(dr, dc)] = ray
+    return rays
+
+# Precomputed move tables, built once at import so that move generation
+# and check detection iterate only on-board squares
+ROOK_DIRECTIONS = [(-1, 0), (1, 0), (0, -1), (0, 1)]
+BISHOP_DIRECTIONS = [(-1, -1), (-1, 1), (1, -1), (1, 1)]
+QUEEN_DIRECTIONS = ROOK_DIRECTIONS + BISHOP_DIRECTIONS
+KNIGHT_TARGETS = build_step_targets([(-2, -1), (-1, -2), (-2, 1), (-1, 2), (2, -1), (1, -2), (2, 1), (1, 2)])
+KING_TARGETS = build_step_targets([(-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, -1), (1, 0), (1, 1)])
+WHITE_PAWN_CAPTURE_TARGETS = build_step_targets([(-1, -1), (-1, 1)])
+BLACK_PAWN_CAPTURE_TARGETS = build_step_targets([(1, 1), (1, -1)])
+RAYS = build_rays(QUEEN_DIRECTIONS)
+
 def is_draw_by_insufficient_material(board):
-    all_pieces = [board.squares[i][j] for i in range(8) for j in range(8) if board.squares[i][j] != "."]
+    counts = board.piece_counts
 
     # If there are any queens, rooks, or pawns on the board, it's not a draw
-    if "Q" in all_pieces or "R" in all_pieces or "P" in all_pieces or "q" in all_pieces or "r" in all_pieces or "p" in all_pieces:
+    if counts["Q"] or counts["R"] or counts["P"] or counts["q"] or counts["r"] or counts["p"]:
         return False
     
     # If both sides have at most a single knight or bishop left, it's a draw
-    if all_pieces.count("b") + all_pieces.count("n") <= 1 and all_pieces.count("B") + all_pieces.count("N") <= 1:
+    if counts["b"] + counts["n"] <= 1 and counts["B"] + counts["N"] <= 1:
         return True
 
     # Any other case, it's not a draw
@@ -136,101 +177,135 @@ def is_draw_by_insufficient_material(board):
 
 def is_draw_by_threefold_repeition(board):
 
-    # Check if the current Zobrist hash has been repeated twice before.
-    # Note the hash will only be the same if its the same player's turn,
-    # so we can skip every other element in the list
-    hash = board.zobrist_hash
-    appearances = 0
-    check = True
-    for i in reversed(board.zobrist_history):
-        if check and hash == i:
-            appearances += 1 # Note the first entry we check will be an "appearance"
-        if appearances == 3:
+    # Check if the current Zobrist hash has occurred three times, counting the
+    # initial position.  Positions can only repeat within the moves since the last
+    # capture or pawn move, and each repetition takes at least four of them.
+    if board.halfmove_clock < 8:
+        return False
+    return board.position_counts.get(board.zobrist_hash, 0) >= 3
+
+def is_draw_by_fifty_move_rule(board):
+
+    # Fifty moves by each player without a capture or pawn move
+    return board.halfmove_clock >= 100
+
+def is_square_attacked(board, row, col, by_white, ignore = None):
+    """
+    Returns True if the square is attacked by white (by_white) or black pieces.
+    If ignore is a (row, col), that square is treated as empty, which lets a king
+    test the squares it is moving to without shielding them from sliding pieces.
+    """
+
+    if board.uses_bitboards:
+        occupancy = board.occupancy
+        if ignore is not None:
+            occupancy &= ~bitboard_board.square_bit(ignore[0], ignore[1])
+        return bitboard_board.is_square_attacked(board, row * 8 + col, by_white, occupancy)
+
+    squares = board.squares
+    if by_white:
+        knight, pawn, king, straight_attackers, diagonal_attackers = "N", "P", "K", "RQ", "BQ"
+        # A white pawn attacks the square if it stands where a black pawn on the square would attack
+        pawn_sources = BLACK_PAWN_CAPTURE_TARGETS[row][col]
+    else:
+        knight, pawn, king, straight_attackers, diagonal_attackers = "n", "p", "k", "rq", "bq"
+        pawn_sources = WHITE_PAWN_CAPTURE_TARGETS[row][col]
+
+    # Check for knights first
+    for r, c in KNIGHT_TARGETS[row][col]:
+        if squares[r][c] == knight:
             return True
-        check = not check
-    return False
 
-def fast_straight_probe(white_king, board, target_row, target_col, row_direction, col_direction):
-    a_row = target_row + row_direction
-    a_col = target_col + col_direction
-    step = 1
-    while in_bounds(a_row, a_col):
-        piece = board.squares[a_row][a_col]
-        if step == 1:
-            if (not white_king and piece == "K" or
-                white_king and piece == "k"):
-                return True
-        if row_direction == 0 or col_direction == 0:
-            # Non-diagonal
-            if (not white_king and piece in "RQ" or
-                white_king and piece in "rq"):
-                return True
-        else:
-            # Diagonal
-            if (not white_king and piece in "BQ" or
-                white_king and piece in "bq"):
-                return True
-        if piece != ".":
-            return False
-        a_row += row_direction
-        a_col += col_direction
-        step += 1
+    # Check for pawns next
+    for r, c in pawn_sources:
+        if squares[r][c] == pawn:
+            return True
+
+    # Check for the opposing king
+    for r, c in KING_TARGETS[row][col]:
+        if squares[r][c] == king:
+            return True
+
+    # Check for bishops, rooks, and queens
+    for direction in QUEEN_DIRECTIONS:
+        attackers = straight_attackers if direction[0] == 0 or direction[1] == 0 else diagonal_attackers
+        for r, c in RAYS[row][col][direction]:
+            piece = squares[r][c]
+            if piece != "." and (r, c) != ignore:
+                if piece in attackers:
+                    return True
+                break
+
     return False
 
 def is_king_in_check(white_king, board):
     """ If white_king is True, return True if white king is in check; same with black"""
-
-    # Find the king
-    king_pos = (-1, -1)
-    for row in range(8):
-        for col in range(8):
-            if white_king and board.squares[row][col] == "K" or not white_king and board.squares[row][col] == "k":
-                king_pos = (row, col)
-                break
-        if king_pos != (-1, -1):
-            break
-    else:
+    king_row, king_col = board.king_square(white_king)
+    if king_row == -1:
         print("ERROR: Cannot find king in board " + str(board.squares))
         return False
+    return is_square_attacked(board, king_row, king_col, not white_king)
 
-    # Check for checks with knights first
-    for i in [(-1, -2), (-1, 2), (1, -2), (1, 2), (-2, -1), (-2, 1), (2, -1), (2, 1)]:
-        a_row = king_pos[0] + i[0]
-        a_col = king_pos[1] + i[1]
-        if in_bounds(a_row, a_col):
-            if (not white_king and board.squares[a_row][a_col] == "N" or
-                white_king and board.squares[a_row][a_col] == "n"):
-                return True
-            
-    # Check for checks with pawns next
-    if white_king:
-        if in_bounds(king_pos[0] - 1, king_pos[1] - 1) and board.squares[king_pos[0] - 1][king_pos[1] - 1] == "p":
-            return True
-        if in_bounds(king_pos[0] - 1, king_pos[1] + 1) and board.squares[king_pos[0] - 1][king_pos[1] + 1] == "p":
-            return True
+def compute_checks_and_pins(white, board):
+    """
+    Finds everything needed to generate legal moves for the white (or black) side.
+    Returns three values:
+        1) List of (row, col) of the opposing pieces giving check
+        2) Set of squares a non-king move must land on to resolve a single check
+           (the checker plus any squares between it and the king), or None if not in check
+        3) Dict of (row, col) of each pinned piece -> set of squares it may still move to
+           (the pin ray between the king and the pinner, including the pinner)
+    """
+    checkers = []
+    block_squares = None
+    pins = {}
+    king_row, king_col = board.king_square(white)
+    if king_row == -1:
+        return checkers, block_squares, pins
+    squares = board.squares
+
+    if white:
+        own, knight, pawn, straight_attackers, diagonal_attackers = "KQRNBP", "n", "p", "rq", "bq"
+        pawn_sources = WHITE_PAWN_CAPTURE_TARGETS[king_row][king_col]
     else:
-        if in_bounds(king_pos[0] + 1, king_pos[1] - 1) and board.squares[king_pos[0] + 1][king_pos[1] - 1] == "P":
-            return True
-        if in_bounds(king_pos[0] + 1, king_pos[1] + 1) and board.squares[king_pos[0] + 1][king_pos[1] + 1] == "P":
-            return True
-        
-    # Check for checks with bishops, rooks, queens, and kings
-    for direction in [(-1, 0), (-1, 1), (0, 1), (1, 1), (1, 0), (1, -1), (0, -1), (-1, -1)]:
-        if fast_straight_probe(white_king, board, king_pos[0], king_pos[1], direction[0], direction[1]):
-            return True
+        own, knight, pawn, straight_attackers, diagonal_attackers = "kqrnbp", "N", "P", "RQ", "BQ"
+        pawn_sources = BLACK_PAWN_CAPTURE_TARGETS[king_row][king_col]
+
+    # Knight and pawn checks can only be resolved by capturing the checker
+    for r, c in KNIGHT_TARGETS[king_row][king_col]:
+        if squares[r][c] == knight:
+            checkers.append((r, c))
+            block_squares = {(r, c)}
+    for r, c in pawn_sources:
+        if squares[r][c] == pawn:
+            checkers.append((r, c))
+            block_squares = {(r, c)}
+
+    # Walk each ray out from the king.  An opposing slider with only one of our
+    # pieces in between pins that piece; with nothing in between it gives check.
+    for direction in QUEEN_DIRECTIONS:
+        attackers = straight_attackers if direction[0] == 0 or direction[1] == 0 else diagonal_attackers
+        ray_squares = set()
+        pinned = None
+        for r, c in RAYS[king_row][king_col][direction]:
+            piece = squares[r][c]
+            ray_squares.add((r, c))
+            if piece == ".":
+                continue
+            if piece in own:
+                if pinned is not None:
+                    break
+                pinned = (r, c)
+            else:
+                if piece in attackers:
+                    if pinned is None:
+                        checkers.append((r, c))
+                        block_squares = ray_squares
+                    else:
+                        pins[pinned] = ray_squares
+                break
 
-    # TODO -- remove this block! Check for checks
-    """for row in range(8):
-        for col in range(8):
-            attacker = board.squares[row][col]
-            if attacker in opp_pieces:
-                moves = valid_moves(row, col, board, False)
-                for m in moves:
-                    if king_pos[0] == m[0] and king_pos[1] == m[1]:
-                        return True"""
-
-    # If we made it this far, there are no checks
-    return False
+    return checkers, block_squares, pins
 
 def prune_moves_to_avoid_checks(row, col, moves, board):
     """ Get rid of moves that have us in check after they are made """
@@ -246,32 +321,164 @@ def prune_moves_to_avoid_checks(row, col, moves, board):
         board.unmake_move()
     return pruned_moves
 
+def legal_moves(row, col, board, checks_and_pins):
+    """
+    Legal moves of the piece on (row, col), given the result of compute_checks_and_pins
+    for its side.  Only en passant captures, which can expose the king along the rank
+    of both pawns, are verified by making and unmaking the move.
+    """
+    checkers, block_squares, pins = checks_and_pins
+    piece = board.squares[row][col]
+    white = piece in "KQRNBP"
+    moves = valid_moves(row, col, board, False)
+
+    # The king may go to any square not attacked once it has stepped off its own square
+    if piece in "Kk":
+        legal = []
+        for m in moves:
+            if not is_square_attacked(board, m[0], m[1], not white, (row, col)):
+                legal.append(m)
+        if not checkers:
+            legal.extend(castling_moves(white, board))
+        return legal
+
+    # Only the king can get out of a double check
+    if len(checkers) > 1:
+        return []
+
+    allowed = pins.get((row, col))
+    legal = []
+    for m in moves:
+        if m[2]:
+            legal.extend(prune_moves_to_avoid_checks(row, col, [m], board))
+            continue
+        if allowed is not None and (m[0], m[1]) not in allowed:
+            continue
+        if block_squares is not None and (m[0], m[1]) not in block_squares:
+            continue
+        legal.append(m)
+    return legal
+
+def generate_legal_moves(board, captures_first = True):
+    """
+    Yields the legal moves of the side to move one at a time as ((row, col), move),
+    so callers that only need the first few moves can stop early.  With captures_first,
+    every capture is yielded before any quiet move; otherwise moves are yielded piece
+    by piece.  The board must not be changed until the generator is finished with.
+    """
+    checks_and_pins = compute_checks_and_pins(board.whites_turn, board)
+    # Snapshot the squares, since an en passant check makes and unmakes a move
+    squares = list(board.occupied_squares(board.whites_turn))
+    if not captures_first:
+        for row, col in squares:
+            for m in legal_moves(row, col, board, checks_and_pins):
+                yield (row, col), m
+        return
+
+    # Keep each piece's quiet moves for the second phase rather than generating them twice
+    quiet_moves = []
+    for row, col in squares:
+        moves = legal_moves(row, col, board, checks_and_pins)
+        for m in moves:
+            if m[3]:
+                yield (row, col), m
+        quiet_moves.append(((row, col), moves))
+    for start, moves in quiet_moves:
+        for m in moves:
+            if not m[3]:
+                yield start, m
+
 def are_there_any_valid_moves(board):
-    for row in range(8):
-        for col in range(8):
-            piece = board.squares[row][col]
-            if board.whites_turn and piece in "KQRNBP" or not board.whites_turn and piece in "kqrnbp":
-                if len(valid_moves(row, col, board, True)) > 0:
-                    return True
-    return False
+    return next(generate_legal_moves(board, False), None) is not None
+
+def compute_all_valid_moves(board, targets = None):
+    """
+    Returns the legal moves of the side to move, keyed by the (row, col) of each piece.
+    If a targets dictionary is given, it is also filled with the reverse index: key is
+    the (row, col) of a target square, value is a list of (origin (row, col), move)
+    for every legal move to that square.
+    """
+    # Bitboard boards generate every piece's moves at once from masks
+    if board.uses_bitboards:
+        return bitboard_board.compute_all_valid_moves(board, targets)
 
-def compute_all_valid_moves(board):
     all_moves = {} # key is (row, col), value is list of valid moves (new row, new col, is en passant?, is capture?) for the piece
-    for row in range(8):
-        for col in range(8):
-            piece = board.squares[row][col]
-            if board.whites_turn and piece in "KQRNBP" or not board.whites_turn and piece in "kqrnbp":
-                all_moves[(row, col)] = valid_moves(row, col, board, True)
+    checks_and_pins = compute_checks_and_pins(board.whites_turn, board)
+    # Snapshot the squares, since an en passant check makes and unmakes a move
+    for row, col in list(board.occupied_squares(board.whites_turn)):
+        moves = legal_moves(row, col, board, checks_and_pins)
+        all_moves[(row, col)] = moves
+        if targets is not None:
+            for m in moves:
+                target = (m[0], m[1])
+                if target in targets:
+                    targets[target].append(((row, col), m))
+                else:
+                    targets[target] = [((row, col), m)]
     return all_moves
 
+def count_legal_moves(board):
+    """ Number of legal moves of the side to move """
+    if board.uses_bitboards:
+        return bitboard_board.count_legal_moves(board)
+    return sum(len(moves) for moves in compute_all_valid_moves(board).values())
+
+def castling_moves(white, board):
+    """
+    Castling moves available to the white (or black) king on its home square.
+    The board's castling rights already record whether the king or rook has
+    moved or the rook was captured, so only the squares need checking here.
+    """
+    moves = []
+    if white:
+        home_row, enemy_is_white = 7, False
+        ks_rights, qs_rights = board.white_ks_castling_rights, board.white_qs_castling_rights
+    else:
+        home_row, enemy_is_white = 0, True
+        ks_rights, qs_rights = board.black_ks_castling_rights, board.black_qs_castling_rights
+    if not ks_rights and not qs_rights:
+        return moves
+    row = board.squares[home_row]
+
+    # Ensure king is not in check
+    if is_square_attacked(board, home_row, 4, enemy_is_white):
+        return moves
+
+    # Short castle: squares between king and rook are empty and the king does not go through check
+    if (ks_rights and row[5] == "." and row[6] == "." and
+        not is_square_attacked(board, home_row, 5, enemy_is_white) and
+        not is_square_attacked(board, home_row, 6, enemy_is_white)):
+        moves.append((home_row, 6, False, False))
+
+    # Long castle: the b-file square must be empty but may be attacked
+    if (qs_rights and row[3] == "." and row[2] == "." and row[1] == "." and
+        not is_square_attacked(board, home_row, 3, enemy_is_white) and
+        not is_square_attacked(board, home_row, 2, enemy_is_white)):
+        moves.append((home_row, 2, False, False))
+
+    return moves
+
 def valid_moves(row, col, board, check_for_checks):
+    """
+    Moves of the piece on (row, col).  If check_for_checks is True these are the
+    legal moves, including castling.  Otherwise they are pseudo-legal moves that
+    ignore checks and leave out castling, since castling cannot capture a king.
+    """
+
+    if check_for_checks:
+        white = board.squares[row][col] in "KQRNBP"
+        return legal_moves(row, col, board, compute_checks_and_pins(white, board))
 
     # Moves is a list of (new row, new col, is en passant?, is capture?) - all moves for the piece on row, col
     moves = []
     piece = board.squares[row][col]
 
+    # Bitboard boards generate knight, bishop, rook, queen, and king moves set-wise
+    if board.uses_bitboards and piece in "KQRBNkqrbn":
+        moves = bitboard_board.piece_moves(row, col, board)
+
     # White pawn
-    if piece == "P":
+    elif piece == "P":
         # Move "up" to an empty space
         if row >= 1 and board.squares[row-1][col] == ".":
             moves.append((row-1, col, False, False))
@@ -279,21 +486,13 @@ def valid_moves(row, col, board, check_for_checks):
         if row == 6 and board.squares[row-1][col] == "." and board.squares[row-2][col] == ".":
             moves.append((row-2, col, False, False))
         # Capture diagonally
-        if row >= 1 and col >= 1 and board.squares[row-1][col-1] in "kqrnbp":
-            moves.append((row-1, col-1, False, True))
-        if row >= 1 and col <= 6 and board.squares[row-1][col+1] in "kqrnbp":
-            moves.append((row-1, col+1, False, True))
-        # En passant
-        if board.move_history:
-            last_move = board.move_history[-1]
-            if (row == 3 and col >= 1 and board.squares[2][col-1] == "." and
-                last_move[4] == "p" and last_move[0] == 1 and last_move[1] == col-1 and
-                last_move[2] == 3 and last_move[3] == col-1):
-                moves.append((row-1, col-1, True, True))
-            if (row == 3 and col <= 6 and board.squares[2][col+1] == "." and
-                last_move[4] == "p" and last_move[0] == 1 and last_move[1] == col+1 and
-                last_move[2] == 3 and last_move[3] == col+1):
-                moves.append((row-1, col+1, True, True))
+        for r, c in WHITE_PAWN_CAPTURE_TARGETS[row][col]:
+            if board.squares[r][c] in "kqrnbp":
+                moves.append((r, c, False, True))
+        # En passant, onto the square the black pawn just passed over
+        ep_row, ep_col = board.en_passant_rights
+        if ep_row == 2 and row == 3 and abs(ep_col - col) == 1:
+            moves.append((ep_row, ep_col, True, True))
 
     # Black pawn
     elif piece == "p":
@@ -304,151 +503,29 @@ def valid_moves(row, col, board, check_for_checks):
         if row == 1 and board.squares[row+1][col] == "." and board.squares[row+2][col] == ".":
             moves.append((row+2, col, False, False))
         # Capture diagonally
-        if row <= 6 and col <= 6 and board.squares[row+1][col+1] in "KQRNBP":
-            moves.append((row+1, col+1, False, True))
-        if row <= 6 and col >= 1 and board.squares[row+1][col-1] in "KQRNBP":
-            moves.append((row+1, col-1, False, True))
-        # En passant
-        if board.move_history:
-            last_move = board.move_history[-1]
-            if (row == 4 and col >= 1 and board.squares[5][col-1] == "." and
-                last_move[4] == "P" and last_move[0] == 6 and last_move[1] == col-1 and
-                last_move[2] == 4 and last_move[3] == col-1):
-                moves.append((row+1, col-1, True, True))
-            if (row == 4 and col <= 6 and board.squares[5][col+1] == "." and
-                last_move[4] == "P" and last_move[0] == 6 and last_move[1] == col+1 and
-                last_move[2] == 4 and last_move[3] == col+1):
-                moves.append((row+1, col+1, True, True))
+        for r, c in BLACK_PAWN_CAPTURE_TARGETS[row][col]:
+            if board.squares[r][c] in "KQRNBP":
+                moves.append((r, c, False, True))
+        # En passant, onto the square the white pawn just passed over
+        ep_row, ep_col = board.en_passant_rights
+        if ep_row == 5 and row == 4 and abs(ep_col - col) == 1:
+            moves.append((ep_row, ep_col, True, True))
 
     # White king
     elif piece == "K":
-        for r in [row-1, row, row+1]:
-            for c in [col-1, col, col+1]:
-                if r == row and c == col:
-                    continue
-                if in_bounds(r, c) and board.squares[r][c] == ".":
-                    moves.append((r, c, False, False))
-                elif in_bounds(r, c) and board.squares[r][c] in "kqrnbp":
-                    moves.append((r, c, False, True))
-        # Only check for castling if we're "checking for checks", since the
-        # act of castling cannot capture an opposing king.
-        if check_for_checks:
-            # Check short castle then long castle
-            for rook_col in [7, 0]:
-                # Ensure king and rook have never moved, and the rook has not been captured
-                for m in board.move_history:
-                    if ((m[0] == 7 and m[1] == 4 or m[0] == 7 and m[1] == rook_col) or # king or rook moved
-                        m[2] == 7 and m[3] == rook_col): # rook was captured
-                        break
-                else:
-                    # Ensure squares between them are empty
-                    for space_col in range(min(rook_col, 4) + 1, max(rook_col, 4)):
-                        if board.squares[7][space_col] != ".":
-                            break
-                    else:
-                        # Ensure king is not in check
-                        if not is_king_in_check(True, board):
-                            # Ensure king will not go through check
-                            if rook_col == 7:
-                                for c in [5, 6]:
-                                    board.make_move(7, 4, 7, c)
-                                    is_in_check = is_king_in_check(True, board)
-                                    board.unmake_move()
-                                    if is_in_check:
-                                        break
-                                else:
-                                    # We can castle
-                                    moves.append((7, 6, False, False))
-                            elif rook_col == 0:
-                                for c in [3, 2]:
-                                    board.make_move(7, 4, 7, c)
-                                    is_in_check = is_king_in_check(True, board)
-                                    board.unmake_move()
-                                    if is_in_check:
-                                        break
-                                else:
-                                    # We can castle
-                                    moves.append((7, 2, False, False))                             
+        step_moves(KING_TARGETS[row][col], "kqrnbp", moves, board)
 
     # Black king
     elif piece == "k":
-        for r in [row-1, row, row+1]:
-            for c in [col-1, col, col+1]:
-                if r == row and c == col:
-                    continue
-                if in_bounds(r, c) and board.squares[r][c] == ".":
-                    moves.append((r, c, False, False))
-                elif in_bounds(r, c) and board.squares[r][c] in "KQRNBP":
-                    moves.append((r, c, False, True))
-        # Only check for castling if we're "checking for checks", since the
-        # act of castling cannot capture an opposing king.
-        if check_for_checks:
-            # Check short castle then long castle
-            for rook_col in [7, 0]:
-                # Ensure king and rook have never moved, and the rook has not been captured
-                for m in board.move_history:
-                    if ((m[0] == 0 and m[1] == 4 or m[0] == 0 and m[1] == rook_col) or # king or rook moved
-                        m[2] == 0 and m[3] == rook_col): # rook was captured
-                        break
-                else:
-                    # Ensure squares between them are empty
-                    for space_col in range(min(rook_col, 4) + 1, max(rook_col, 4)):
-                        if board.squares[0][space_col] != ".":
-                            break
-                    else:
-                        # Ensure king is not in check
-                        if not is_king_in_check(False, board):
-                            # Ensure king will not go through check
-                            if rook_col == 7:
-                                for c in [5, 6]:
-                                    board.make_move(0, 4, 0, c)
-                                    is_in_check = is_king_in_check(False, board)
-                                    board.unmake_move()
-                                    if is_in_check:
-                                        break
-                                else:
-                                    # We can castle
-                                    moves.append((0, 6, False, False))
-                            elif rook_col == 0:
-                                for c in [3, 2]:
-                                    board.make_move(0, 4, 0, c)
-                                    is_in_check = is_king_in_check(False, board)
-                                    board.unmake_move()
-                                    if is_in_check:
-                                        break
-                                else:
-                                    # We can castle
-                                    moves.append((0, 2, False, False))
+        step_moves(KING_TARGETS[row][col], "KQRNBP", moves, board)
 
     # White knight
     elif piece == "N":
-        for r, c in [(row - 2, col - 1),
-                     (row - 1, col - 2),
-                     (row - 2, col + 1),
-                     (row - 1, col + 2),
-                     (row + 2, col - 1),
-                     (row + 1, col - 2),
-                     (row + 2, col + 1),
-                     (row + 1, col + 2)]:
-            if in_bounds(r, c) and board.squares[r][c] == ".":
-                moves.append((r, c, False, False))
-            elif in_bounds(r, c) and board.squares[r][c] in "kqrnbp":
-                moves.append((r, c, False, True))
+        step_moves(KNIGHT_TARGETS[row][col], "kqrnbp", moves, board)
 
     # Black knight
     elif piece == "n":
-        for r, c in [(row - 2, col - 1),
-                     (row - 1, col - 2),
-                     (row - 2, col + 1),
-                     (row - 1, col + 2),
-                     (row + 2, col - 1),
-                     (row + 1, col - 2),
-                     (row + 2, col + 1),
-                     (row + 1, col + 2)]:
-            if in_bounds(r, c) and board.squares[r][c] == ".":
-                moves.append((r, c, False, False))
-            elif in_bounds(r, c) and board.squares[r][c] in "KQRNBP":
-                moves.append((r, c, False, True))
+        step_moves(KNIGHT_TARGETS[row][col], "KQRNBP", moves, board)
 
     # White rook
     elif piece == "R":
@@ -500,27 +577,29 @@ def valid_moves(row, col, board, check_for_checks):
         moves.extend(straight_probe(row, col, False, 1, -1, board))
         moves.extend(straight_probe(row, col, False, 1, 1, board))
 
-    # Are we pruning moves that result in checks?
-    if check_for_checks:
-        moves = prune_moves_to_avoid_checks(row, col, moves, board)
-
     return moves
 
+def step_moves(targets, enemies, moves, board):
+    """ Append moves of a knight or king to its precomputed target squares """
+    squares = board.squares
+    for r, c in targets:
+        target = squares[r][c]
+        if target == ".":
+            moves.append((r, c, False, False))
+        elif target in enemies:
+            moves.append((r, c, False, True))
+
 def straight_probe(row, col, white, direction_row, direction_col, board):
     moves = []
-    if white:
-        valid_squares = ".kqrnbp"
-    else:
-        valid_squares = ".KQRNBP"
-    r = row + direction_row
-    c = col + direction_col
-    while in_bounds(r, c) and board.squares[r][c] in valid_squares:
-        if board.squares[r][c] == ".":
+    enemies = "kqrnbp" if white else "KQRNBP"
+    squares = board.squares
+    for r, c in RAYS[row][col][(direction_row, direction_col)]:
+        target = squares[r][c]
+        if target == ".":
             moves.append((r, c, False, False))
-            r += direction_row
-            c += direction_col
         else:
-            # This is a capture
-            moves.append((r, c, False, True))
+            if target in enemies:
+                # This is a capture
+                moves.append((r, c, False, True))
             break
     return moves
@@ -0,0 +1,74 @@
+from collections import OrderedDict
+import chess_board
+import move_cache
+import rulebook as rules
+
+class SANCache():
+    """
+    Bounded cache of moves in standard algebraic notation (with check and checkmate
+    marks), keyed by the Zobrist hash of the position and the move in long algebraic
+    notation.  Engines repeat the same principal variations from the same positions
+    many times a second while analysing, so each move is only converted once.  Once
+    max_entries is reached, the least recently used entry is evicted.
+
+    Legal moves come from a MoveCache, which may be shared with the board's other users.
+    """
+
+    def __init__(self, max_entries = 100000, moves = None):
+        self.max_entries = max_entries
+        self.entries = OrderedDict() # key is (Zobrist hash, move), value is SAN
+        self.move_cache = moves if moves is not None else move_cache.MoveCache()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def san(self, board, uci):
+        """ SAN of the move in the board's position, or None if it is not legal there """
+        key = (board.zobrist_hash, uci)
+        san = self.entries.get(key)
+        if san is not None:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return san
+        self.misses += 1
+        try:
+            start_row, start_col, end_row, end_col = chess_board.uci_to_squares(uci)
+        except (IndexError, ValueError):
+            return None
+        all_valid_moves, targets = self.move_cache.compute_valid_moves_and_targets(board)
+        if not any(origin == (start_row, start_col) for origin, m in targets.get((end_row, end_col), [])):
+            return None
+        san = rules.algebraic_notation(start_row, start_col, end_row, end_col, all_valid_moves, board, targets)
+        board.make_move(start_row, start_col, end_row, end_col)
+        if rules.is_king_in_check(board.whites_turn, board):
+            san += "+" if rules.are_there_any_valid_moves(board) else "#"
+        board.unmake_move()
+        self.entries[key] = san
+        if len(self.entries) > self.max_entries:
+            self.entries.popitem(last = False)
+        return san
+
+    def pv_to_san(self, board, pv):
+        """
+        List of the SAN of the moves of a principal variation (in long algebraic notation)
+        from the board's position, up to any illegal move.  The moves are made on the board
+        and then unmade, so the board is left in its position.
+        """
+        sans = []
+        for uci in pv:
+            san = self.san(board, uci)
+            if san is None:
+                break
+            sans.append(san)
+            start_row, start_col, end_row, end_col = chess_board.uci_to_squares(uci)
+            board.make_move(start_row, start_col, end_row, end_col)
+        for san in sans:
+            board.unmake_move()
+        return sans
+
+    def clear(self):
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
@@ -1,6 +1,22 @@
+import asyncio
+import bitboard_board
 import chess_board
+import contextlib
+import io
+import move_cache
+import opening_finder
+import os
+import perft
+import pgn_reader
+import polyglot_book
 import rulebook as rules
+import san_cache
+import sys
+import tempfile
+import threading
 import time
+import uci_engine
+import zobrist
 
 def test_move_hashing():
     board = chess_board.Board()
@@ -94,6 +110,692 @@ def test_move_generation():
     for i in truth_moves:
         assert number_of_valid_moves(board, i) == truth_moves[i]
 
+def test_bitboard_move_generation():
+    truth_moves = {1:20, 2:400, 3:8902}
+    board = bitboard_board.BitboardBoard()
+    for i in truth_moves:
+        assert number_of_valid_moves(board, i) == truth_moves[i]
+    board.make_move(6, 4, 4, 4) # e4
+    board.make_move(1, 3, 3, 3) # d5
+    board.make_move(4, 4, 3, 3) # exd5
+    board.make_move(1, 2, 3, 2) # c5
+    board.make_move(3, 3, 2, 2) # dxc6 (en passant)
+    board.make_move(0, 6, 2, 5) # Nf6
+    board.make_move(2, 2, 1, 2) # c7
+    board.make_move(1, 4, 3, 4) # e5
+    board.make_move(6, 0, 4, 0) # a4
+    board.make_move(0, 5, 5, 0) # Ba3
+    board.make_move(7, 0, 5, 0) # Rxa3
+    board.make_move(0, 4, 0, 6) # O-O
+    board.make_move(1, 2, 0, 1) # cxb8=Q
+    incremental = dict(board.bitboards)
+    board.build_bitboards()
+    assert incremental == board.bitboards
+    while board.move_history:
+        board.unmake_move()
+    incremental = dict(board.bitboards)
+    board.build_bitboards()
+    assert incremental == board.bitboards
+
+    # Both backends generate the same moves along a game with pins,
+    # en passant, castling and promotion
+    moves = [(6, 4, 4, 4), (1, 3, 3, 3), (4, 4, 3, 3), (1, 2, 3, 2),
+             (3, 3, 2, 2), (0, 6, 2, 5), (7, 5, 3, 1), (0, 2, 1, 3),
+             (2, 2, 1, 1), (1, 4, 3, 4), (7, 6, 5, 5), (0, 5, 2, 3),
+             (7, 4, 7, 6), (1, 3, 3, 1), (1, 1, 0, 0)]
+    list_board = chess_board.Board()
+    bit_board = bitboard_board.BitboardBoard()
+    for move in moves + [None]:
+        list_targets = {}
+        bit_targets = {}
+        list_moves = rules.compute_all_valid_moves(list_board, list_targets)
+        bit_moves = rules.compute_all_valid_moves(bit_board, bit_targets)
+        assert {k: sorted(v) for k, v in list_moves.items()} == \
+               {k: sorted(v) for k, v in bit_moves.items()}
+        assert {k: sorted(v) for k, v in list_targets.items()} == \
+               {k: sorted(v) for k, v in bit_targets.items()}
+        assert rules.count_legal_moves(list_board) == rules.count_legal_moves(bit_board)
+        if move:
+            list_board.make_move(*move)
+            bit_board.make_move(*move)
+
+def play_moves(board, moves):
+    """ Play space separated moves given by their start and end squares (e.g. "e2e4") """
+    for m in moves.split():
+        start_row, start_col = rules.notation_to_loc(m[0:2])
+        end_row, end_col = rules.notation_to_loc(m[2:4])
+        board.make_move(start_row, start_col, end_row, end_col)
+
+def legal_move_set(board):
+    all_valid_moves = rules.compute_all_valid_moves(board)
+    return set((start, (m[0], m[1])) for start in all_valid_moves for m in all_valid_moves[start])
+
+def test_legal_moves_from_checks_and_pins():
+    for board_type in [chess_board.Board, bitboard_board.BitboardBoard]:
+        # Kiwipete and "position 3" perft counts
+        board = board_type.from_fen("r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1")
+        assert perft.perft(board, 3) == 97862
+        board = board_type.from_fen("8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1")
+        assert perft.perft(board, 4) == 43238
+
+        # A single check is met by blocking on d2 or c3
+        board = board_type()
+        play_moves(board, "d2d4 e7e6 c2c4 f8b4")
+        assert legal_move_set(board) == {((7, 3), (6, 3)), ((7, 2), (6, 3)), # Qd2, Bd2
+                                         ((7, 1), (6, 3)), ((7, 1), (5, 2))} # Nd2, Nc3
+
+        # A pinned bishop can only move along the pin, and a pinned knight cannot move
+        board = board_type()
+        play_moves(board, "d2d4 e7e6 c2c4 f8b4 c1d2 a7a6")
+        assert sorted(m[0:2] for m in rules.compute_all_valid_moves(board)[(6, 3)]) == [(4, 1), (5, 2)]
+        board = board_type()
+        play_moves(board, "d2d4 e7e6 c2c4 f8b4 b1c3 a7a6")
+        assert rules.compute_all_valid_moves(board)[(5, 2)] == []
+
+        # Only the king can move out of a double check, even though fxe5 takes the knight
+        board = board_type()
+        play_moves(board, "f2f4 b7b5 b1c3 d7d6 a2a4 b8c6 e1f2 c8b7 f2f3 c6e5")
+        assert legal_move_set(board) == {((5, 5), (5, 4)), ((5, 5), (5, 6)), ((5, 5), (6, 5))} # Ke3, Kg3, Kf2
+
+        # En passant is illegal when taking both pawns off the rank exposes the king
+        board = board_type()
+        play_moves(board, "c2c3 e7e5 d1a4 f7f5 a2a3 f5f4 b2b3 e8e7 h2h3 e7f6 a1a2 f6g5 a2a1 g5h4 e2e4")
+        assert [m[0:2] for m in rules.compute_all_valid_moves(board)[(4, 5)]] == [(5, 5)]
+        board = board_type()
+        play_moves(board, "c2c3 e7e5 d1a4 f7f5 a2a3 f5f4 b2b3 e8e7 h2h3 e7f6 a1a2 f6g5 a2a1 g5h4 a1a2 h4g5 e2e4")
+        assert sorted(m[0:2] for m in rules.compute_all_valid_moves(board)[(4, 5)]) == [(5, 4), (5, 5)]
+
+def test_piece_square_tracking():
+    board = chess_board.Board()
+    moves = [(6, 4, 4, 4), # e4
+             (1, 3, 3, 3), # d5
+             (4, 4, 3, 3), # exd5
+             (1, 2, 3, 2), # c5
+             (3, 3, 2, 2), # dxc6 (en passant)
+             (0, 6, 2, 5), # Nf6
+             (2, 2, 1, 2), # c7
+             (0, 5, 4, 1), # Bb4
+             (1, 2, 0, 1), # cxb8=Q
+             (0, 4, 0, 6)] # O-O
+    for m in moves:
+        board.make_move(m[0], m[1], m[2], m[3])
+        incremental = {p: set(s) for p, s in board.piece_squares.items()}
+        board.build_piece_squares()
+        assert incremental == board.piece_squares
+    assert board.king_square(False) == (0, 6)
+    assert (0, 1) in board.piece_squares["Q"]
+    while board.move_history:
+        board.unmake_move()
+        incremental = {p: set(s) for p, s in board.piece_squares.items()}
+        board.build_piece_squares()
+        assert incremental == board.piece_squares
+    assert board.king_square(True) == (7, 4)
+
+def test_perft_cache():
+    board = chess_board.Board()
+    cache = perft.PerftCache(1000)
+    assert perft.perft(board, 4, cache) == 197281
+    assert len(cache) <= 1000
+    assert cache.hits > 0
+    results = perft.divide(board, 3, cache)
+    assert len(results) == 20
+    assert sum(count for uci, count in results) == 8902
+    assert ("e2e4", 600) in results
+
+def test_parallel_perft():
+    board = chess_board.Board()
+    board.make_move(6, 4, 4, 4) # e4
+    for split_ply in [1, 2]:
+        results = perft.parallel_divide(board, 3, 2, split_ply)
+        assert len(results) == 20
+        assert sum(count for uci, count in results) == 13160
+    assert board.move_history.tolist() == [chess_board.encode_move(6, 4, 4, 4)]
+
+def test_legal_move_generator():
+    board = chess_board.Board()
+    board.make_move(6, 4, 4, 4) # e4
+    board.make_move(1, 3, 3, 3) # d5
+    all_valid_moves = rules.compute_all_valid_moves(board)
+    expected = set((start, m) for start in all_valid_moves for m in all_valid_moves[start])
+    generated = list(rules.generate_legal_moves(board))
+    assert len(generated) == len(expected) == 31
+    assert set(generated) == expected
+    assert generated[0] == ((4, 4), (3, 3, False, True)) # exd5 comes first
+    assert all(m[3] for start, m in generated[:1]) and not any(m[3] for start, m in generated[1:])
+    assert set(rules.generate_legal_moves(board, False)) == expected
+
+    # Fool's mate
+    board = chess_board.Board()
+    board.make_move(6, 5, 5, 5) # f3
+    board.make_move(1, 4, 3, 4) # e5
+    board.make_move(6, 6, 4, 6) # g4
+    board.make_move(0, 3, 4, 7) # Qh4#
+    assert not rules.are_there_any_valid_moves(board)
+    assert rules.check_for_terminal_states_and_king_checks(board) == (True, -1)
+
+def test_move_cache():
+    board = chess_board.Board()
+    cache = move_cache.MoveCache(2)
+    shuffle = [(7, 6, 5, 5), (0, 6, 2, 5), (5, 5, 7, 6), (2, 5, 0, 6)] # Nf3 Nf6 Ng1 Ng8
+    for i in range(2):
+        for m in shuffle:
+            assert cache.compute_all_valid_moves(board) == rules.compute_all_valid_moves(board)
+            board.make_move(m[0], m[1], m[2], m[3])
+    assert len(cache) == 2
+    assert cache.hits == 0 # Four positions repeat, but only two fit in the cache
+
+    cache = move_cache.MoveCache(100)
+    for i in range(2):
+        for m in shuffle:
+            cache.compute_all_valid_moves(board)
+            board.make_move(m[0], m[1], m[2], m[3])
+    assert (cache.hits, cache.misses) == (4, 4)
+
+    # A colliding position with different state must not be served from the cache
+    state = cache.position_state(board)
+    cache.entries[board.zobrist_hash] = ((not state[0], state[1]), {}, {})
+    assert cache.get(board) is None
+
+def test_material_counters():
+    board = chess_board.Board()
+    moves = [(6, 4, 4, 4), # e4
+             (1, 3, 3, 3), # d5
+             (4, 4, 3, 3), # exd5
+             (1, 2, 3, 2), # c5
+             (3, 3, 2, 2), # dxc6 (en passant)
+             (0, 6, 2, 5), # Nf6
+             (2, 2, 1, 1), # cxb7
+             (0, 2, 2, 0), # Ba6
+             (1, 1, 0, 0)] # bxa8=Q
+    for m in moves:
+        board.make_move(m[0], m[1], m[2], m[3])
+    assert board.white_material == 39 + 8
+    assert board.black_material == 39 - 3 - 5
+    assert board.piece_counts["Q"] == 2 and board.piece_counts["P"] == 7
+    assert board.piece_counts["p"] == 5 and board.piece_counts["r"] == 1
+    assert board.captured_counts["p"] == 3 and board.captured_counts["r"] == 1
+    assert board.captured_counts["P"] == 0
+    while board.move_history:
+        board.unmake_move()
+    assert board.white_material == board.black_material == 39
+    assert not any(board.captured_counts.values())
+    assert board.piece_counts == {p: len(board.piece_squares[p]) for p in "PNBRQKpnbrqk"}
+    assert not rules.is_draw_by_insufficient_material(board)
+
+def test_repetition_and_fifty_move_rule():
+    board = chess_board.Board()
+    shuffle = [(7, 6, 5, 5), (0, 6, 2, 5), (5, 5, 7, 6), (2, 5, 0, 6)] # Nf3 Nf6 Ng1 Ng8
+    for m in shuffle:
+        board.make_move(m[0], m[1], m[2], m[3])
+    assert board.position_counts[board.zobrist_hash] == 2
+    assert not rules.is_draw_by_threefold_repeition(board)
+    for m in shuffle:
+        board.make_move(m[0], m[1], m[2], m[3])
+    assert rules.check_for_terminal_states_and_king_checks(board) == (True, 0.2)
+    board.unmake_move()
+    assert not rules.is_draw_by_threefold_repeition(board)
+    while board.move_history:
+        board.unmake_move()
+    assert board.position_counts == {board.zobrist_hash: 1}
+
+    # A pawn move resets the halfmove clock, and undoing it restores the clock
+    board.make_move(6, 4, 4, 4) # e4
+    board.make_move(1, 4, 3, 4) # e5
+    tour = [(7, 6, 5, 5), (0, 6, 2, 5), (5, 5, 7, 6), (2, 5, 0, 6), # Nf3 Nf6 Ng1 Ng8
+            (7, 1, 5, 2), (0, 1, 2, 2), (5, 2, 7, 1), (2, 2, 0, 1)] # Nc3 Nc6 Nb1 Nb8
+    for i in range(100):
+        m = tour[i % len(tour)]
+        assert not rules.is_draw_by_fifty_move_rule(board)
+        board.make_move(m[0], m[1], m[2], m[3])
+    assert board.halfmove_clock == 100
+    assert rules.is_draw_by_fifty_move_rule(board)
+    board.make_move(6, 3, 4, 3) # d4
+    assert board.halfmove_clock == 0
+    board.unmake_move()
+    assert board.halfmove_clock == 100
+
+def test_move_targets():
+    board = chess_board.Board()
+    moves = [(7, 6, 5, 5), # Nf3
+             (0, 6, 2, 5), # Nf6
+             (6, 3, 5, 3), # d3
+             (1, 3, 2, 3)] # d6
+    for m in moves:
+        board.make_move(m[0], m[1], m[2], m[3])
+    targets = {}
+    all_valid_moves = rules.compute_all_valid_moves(board, targets)
+    assert sum(len(t) for t in targets.values()) == sum(len(m) for m in all_valid_moves.values())
+    assert sorted(origin for origin, m in targets[(6, 3)]) == [(5, 5), (7, 1), (7, 2), (7, 3), (7, 4)]
+    assert rules.algebraic_notation(7, 1, 6, 3, all_valid_moves, board, targets) == "Nbd2"
+    assert rules.algebraic_notation(5, 5, 6, 3, all_valid_moves, board) == "Nfd2"
+    assert rules.algebraic_notation(7, 2, 6, 3, all_valid_moves, board, targets) == "Bd2"
+
+def test_pgn_reader():
+    pgn = """[Event "Test 1"]
+[White "A"]
+[Result "1-0"]
+
+1. e4 e5 2. Nf3 {A comment
+[spanning lines]} Nc6 (2... d6 3. d4) 3. Bb5 a6 $1 4. Ba4 Nf6 5. O-O Be7
+6. Re1 b5 7. Bb3 d6 8. c3 O-O 9. h3 Nb8 10. d4 Nbd7 1-0
+
+[Event "Test 2"]
+[Result "0-1"]
+
+1. f3 e5 2. g4 Qh4# 0-1
+
+[Event "Test 3"]
+[Result "*"]
+
+1. e4 d5 2. exd5 c6 3. dxc6 Nf6 4. cxb7 Bd7 5. bxa8=N *
+"""
+    reader = pgn_reader.PGNReader()
+    games = list(reader.games(io.StringIO(pgn), lambda tags: tags["Event"] != "Test 3"))
+    assert len(games) == 2 and reader.games_skipped == 1
+    assert games[0].tags["White"] == "A" and games[0].result == "1-0"
+    assert len(games[0].san_moves) == 20
+    assert games[0].uci_moves()[-3:] == ["c6b8", "d2d4", "b8d7"]
+    assert games[1].uci_moves() == ["f2f3", "e7e5", "g2g4", "d8h4"]
+    assert rules.check_for_terminal_states_and_king_checks(reader.board) == (True, -1)
+    assert [tags["Event"] for tags in reader.scan_tags(io.StringIO(pgn))] == ["Test 1", "Test 2", "Test 3"]
+
+    # Underpromotion is not supported by Board
+    try:
+        list(reader.games(io.StringIO(pgn)))
+        assert False
+    except pgn_reader.UnsupportedPromotionError:
+        pass
+    list(reader.games(io.StringIO(pgn), skip_errors = True))
+    assert reader.errors == 1
+
+def test_fen():
+    board = chess_board.Board()
+    assert board.to_fen() == chess_board.STARTING_FEN
+    board.make_move(6, 4, 4, 4) # e4
+    assert board.fen_placement() == "rnbqkbnr/pppppppp/8/8/4P3/8/PPPP1PPP/RNBQKBNR"
+    board.make_move(1, 2, 3, 2) # c5
+    board.make_move(4, 4, 3, 4) # e5
+    board.make_move(1, 3, 3, 3) # d5
+    fen = board.to_fen()
+    assert fen == "rnbqkbnr/pp2pppp/8/2ppP3/8/8/PPPP1PPP/RNBQKBNR w KQkq d6 0 3"
+    copy = chess_board.Board.from_fen(fen)
+    assert copy.to_fen() == fen
+    assert copy.squares == board.squares and copy.en_passant_rights == (2, 3)
+    assert copy.piece_counts == board.piece_counts and copy.white_material == board.white_material
+    assert copy.zobrist_hasher.full_hash(copy) == copy.zobrist_hash
+    board.unmake_move()
+    board.unmake_move()
+    assert board.to_fen() == "rnbqkbnr/pp1ppppp/8/2p5/4P3/8/PPPP1PPP/RNBQKBNR w KQkq - 0 2"
+
+    # Perft from other positions, on both board types
+    kiwipete = "r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1"
+    endgame = "8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1"
+    for board_type in [chess_board.Board, bitboard_board.BitboardBoard]:
+        board = board_type.from_fen(kiwipete)
+        assert board.to_fen() == kiwipete
+        assert perft.perft(board, 2) == 2039
+        board = board_type.from_fen(endgame)
+        assert perft.perft(board, 3) == 2812
+
+def test_opening_book():
+    openings = opening_finder.OpeningFinder()
+    openings.load_opening_book_tsv("resources/a.tsv")
+    assert len(openings.openings) == openings.total_openings_loaded
+
+    # Transpositions find the same opening, as the book is keyed by Zobrist hash
+    board = chess_board.Board()
+    for uci in ["g1f3", "g8f6", "c2c4"]:
+        start_row, start_col, end_row, end_col = chess_board.uci_to_squares(uci)
+        board.make_move(start_row, start_col, end_row, end_col)
+    assert openings.find_opening(board) == "English Opening: Anglo-Indian Defense, King's Knight Variation"
+
+    # The same placement with the other side to move is a different position
+    board = chess_board.Board.from_fen("rnbqkb1r/pppppppp/5n2/8/2P5/5N2/PP1PPPPP/RNBQKB1R w KQkq - 0 1")
+    assert openings.find_opening(board) is None
+
+def test_binary_opening_book():
+    tsv_filenames = ["resources/a.tsv", "resources/c.tsv"]
+    in_memory = opening_finder.OpeningFinder()
+    for filename in tsv_filenames:
+        in_memory.load_opening_book_tsv(filename)
+    with tempfile.TemporaryDirectory() as directory:
+        book_filename = os.path.join(directory, "openings.bin")
+        openings = opening_finder.OpeningFinder()
+        openings.open_opening_book(book_filename, tsv_filenames)
+        assert opening_finder.opening_book_is_current(tsv_filenames, book_filename)
+        for key, name in in_memory.openings.items():
+            assert openings.book_lookup(key) == name
+        board = chess_board.Board()
+        assert openings.find_opening(board) is None
+        board.make_move(6, 4, 4, 4) # e4
+        board.make_move(1, 4, 3, 4) # e5
+        assert openings.find_opening(board) == "King's Pawn Game"
+        openings.close()
+
+        # A newer tsv makes the book out of date
+        tsv_time = os.path.getmtime(tsv_filenames[0])
+        os.utime(book_filename, (tsv_time - 10, tsv_time - 10))
+        assert not opening_finder.opening_book_is_current(tsv_filenames, book_filename)
+
+def test_opening_cursor():
+    tsv_filenames = ["resources/a.tsv", "resources/b.tsv", "resources/c.tsv"]
+    in_memory = opening_finder.OpeningFinder()
+    for filename in tsv_filenames:
+        in_memory.load_opening_book_tsv(filename)
+    with tempfile.TemporaryDirectory() as directory:
+        compiled = opening_finder.OpeningFinder()
+        compiled.open_opening_book(os.path.join(directory, "openings.bin"), tsv_filenames)
+        for openings in [in_memory, compiled]:
+            board = chess_board.Board()
+            cursor = opening_finder.OpeningCursor(openings)
+            assert ("e2e4", "King's Pawn Game") in cursor.continuations()
+            names = []
+            for uci in ["e2e4", "e7e5", "g1f3", "b8c6", "f1b5"]:
+                start_row, start_col, end_row, end_col = chess_board.uci_to_squares(uci)
+                board.make_move(start_row, start_col, end_row, end_col)
+                names.append(cursor.advance(board))
+            assert names[1] == "King's Pawn Game" and names[4] == "Ruy Lopez"
+            assert "a7a6" in [uci for uci, name in cursor.continuations()]
+
+            # Leaving the book stops the cursor until it retreats back into the book
+            for uci in ["h7h5", "h2h4", "h8h6"]:
+                start_row, start_col, end_row, end_col = chess_board.uci_to_squares(uci)
+                board.make_move(start_row, start_col, end_row, end_col)
+                assert cursor.advance(board) is None
+            assert not cursor.in_book() and cursor.continuations() == []
+            for i in range(3):
+                board.unmake_move()
+                cursor.retreat()
+            assert cursor.in_book() and cursor.opening_name() == "Ruy Lopez"
+
+            # A transposition into a book position is found by its hash
+            board = chess_board.Board()
+            cursor.reset()
+            for uci in ["g1f3", "g8f6", "c2c4"]:
+                start_row, start_col, end_row, end_col = chess_board.uci_to_squares(uci)
+                board.make_move(start_row, start_col, end_row, end_col)
+                name = cursor.advance(board)
+            assert name == "English Opening: Anglo-Indian Defense, King's Knight Variation"
+        compiled.close()
+
+def test_polyglot_book():
+    # Keys of the Polyglot book format documentation, after each move
+    hasher = zobrist.ZobristHasher(polyglot = True)
+    board = chess_board.Board()
+    board.zobrist_hasher = hasher
+    board.reset()
+    keys = [("", 0x463b96181691fc9c), ("e2e4", 0x823c9b50fd114196), ("d7d5", 0x0756b94461c50fb0),
+            ("e4e5", 0x662fafb965db29d4), ("f7f5", 0x22a48b5a8e47ff78), ("e1e2", 0x652a607ca3f242c1),
+            ("e8f7", 0x00fdd303c946bdd9)]
+    for uci, key in keys:
+        if uci:
+            start_row, start_col, end_row, end_col = chess_board.uci_to_squares(uci)
+            board.make_move(start_row, start_col, end_row, end_col)
+        assert board.zobrist_hash == key and hasher.full_hash(board) == key
+
+    def polyglot_move(uci):
+        start_row, start_col, end_row, end_col = chess_board.uci_to_squares(uci)
+        return (7 - end_row) << 3 | end_col | (7 - start_row) << 9 | start_col << 6
+
+    board = chess_board.Board()
+    castling_position = ["e2e4", "e7e5", "g1f3", "b8c6", "f1c4", "f8c5"]
+    for uci in castling_position:
+        start_row, start_col, end_row, end_col = chess_board.uci_to_squares(uci)
+        board.make_move(start_row, start_col, end_row, end_col)
+    castling_key = hasher.full_hash(board)
+    entries = [(0x463b96181691fc9c, polyglot_move("e2e4"), 10),
+               (0x463b96181691fc9c, polyglot_move("d2d4"), 0),
+               (0x463b96181691fc9c, polyglot_move("a1a5"), 50), # Illegal
+               (castling_key, polyglot_move("e1h1"), 1)]
+    with tempfile.TemporaryDirectory() as directory:
+        book_filename = os.path.join(directory, "book.bin")
+        with open(book_filename, "wb") as f:
+            for key, move, weight in sorted(entries):
+                f.write(polyglot_book.POLYGLOT_ENTRY.pack(key, move, weight, 0))
+        book = polyglot_book.PolyglotBook(book_filename)
+        assert book.count == 4
+        start = chess_board.Board()
+        assert sorted(book.find_moves(start)) == [(6, 3, 4, 3, 0), (6, 4, 4, 4, 10)]
+        assert book.choose_move(start, False) == (6, 4, 4, 4)
+        assert book.choose_move(start) == (6, 4, 4, 4)
+        assert book.choose_move(board) == (7, 4, 7, 6)
+        board.make_move(7, 4, 7, 6)
+        assert book.choose_move(board) is None
+        book.close()
+
+# A minimal UCI engine, which plays a legal move chosen by the rules engine
+FAKE_ENGINE = """
+import sys
+sys.path.insert(0, sys.argv[1])
+import chess_board
+import rulebook as rules
+board = chess_board.Board()
+pending = None
+hang = False
+def choose(board):
+    moves = [(r, c, m) for (r, c), ms in rules.compute_all_valid_moves(board).items() for m in ms]
+    r, c, m = moves[len(board.move_history) * 7 % len(moves)]
+    return rules.loc_to_notation(r, c) + rules.loc_to_notation(m[0], m[1])
+for line in sys.stdin:
+    words = line.split()
+    if not words:
+        continue
+    if words[0] == "uci":
+        print("id name Fake Engine\\noption name Hash type spin default 16 min 1 max 1024\\noption name Ponder type check default false\\nuciok", flush = True)
+    elif words[0] == "isready":
+        print("readyok", flush = True)
+    elif words[0] == "position":
+        board.reset()
+        for uci in words[words.index("moves") + 1:] if "moves" in words else []:
+            board.make_move(*chess_board.uci_to_squares(uci))
+    elif words[0] == "setoption" and words[2:5] == ["Hang", "value", "true"]:
+        # Never answer go, as a stuck engine would not
+        hang = True
+    elif words[0] == "go" and not hang:
+        uci = choose(board)
+        board.make_move(*chess_board.uci_to_squares(uci))
+        reply = choose(board)
+        board.unmake_move()
+        print("info depth 1 score cp 0 nodes 1 pv " + uci + " " + reply, flush = True)
+        # A ponder search only ends on ponderhit or stop
+        pending = "bestmove " + uci + " ponder " + reply
+        if "ponder" not in words:
+            print(pending, flush = True)
+            pending = None
+    elif words[0] in ("ponderhit", "stop") and pending:
+        print(pending, flush = True)
+        pending = None
+    elif words[0] == "quit":
+        break
+"""
+
+@contextlib.contextmanager
+def fake_engine_command():
+    """ Yields the command that runs FAKE_ENGINE, written to a temporary script """
+    with tempfile.TemporaryDirectory() as directory:
+        script = os.path.join(directory, "fake_engine.py")
+        with open(script, "w") as f:
+            f.write(FAKE_ENGINE)
+        yield [sys.executable, script, os.path.dirname(os.path.abspath(__file__))]
+
+def test_uci_engine():
+    with fake_engine_command() as command:
+
+        async def play():
+            engines = [uci_engine.UCIEngine(command, False) for i in range(4)]
+            await asyncio.gather(*[e.start() for e in engines])
+            await asyncio.gather(*[e.handshake(30) for e in engines])
+            assert engines[0].name == "Fake Engine" and "Hash" in engines[0].options
+            info = []
+            engines[0].info_callback = info.append
+            await engines[0].position(["e2e4"])
+            best_move, ponder_move = await engines[0].go(movetime = 10)
+            board = chess_board.Board()
+            board.make_move(6, 4, 4, 4) # e4
+            assert uci_engine.move_is_legal(board, best_move)
+            assert info and info[-1].split()[-2:] == [best_move, ponder_move]
+            games = await asyncio.gather(play_game(engines[0], engines[1]), play_game(engines[2], engines[3]))
+            await asyncio.gather(*[e.quit() for e in engines])
+            return games
+
+        async def play_game(white, black):
+            return await uci_engine.play_game(white, black, 10, 20)
+
+        for result, moves in asyncio.run(play()):
+            assert result == "1/2-1/2" and len(moves) == 20
+
+        # An engine that does not answer the handshake times out
+        async def silent():
+            engine = uci_engine.UCIEngine([sys.executable, "-c", "import time; time.sleep(30)"], False)
+            await engine.start()
+            try:
+                await engine.handshake(0.5)
+            except uci_engine.UCIError:
+                return True
+            finally:
+                engine.process.kill()
+                await engine.process.wait()
+            return False
+        assert asyncio.run(silent())
+
+        # An engine that never sends bestmove times out once its movetime and the margin have passed
+        async def hang():
+            engine = uci_engine.UCIEngine(command, False)
+            engine.go_timeout_margin = 0.2
+            await engine.start()
+            await engine.handshake(30)
+            await engine.set_option("Hang", "true")
+            await engine.position([])
+            try:
+                await engine.go(movetime = 100)
+            except uci_engine.UCIError:
+                return True
+            finally:
+                await engine.quit()
+            return False
+        assert asyncio.run(hang())
+
+        # Engines run on a background loop deliver their results on a queue
+        loop = uci_engine.EngineLoop()
+        engine = uci_engine.UCIEngine(command, False)
+        async def start():
+            await engine.start()
+            await engine.handshake(30)
+            return engine.name
+        loop.submit(start(), "started")
+        assert loop.results.get(timeout = 30) == ("started", "Fake Engine", None)
+        loop.close([engine])
+        assert engine.process.returncode is not None
+
+def test_engine_loop_notify():
+    with fake_engine_command() as command:
+        engine = uci_engine.UCIEngine(command, False)
+        wakeups = []
+        woken = threading.Event()
+        def notify():
+            wakeups.append(time.perf_counter())
+            woken.set()
+        loop = uci_engine.EngineLoop(notify)
+        async def search():
+            await engine.start()
+            await engine.handshake(30)
+            engine.info_callback = lambda line: loop.post("info", line)
+            await engine.position([])
+            return await engine.go(movetime = 10)
+        loop.submit(search(), "bestmove")
+
+        # Results arriving before they are collected share a wakeup
+        results = []
+        while not results or results[-1][0] != "bestmove":
+            assert woken.wait(30)
+            woken.clear()
+            results.extend(loop.collect())
+        assert [tag for tag, result, error in results] == ["info", "bestmove"]
+        assert 1 <= len(wakeups) <= 2
+
+        # The best move is collected within milliseconds of being read
+        assert wakeups[-1] - engine.bestmove_time < 0.05
+        loop.close([engine])
+
+def test_info_buffer():
+    info = uci_engine.parse_info("info depth 20 seldepth 31 multipv 1 score mate -3 upperbound nodes 123 nps 456 time 30 pv e2e4 e7e5")
+    assert info == {"depth": 20, "seldepth": 31, "multipv": 1, "score_mate": -3, "score_bound": "upperbound",
+                    "nodes": 123, "nps": 456, "time": 30, "pv": ["e2e4", "e7e5"]}
+    assert uci_engine.score_centipawns(info) == -uci_engine.MATE_SCORE + 3
+    assert uci_engine.parse_info("info string NNUE evaluation enabled") == {"string": "NNUE evaluation enabled"}
+    assert uci_engine.parse_info("info depth") == {}
+
+    # Only the latest value of each field is kept, and a new search starts afresh
+    buffer = uci_engine.InfoBuffer()
+    assert buffer.take(1) is None
+    for depth in range(1, 1001):
+        buffer.update(1, uci_engine.parse_info("info depth " + str(depth) + " score cp " + str(depth) + " nodes " + str(depth * 100)))
+    buffer.update(1, uci_engine.parse_info("info depth 1000 score mate 2 pv d1h5"))
+    fields, lines = buffer.take(1)
+    assert lines == 1001 and fields == {"depth": 1000, "score_mate": 2, "nodes": 100000, "pv": ["d1h5"]}
+    assert buffer.take(1) is None
+    buffer.update(1, uci_engine.parse_info("info nodes 5"))
+    assert buffer.take(2) is None
+    buffer.update(2, uci_engine.parse_info("info depth 3"))
+    assert buffer.take(2) == ({"depth": 3}, 1)
+
+def test_ponder():
+    with fake_engine_command() as command:
+
+        async def ponder():
+            engine = uci_engine.UCIEngine(command, False)
+            await engine.start()
+            await engine.handshake(30)
+            assert "Ponder" in engine.options
+            await engine.set_option("Ponder", "true")
+
+            # The engine expects a reply to its move, and searches after it until ponderhit
+            await engine.position([])
+            best_move, ponder_move = await engine.go(movetime = 10)
+            assert ponder_move is not None
+            await engine.position([best_move, ponder_move])
+            search = asyncio.ensure_future(engine.go(movetime = 10, ponder = True))
+            await engine.is_ready()
+            assert not search.done()
+            await engine.ponderhit()
+            hit_move, hit_ponder_move = await asyncio.wait_for(search, 30)
+            assert hit_move is not None
+
+            # A ponder search on the wrong reply is stopped
+            search = asyncio.ensure_future(engine.go(movetime = 10, ponder = True))
+            await engine.is_ready()
+            assert not search.done()
+            await engine.stop()
+            await asyncio.wait_for(search, 30)
+            await engine.quit()
+
+        asyncio.run(ponder())
+
+def test_multipv_analysis():
+    # Each variation keeps its own latest fields, and the first is the search's
+    buffer = uci_engine.InfoBuffer()
+    buffer.update(1, uci_engine.parse_info("info depth 10 multipv 1 score cp 30 nodes 100 pv e2e4 e7e5"))
+    buffer.update(1, uci_engine.parse_info("info depth 10 multipv 2 score cp 20 nodes 200 pv d2d4 d7d5"))
+    buffer.update(1, uci_engine.parse_info("info depth 11 multipv 2 score mate 5 nodes 300 pv g1f3"))
+    fields, lines = buffer.take(1)
+    assert fields["score_cp"] == 30 and fields["pv"] == ["e2e4", "e7e5"] and fields["nodes"] == 300
+    assert fields["lines"][1]["depth"] == 10 and fields["lines"][2] == {"depth": 11, "multipv": 2, "score_mate": 5, "nodes": 300, "pv": ["g1f3"]}
+
+    # Variations are converted to SAN once per position and move
+    board = chess_board.Board()
+    cache = san_cache.SANCache()
+    pv = ["e2e4", "e7e5", "d1h5", "b8c6", "f1c4", "g8f6", "h5f7"]
+    assert cache.pv_to_san(board, pv) == ["e4", "e5", "Qh5", "Nc6", "Bc4", "Nf6", "Qxf7#"]
+    assert board.to_fen() == chess_board.STARTING_FEN
+    assert cache.misses == 7 and cache.hits == 0
+    assert cache.pv_to_san(board, pv[0:3] + ["f8c5"]) == ["e4", "e5", "Qh5", "Bc5"]
+    assert cache.hits == 3 and cache.misses == 8
+    assert cache.pv_to_san(board, ["e2e4", "e2e4"]) == ["e4"]
+    board.make_move(6, 6, 4, 6) # g4
+    board.make_move(1, 4, 3, 4) # e5
+    board.make_move(6, 5, 5, 5) # f3
+    assert cache.pv_to_san(board, ["d8h4"]) == ["Qh4#"]
+
 if __name__ == '__main__':
 
     print("test_move_hashing")
@@ -112,4 +814,130 @@ if __name__ == '__main__':
     start_time = time.time()
     test_number_of_captures()
     end_time = time.time()
-    print(" -> passed; time =", '{0:.2f}'.format(end_time - start_time), "seconds")
\ No newline at end of file
+    print(" -> passed; time =", '{0:.2f}'.format(end_time - start_time), "seconds")
+
+    print("test_bitboard_move_generation")
+    start_time = time.time()
+    test_bitboard_move_generation()
+    end_time = time.time()
+    print(" -> passed; time =", '{0:.2f}'.format(end_time - start_time), "seconds")
+
+    print("test_legal_moves_from_checks_and_pins")
+    start_time = time.time()
+    test_legal_moves_from_checks_and_pins()
+    end_time = time.time()
+    print(" -> passed; time =", '{0:.2f}'.format(end_time - start_time), "seconds")
+
+    print("test_piece_square_tracking")
+    start_time = time.time()
+    test_piece_square_tracking()
+    end_time = time.time()
+    print(" -> passed; time =", '{0:.2f}'.format(end_time - start_time), "seconds")
+
+    print("test_perft_cache")
+    start_time = time.time()
+    test_perft_cache()
+    end_time = time.time()
+    print(" -> passed; time =", '{0:.2f}'.format(end_time - start_time), "seconds")
+
+    print("test_parallel_perft")
+    start_time = time.time()
+    test_parallel_perft()
+    end_time = time.time()
+    print(" -> passed; time =", '{0:.2f}'.format(end_time - start_time), "seconds")
+
+    print("test_legal_move_generator")
+    start_time = time.time()
+    test_legal_move_generator()
+    end_time = time.time()
+    print(" -> passed; time =", '{0:.2f}'.format(end_time - start_time), "seconds")
+
+    print("test_move_cache")
+    start_time = time.time()
+    test_move_cache()
+    end_time = time.time()
+    print(" -> passed; time =", '{0:.2f}'.format(end_time - start_time), "seconds")
+
+    print("test_material_counters")
+    start_time = time.time()
+    test_material_counters()
+    end_time = time.time()
+    print(" -> passed; time =", '{0:.2f}'.format(end_time - start_time), "seconds")
+
+    print("test_repetition_and_fifty_move_rule")
+    start_time = time.time()
+    test_repetition_and_fifty_move_rule()
+    end_time = time.time()
+    print(" -> passed; time =", '{0:.2f}'.format(end_time - start_time), "seconds")
+
+    print("test_move_targets")
+    start_time = time.time()
+    test_move_targets()
+    end_time = time.time()
+    print(" -> passed; time =", '{0:.2f}'.format(end_time - start_time), "seconds")
+
+    print("test_pgn_reader")
+    start_time = time.time()
+    test_pgn_reader()
+    end_time = time.time()
+    print(" -> passed; time =", '{0:.2f}'.format(end_time - start_time), "seconds")
+
+    print("test_fen")
+    start_time = time.time()
+    test_fen()
+    end_time = time.time()
+    print(" -> passed; time =", '{0:.2f}'.format(end_time - start_time), "seconds")
+
+    print("test_opening_book")
+    start_time = time.time()
+    test_opening_book()
+    end_time = time.time()
+    print(" -> passed; time =", '{0:.2f}'.format(end_time - start_time), "seconds")
+
+    print("test_binary_opening_book")
+    start_time = time.time()
+    test_binary_opening_book()
+    end_time = time.time()
+    print(" -> passed; time =", '{0:.2f}'.format(end_time - start_time), "seconds")
+
+    print("test_opening_cursor")
+    start_time = time.time()
+    test_opening_cursor()
+    end_time = time.time()
+    print(" -> passed; time =", '{0:.2f}'.format(end_time - start_time), "seconds")
+
+    print("test_polyglot_book")
+    start_time = time.time()
+    test_polyglot_book()
+    end_time = time.time()
+    print(" -> passed; time =", '{0:.2f}'.format(end_time - start_time), "seconds")
+
+    print("test_uci_engine")
+    start_time = time.time()
+    test_uci_engine()
+    end_time = time.time()
+    print(" -> passed; time =", '{0:.2f}'.format(end_time - start_time), "seconds")
+
+    print("test_engine_loop_notify")
+    start_time = time.time()
+    test_engine_loop_notify()
+    end_time = time.time()
+    print(" -> passed; time =", '{0:.2f}'.format(end_time - start_time), "seconds")
+
+    print("test_info_buffer")
+    start_time = time.time()
+    test_info_buffer()
+    end_time = time.time()
+    print(" -> passed; time =", '{0:.2f}'.format(end_time - start_time), "seconds")
+
+    print("test_ponder")
+    start_time = time.time()
+    test_ponder()
+    end_time = time.time()
+    print(" -> passed; time =", '{0:.2f}'.format(end_time - start_time), "seconds")
+
+    print("test_multipv_analysis")
+    start_time = time.time()
+    test_multipv_analysis()
+    end_time = time.time()
+    print(" -> passed; time =", '{0:.2f}'.format(end_time - start_time), "seconds")
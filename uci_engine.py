@@ -0,0 +1,448 @@
+import argparse
+import asyncio
+import queue
+import threading
+import time
+import chess_board
+import rulebook as rules
+
+# Info fields with an integer value
+INFO_INTEGER_FIELDS = ("depth", "seldepth", "multipv", "nodes", "nps", "time", "hashfull", "tbhits", "currmovenumber")
+
+# Centipawn value of a mate, less the number of moves to the mate
+MATE_SCORE = 10000
+
+# Seconds an engine may take to send bestmove beyond the time its search was given
+GO_TIMEOUT_MARGIN = 5
+
+class UCIError(Exception):
+    """ An engine that does not answer in time, or that has exited """
+    pass
+
+class UCIEngine():
+    """
+    Asynchronous client of a Universal Chess Interface (UCI) engine running as a
+    subprocess.  The methods are coroutines, and one event loop can drive any number
+    of engines at once.  Each engine's output is read by a single reader task, which
+    passes the replies waited for (uciok, readyok, bestmove) to the waiting coroutine
+    and the info lines of a search to info_callback.
+
+    Callers sending a sequence of commands (such as position and go) should hold
+    self.lock, so that sequences from different callers do not interleave.
+    """
+
+    def __init__(self, command, verbose = True):
+        self.command = command # Program and its arguments
+        self.verbose = verbose
+        self.process = None
+        self.reader_task = None
+        self.lock = asyncio.Lock()
+        self.name = None
+        self.options = {} # Option name -> its type and values
+        self.waiting = {} # First word of an awaited reply -> future
+        self.info_callback = None # Called on the event loop with each info line
+        self.bestmove_time = 0 # time.perf_counter() when the last bestmove was read
+        self.go_timeout_margin = GO_TIMEOUT_MARGIN
+
+    async def start(self):
+        try:
+            self.process = await asyncio.create_subprocess_exec(*self.command,
+                                                                stdin = asyncio.subprocess.PIPE,
+                                                                stdout = asyncio.subprocess.PIPE,
+                                                                stderr = asyncio.subprocess.DEVNULL)
+        except OSError as e:
+            raise UCIError("Cannot start engine " + str(self.command[0]) + ": " + str(e))
+        self.reader_task = asyncio.ensure_future(self.read_lines())
+
+    async def read_lines(self):
+        while True:
+            line = await self.process.stdout.readline()
+            if not line:
+                break
+            line = line.decode(errors = "replace").strip()
+            if self.verbose:
+                print("From external engine:", line)
+            words = line.split()
+            if not words:
+                continue
+            if words[0] == "info":
+                if self.info_callback:
+                    self.info_callback(line)
+            elif words[0] == "id" and len(words) > 2 and words[1] == "name":
+                self.name = line.split(None, 2)[2]
+            elif words[0] == "option" and len(words) > 2 and words[1] == "name":
+                # Option names may contain spaces, and end at the type
+                rest = line.split(None, 2)[2]
+                name, sep, details = rest.partition(" type ")
+                self.options[name] = details
+            elif words[0] in self.waiting:
+                if words[0] == "bestmove":
+                    self.bestmove_time = time.perf_counter()
+                future = self.waiting.pop(words[0])
+                if not future.done():
+                    future.set_result(words)
+
+        # The engine has exited, so nothing waited for will arrive
+        for future in self.waiting.values():
+            if not future.done():
+                future.set_exception(UCIError("Engine " + str(self.command[0]) + " has exited"))
+        self.waiting.clear()
+
+    async def send(self, line, reply = None, timeout = None):
+        """ Send a line to the engine, and if reply is given, return the words of the
+        engine's next line starting with it """
+        future = None
+        if reply is not None:
+            if self.reader_task is None or self.reader_task.done():
+                raise UCIError("Engine " + str(self.command[0]) + " is not running")
+            future = asyncio.get_running_loop().create_future()
+            self.waiting[reply] = future
+        if self.verbose:
+            print("To external engine:", line)
+        try:
+            self.process.stdin.write((line + "\n").encode())
+            await self.process.stdin.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            self.waiting.pop(reply, None)
+            raise UCIError("Engine " + str(self.command[0]) + " has exited")
+        if future is None:
+            return None
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            self.waiting.pop(reply, None)
+            raise UCIError("Engine " + str(self.command[0]) + " did not send " + reply + " within " + str(timeout) + " seconds")
+
+    async def handshake(self, timeout = 10):
+        """ Switch the engine to UCI mode and wait until it is ready """
+        await self.send("uci", "uciok", timeout)
+        await self.is_ready(timeout)
+
+    async def is_ready(self, timeout = 10):
+        await self.send("isready", "readyok", timeout)
+
+    async def set_option(self, name, value):
+        await self.send("setoption name " + name + " value " + str(value))
+
+    async def new_game(self, timeout = 10):
+        await self.send("ucinewgame")
+        await self.is_ready(timeout)
+
+    async def position(self, moves, fen = None):
+        """ Set the position from the starting position (or FEN) and moves in long algebraic notation """
+        line = "position startpos" if fen is None else "position fen " + fen
+        if moves:
+            line += " moves " + " ".join(moves)
+        await self.send(line)
+
+    async def go(self, depth = None, movetime = None, wtime = None, btime = None, winc = None, binc = None, ponder = False, infinite = False):
+        """
+        Search the current position, returning (best move, ponder move or None) in long
+        algebraic notation once the engine sends bestmove.  Limits that are None are not sent.
+        If ponder is True, the position is searched on the opponent's time, and the search
+        only ends once ponderhit turns it into a normal search (or stop ends it).  If
+        infinite is True, the search only ends with stop.
+
+        A search limited by movetime or the clock raises UCIError if bestmove has not
+        arrived go_timeout_margin seconds after the time it was given.  Searches limited
+        only by depth, and ponder and infinite searches, are waited for without a timeout.
+        """
+        line = "go ponder" if ponder else "go"
+        for name, value in [("depth", depth), ("movetime", movetime), ("wtime", wtime),
+                            ("btime", btime), ("winc", winc), ("binc", binc)]:
+            if value is not None:
+                line += " " + name + " " + str(value)
+        if infinite:
+            line += " infinite"
+        timeout = None
+        if not ponder and not infinite:
+            limits = []
+            if movetime is not None:
+                limits.append(movetime)
+            if wtime is not None or btime is not None:
+                # The side to move cannot use more than its clock and one increment
+                limits.append(max(wtime or 0, btime or 0) + max(winc or 0, binc or 0))
+            if limits:
+                timeout = min(limits) / 1000 + self.go_timeout_margin
+        words = await self.send(line, "bestmove", timeout)
+        best_move = words[1] if len(words) > 1 else None
+        ponder_move = words[3] if len(words) > 3 and words[2] == "ponder" else None
+        return best_move, ponder_move
+
+    async def ponderhit(self):
+        """ The opponent played the expected move, so the ponder search carries on as a normal search """
+        await self.send("ponderhit")
+
+    async def stop(self):
+        """ Stop the search, whose go call then returns the best move found so far """
+        if self.process is not None and self.process.returncode is None:
+            await self.send("stop")
+
+    async def quit(self, timeout = 2):
+        if self.process is None or self.process.returncode is not None:
+            return
+        try:
+            await self.send("quit")
+            await asyncio.wait_for(self.process.wait(), timeout)
+        except (UCIError, asyncio.TimeoutError):
+            self.process.kill()
+            await self.process.wait()
+
+def parse_info(line):
+    """
+    Returns a dictionary of the fields of an info line: integer fields (such as depth,
+    seldepth, nodes, and nps), score_cp or score_mate (with score_bound set to
+    "lowerbound" or "upperbound" if the score is a bound), currmove, pv as a list of
+    moves in long algebraic notation, and string.  Fields the line does not have are left out.
+    """
+    info = {}
+    words = line.split()
+    i = 1
+    while i < len(words):
+        word = words[i]
+        try:
+            if word in INFO_INTEGER_FIELDS:
+                info[word] = int(words[i + 1])
+                i += 2
+            elif word == "score":
+                info["score_" + words[i + 1]] = int(words[i + 2])
+                i += 3
+                if i < len(words) and words[i] in ("lowerbound", "upperbound"):
+                    info["score_bound"] = words[i]
+                    i += 1
+            elif word == "currmove":
+                info["currmove"] = words[i + 1]
+                i += 2
+            elif word == "pv":
+                # The moves of the principal variation run to the end of the line
+                info["pv"] = words[i + 1:]
+                break
+            elif word == "string":
+                info["string"] = " ".join(words[i + 1:])
+                break
+            else:
+                i += 1
+        except (IndexError, ValueError):
+            # A field cut short or with a bad value ends the line
+            break
+    return info
+
+def score_centipawns(info):
+    """ Score of parsed info in centipawns from the side to move's view, counting a mate as
+    MATE_SCORE less its number of moves, or None if it has no score """
+    if "score_cp" in info:
+        return info["score_cp"]
+    if "score_mate" in info:
+        mate = info["score_mate"]
+        return MATE_SCORE - mate if mate > 0 else -MATE_SCORE - mate
+    return None
+
+class InfoBuffer():
+    """
+    Coalesces the parsed info lines of a search, for a program that draws them at
+    its own rate rather than once per line.  The engine loop's thread adds lines with
+    update, keeping only the latest value of each field, and the program's thread
+    takes the fields that have changed since it last looked.  Lines of a different
+    search (by search id) replace, rather than add to, the fields.
+
+    With MultiPV, the fields of each principal variation are also kept by their
+    multipv number, and only the first variation's fields (and the search-wide
+    counters of the others) become the search's fields.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.search_id = None
+        self.fields = {}
+        self.pv_lines = {} # multipv number -> latest fields of that variation
+        self.changed = False
+        self.lines = 0 # Lines coalesced since the last take
+
+    def merge(self, fields, info):
+        # A score replaces the other kind of score, and any bound of the last
+        if "score_cp" in info or "score_mate" in info:
+            fields.pop("score_cp", None)
+            fields.pop("score_mate", None)
+            fields.pop("score_bound", None)
+        fields.update(info)
+
+    def update(self, search_id, info):
+        with self.lock:
+            if search_id != self.search_id:
+                self.search_id = search_id
+                self.fields = {}
+                self.pv_lines = {}
+                self.lines = 0
+            number = info.get("multipv", 1)
+            if "multipv" in info:
+                self.merge(self.pv_lines.setdefault(number, {}), info)
+            if number == 1:
+                self.merge(self.fields, info)
+            else:
+                self.fields.update((k, info[k]) for k in ("nodes", "nps", "time", "hashfull", "tbhits") if k in info)
+            self.changed = True
+            self.lines += 1
+
+    def take(self, search_id):
+        """ Returns (the latest fields of the search, the number of lines since the last
+        take), or None if nothing has arrived for the search since the last take.  With
+        MultiPV, the fields include "lines", the latest fields of each variation by number. """
+        with self.lock:
+            if not self.changed or search_id != self.search_id:
+                return None
+            self.changed = False
+            lines = self.lines
+            self.lines = 0
+            fields = dict(self.fields)
+            if self.pv_lines:
+                fields["lines"] = {number: dict(line) for number, line in self.pv_lines.items()}
+            return fields, lines
+
+class EngineLoop():
+    """
+    Runs an asyncio event loop in a background thread, so that engines can be driven
+    from a program (such as the tkinter GUI) whose own thread must not block.
+    Coroutines submitted with a tag put (tag, result, exception) on self.results
+    when they finish, for the program to collect from its own thread.
+
+    Instead of polling, the program can set notify, which is called from the loop's
+    thread when results arrive.  It is called once until the program next calls
+    collect, however many results arrive in between.
+    """
+
+    def __init__(self, notify = None):
+        self.loop = asyncio.new_event_loop()
+        self.results = queue.Queue()
+        self.notify = notify
+        self.notify_pending = False
+        self.thread = threading.Thread(target = self.loop.run_forever, daemon = True)
+        self.thread.start()
+
+    def submit(self, coroutine, tag = None):
+        """ Run the coroutine on the loop, returning its concurrent.futures.Future """
+        future = asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+        if tag is not None:
+            future.add_done_callback(lambda f: self.deliver(tag, f))
+        return future
+
+    def deliver(self, tag, future):
+        if future.cancelled():
+            self.post(tag, None, asyncio.CancelledError())
+        elif future.exception() is not None:
+            self.post(tag, None, future.exception())
+        else:
+            self.post(tag, future.result())
+
+    def post(self, tag, result, error = None):
+        """ Put a result on self.results, notifying the program if it is not already due to collect """
+        self.results.put((tag, result, error))
+        if self.notify is not None and not self.notify_pending:
+            self.notify_pending = True
+            self.notify()
+
+    def collect(self):
+        """ Returns the list of waiting (tag, result, exception) """
+        # Clear the flag first, so that a result posted while collecting notifies again
+        self.notify_pending = False
+        collected = []
+        while True:
+            try:
+                collected.append(self.results.get_nowait())
+            except queue.Empty:
+                return collected
+
+    def close(self, engines = (), timeout = 2):
+        """ Quit the engines and stop the loop """
+        engines = [e for e in engines if e is not None]
+        if engines:
+            future = self.submit(quit_engines(engines, timeout))
+            try:
+                future.result(timeout + 1)
+            except Exception:
+                pass
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(timeout)
+
+async def quit_engines(engines, timeout = 2):
+    await asyncio.gather(*[e.quit(timeout) for e in engines], return_exceptions = True)
+
+def move_is_legal(board, uci):
+    if uci is None or len(uci) < 4:
+        return False
+    try:
+        start_row, start_col, end_row, end_col = chess_board.uci_to_squares(uci)
+    except ValueError:
+        return False
+    all_valid_moves = rules.compute_all_valid_moves(board)
+    return any(m[0] == end_row and m[1] == end_col for m in all_valid_moves.get((start_row, start_col), []))
+
+async def play_game(white, black, movetime = 100, max_plies = 500):
+    """
+    Play a game between two started engines, returning (result, moves in long algebraic
+    notation).  An engine that fails or plays an illegal move loses the game.
+    """
+    board = chess_board.Board()
+    await white.new_game()
+    await black.new_game()
+    while len(board.move_history) < max_plies:
+        game_over, status = rules.check_for_terminal_states_and_king_checks(board)
+        if game_over:
+            if status == 1 or status == -1:
+                return ("0-1" if board.whites_turn else "1-0"), board.uci_moves()
+            return "1/2-1/2", board.uci_moves()
+        engine = white if board.whites_turn else black
+        try:
+            async with engine.lock:
+                await engine.position(board.uci_moves())
+                best_move, ponder_move = await engine.go(movetime = movetime)
+        except UCIError:
+            best_move = None
+        if not move_is_legal(board, best_move):
+            return ("0-1" if board.whites_turn else "1-0"), board.uci_moves()
+        # The board only promotes to a queen
+        start_row, start_col, end_row, end_col = chess_board.uci_to_squares(best_move)
+        board.make_move(start_row, start_col, end_row, end_col)
+    return "1/2-1/2", board.uci_moves()
+
+async def play_match(first_command, second_command, games, movetime, verbose = False):
+    """ Play all games of a match at once, each between its own pair of engine processes,
+    returning the number of points scored by the first engine """
+    engines = [UCIEngine(command, verbose) for i in range(games) for command in (first_command, second_command)]
+    try:
+        await asyncio.gather(*[e.start() for e in engines])
+        await asyncio.gather(*[e.handshake() for e in engines])
+        pairings = []
+        for game in range(games):
+            first, second = engines[2 * game], engines[2 * game + 1]
+            # Alternate colors between games
+            pairings.append((first, second) if game % 2 == 0 else (second, first))
+        results = await asyncio.gather(*[play_game(white, black, movetime) for white, black in pairings])
+    finally:
+        await quit_engines([e for e in engines if e.process is not None])
+
+    points = 0
+    for game, (result, moves) in enumerate(results):
+        first_is_white = game % 2 == 0
+        if result == "1/2-1/2":
+            points += 0.5
+        elif (result == "1-0") == first_is_white:
+            points += 1
+        print("Game", game + 1, result, "after", len(moves), "plies")
+    return points
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description = "Play a match between two UCI engines, with all games played at once")
+    parser.add_argument("first_engine")
+    parser.add_argument("second_engine")
+    parser.add_argument("--games", type = int, default = 10)
+    parser.add_argument("--movetime", type = int, default = 100, help = "milliseconds per move")
+    parser.add_argument("--verbose", action = "store_true", help = "print every line sent to and from the engines")
+    args = parser.parse_args()
+
+    start_time = time.perf_counter()
+    points = asyncio.run(play_match([args.first_engine], [args.second_engine], args.games, args.movetime, args.verbose))
+    elapsed = time.perf_counter() - start_time
+
+    print("Score of", args.first_engine, "vs", args.second_engine + ":", points, "-", args.games - points)
+    print("Time:", '{0:.2f}'.format(elapsed), "seconds")
@@ -1,4 +1,10 @@
 import random
+import polyglot_random
+
+# Seed of the random values.  Using the same seed for every hasher gives every
+# board the same hash for the same position, so hashes can be used as keys in
+# tables shared between boards (such as the opening book).
+DEFAULT_SEED = 0x436f72616c
 
 class ZobristHasher():
     """
@@ -6,7 +12,14 @@ class ZobristHasher():
     See https://en.wikipedia.org/wiki/Zobrist_hashing for more information.
     """
 
-    def __init__(self):
+    def __init__(self, seed = DEFAULT_SEED, polyglot = False):
+        """
+        If polyglot is True, the random values of the Polyglot opening book format
+        are used in place of seeded ones, so that hashes are Polyglot book keys.
+        """
+
+        # Random number generator for the values below
+        self.random = random.Random(seed)
 
         # Unique number for each piece
         self.piece_index = {}
@@ -31,12 +44,35 @@ class ZobristHasher():
         # Random values for en passant file (column)
         self.hash_en_passant = [self.random_value() for e in range(8)]
 
+        # Whether the turn value is applied when it is white's turn rather than black's
+        self.hash_turn_when_white = False
+
+        if polyglot:
+            self.use_polyglot_values()
+
+    def use_polyglot_values(self):
+        values = polyglot_random.RANDOM_64
+        # Polyglot piece kinds alternate black and white, and its squares count up from a1
+        for p, kind in zip("pPnNbBrRqQkK", range(12)):
+            for square in range(64):
+                row, col = divmod(square, 8)
+                self.hash_piece[square][self.piece_index[p]] = values[64 * kind + (7 - row) * 8 + col]
+        self.hash_white_ks_castling_rights = values[768]
+        self.hash_white_qs_castling_rights = values[769]
+        self.hash_black_ks_castling_rights = values[770]
+        self.hash_black_qs_castling_rights = values[771]
+        self.hash_en_passant = values[772:780]
+        # Polyglot applies its turn value when it is white's turn.  Since the value
+        # is toggled by every move either way, only full_hash needs to know this.
+        self.hash_blacks_turn = values[780]
+        self.hash_turn_when_white = True
+
     def random_value(self):
-        return random.randint(0, pow(2, 64))
+        return self.random.getrandbits(64)
     
     def full_hash(self, board):
         h = 0
-        if not board.whites_turn:
+        if board.whites_turn == self.hash_turn_when_white:
             h ^= self.hash_blacks_turn
         for i in range(64):
             row = i // 8